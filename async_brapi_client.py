@@ -0,0 +1,401 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List
+from urllib.parse import urlparse
+
+import aiohttp
+
+from brapi_calls import BrapiCalls, known_brapi_calls, register_brapi_calls
+from brapi_client import route_template, url_path_join
+from json_backend import get_json_loads
+from page_size_controller import PageSizeController, Paging
+from retry_policy import RETRY_STATUSES, RetryPolicy, parse_retry_after
+from run_metrics import RunMetrics
+from tracing import span
+
+try:
+    from streaming_json import AsyncResponseStream, JSONError, aiter_result_data
+except ImportError:
+    # ijson is not installed: pages can not be streamed
+    aiter_result_data = None
+
+
+class AsyncBrapiClient:
+    """ Provide asyncio methods to the BRAPI, mirroring BrapiClient
+
+    Every request goes through one aiohttp session and at most `concurrency` requests are in flight at once, so many
+    studies, pages and germplasm lookups can be fetched concurrently on one event loop.
+    """
+
+    def __init__(self, endpoint: str, logger: logging.Logger, session: aiohttp.ClientSession = None,
+                 concurrency: int = 10, timeout: float = 300, prefetch_pages: int = 0,
+                 calls_cache_dir: str = None, calls_cache_ttl: float = 86400,
+                 page_size_controller: PageSizeController = None, retry_policy: RetryPolicy = None,
+                 json_backend: str = None, stream_pages: bool = False, metrics: RunMetrics = None):
+        """
+        :param endpoint BrAPI server endpoint
+        :param logger logger used to trace the requests
+        :param session aiohttp session to use, one is created on first request if not provided
+        :param concurrency maximum number of requests in flight
+        :param timeout timeout in seconds of every request
+        :param prefetch_pages number of pages fetched concurrently by fetch_objects (0 to disable)
+        :param calls_cache_dir directory where the result of /calls is persisted (None to keep it in memory only)
+        :param calls_cache_ttl time in seconds after which the persisted result of /calls is discovered again
+        :param page_size_controller controller tuning the page size of paginated calls (one is created if not provided,
+                                    it can be shared with BrapiClient instances)
+        :param retry_policy policy retrying failed requests (one is created if not provided)
+        :param json_backend JSON library decoding the responses (see json_backend.BACKENDS), the fastest installed
+                            one if not provided
+        :param stream_pages if True, the objects of the pages fetched one after another are parsed and yielded as the
+                            response body is received (requires ijson), the request then holds one of the
+                            `concurrency` slots until its page is consumed
+        :param metrics if provided, every request is recorded there, by route template (see run_metrics)
+        """
+        self.endpoint = endpoint
+        self.logger = logger
+        self.session = session
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.prefetch_pages = prefetch_pages
+        self.calls_cache_dir = calls_cache_dir
+        self.calls_cache_ttl = calls_cache_ttl
+        self.page_size_controller = page_size_controller or PageSizeController(logger)
+        self.retry_policy = retry_policy or RetryPolicy(logger)
+        self.json_backend, self.json_loads = get_json_loads(json_backend)
+        if stream_pages and aiter_result_data is None:
+            logger.warning("ijson is not installed, pages will not be streamed")
+        self.stream_pages = stream_pages and aiter_result_data is not None
+        self.metrics = metrics
+        self._endpoint_path = urlparse(endpoint).path.rstrip('/')
+        self.obs_unit_call = " "
+        self.obs_var_call = " "
+        self._calls = None
+        self._calls_lock = None
+        self._semaphore = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(headers={'Accept': 'application/json'},
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                 connector=aiohttp.TCPConnector(limit=self.concurrency))
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def close(self):
+        """Close the aiohttp session"""
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get_calls(self) -> BrapiCalls:
+        """Return the calls supported by the endpoint (shared with BrapiClient, see brapi_calls.get_brapi_calls)"""
+        if self._calls is not None:
+            return self._calls
+        if self._calls_lock is None:
+            self._calls_lock = asyncio.Lock()
+        # concurrent tasks wait for the discovery of the first one
+        async with self._calls_lock:
+            if self._calls is None:
+                self._calls = known_brapi_calls(self.endpoint, self.calls_cache_dir, self.calls_cache_ttl,
+                                                self.logger)
+            if self._calls is None:
+                self.logger.debug("Discovering calls of " + self.endpoint)
+                calls = [call async for call in self.fetch_objects('GET', '/calls')]
+                self._calls = register_brapi_calls(self.endpoint, calls, self.calls_cache_dir, self.logger)
+        return self._calls
+
+    async def _get_obs_unit_call(self) -> str:
+        """Choose which BrAPI call to use in order to fetch observation unit by study"""
+        if self.obs_unit_call == " ":
+            calls = await self.get_calls()
+            if len(calls) == 0 or calls.supports('studies/{studyDbId}/observationUnits'):
+                self.obs_unit_call = "observationUnits"
+            else:
+                self.obs_unit_call = "observationunits"
+        return self.obs_unit_call
+
+    async def _get_obs_var_call(self) -> str:
+        """Choose which BrAPI call to use in order to fetch observation variables by study"""
+        if self.obs_var_call == " ":
+            calls = await self.get_calls()
+            if len(calls) == 0 or calls.supports('studies/{studyDbId}/observationVariables'):
+                self.obs_var_call = "observationVariables"
+            else:
+                self.obs_var_call = "observationvariables"
+        return self.obs_var_call
+
+    async def get_study(self, study_id: str) -> dict:
+        """"Given a BRAPI study object from a BRAPI endpoint server"""
+        return await self.fetch_object(f'/studies/{study_id}')
+
+    def get_study_germplasms(self, study_id: str) -> AsyncIterator:
+        """"Given a BRAPI study identifier returns an array of germplasm objects"""
+        return self.fetch_objects('GET', f'/studies/{study_id}/germplasm')
+
+    async def get_study_observation_units(self, study_id: str) -> AsyncIterator:
+        """ Given a BRAPI study identifier, return an list of BRAPI observation units"""
+        observation_unit_call = await self._get_obs_unit_call()
+        async for obs_unit in self.fetch_objects('GET', f'/studies/{study_id}/{observation_unit_call}'):
+            yield obs_unit
+
+    async def get_germplasm(self, germplasm_id: str) -> dict:
+        """ Given a BRAPI germplasm identifiers, return an list of BRAPI germplasm attributes"""
+        return await self.fetch_object(f'/germplasm/{germplasm_id}')
+
+    async def get_germplasms_by_ids(self, germplasm_ids: List[str]) -> List[dict]:
+        """
+        Given a list of BRAPI germplasm identifiers, return the BRAPI germplasm attributes in the same order
+        Germplasms are searched by batch when the endpoint supports POST germplasm-search, otherwise they are fetched
+        concurrently.
+        """
+        if (await self.get_calls()).supports('germplasm-search', 'POST'):
+            return await self._search_germplasms_by_ids(germplasm_ids)
+        return list(await asyncio.gather(*(self.get_germplasm(germplasm_id) for germplasm_id in germplasm_ids)))
+
+    async def _search_germplasms_by_ids(self, germplasm_ids: List[str], batch_size: int = 1000) -> List[dict]:
+        """Search germplasm details by batch of ids with germplasm-search, returned in the order of the ids"""
+        germplasms = []
+        for start in range(0, len(germplasm_ids), batch_size):
+            batch = germplasm_ids[start:start + batch_size]
+            found = {}
+            async for germplasm in self.fetch_objects('POST', '/germplasm-search',
+                                                      data={'germplasmDbIds': list(set(batch))}):
+                found[germplasm['germplasmDbId']] = germplasm
+            # not returned by the search, fallback to the single germplasm call
+            missing = list(dict.fromkeys(germplasm_id for germplasm_id in batch if germplasm_id not in found))
+            found.update(zip(missing, await asyncio.gather(*(self.get_germplasm(germplasm_id)
+                                                             for germplasm_id in missing))))
+            germplasms.extend(found[germplasm_id] for germplasm_id in batch)
+        return germplasms
+
+    async def get_study_observed_variables(self, study_id: str) -> AsyncIterator:
+        """" Given a BRAPI study identifier, returns a list of BRAPI observation Variables objects """
+        observation_var_call = await self._get_obs_var_call()
+        async for obs_var in self.fetch_objects('GET', f'/studies/{study_id}/{observation_var_call}'):
+            yield obs_var
+
+    async def get_trials(self, trial_ids: List[str]) -> AsyncIterator:
+        """"
+        Return trials found in a given BRAPI endpoint server
+        :param trial_ids list of trial ids to fetch, ["all"] to fetch every trial of the endpoint
+        :return async iterable of BrAPI trials (pared from JSON as python dict)
+        """
+        if trial_ids == ["all"]:
+            self.logger.info("Return all trials")
+            async for trial in self.fetch_objects('GET', '/trials'):
+                yield trial
+        else:
+            self.logger.info("Return  trials: " + str(trial_ids))
+            for trial in await asyncio.gather(*(self.fetch_object(f'/trials/{trial_id}') for trial_id in trial_ids)):
+                yield trial
+
+    async def fetch_object(self, path: str) -> dict:
+        """
+        Fetch single BrAPI object by path
+        :param path URL path of the BrAPI call (ex '/studies/1', '/germplasm/2', ...)
+        :return a BrAPI object parsed from JSON to python dict
+        """
+        url = url_path_join(self.endpoint, path)
+        status, body = await self._request('GET', url)
+        if status != 200:
+            self.logger.error("problem with request: " + url + " " + str(status))
+            raise RuntimeError("Non-200 status code")
+        return body["result"]
+
+    async def fetch_objects(self, method: str, path: str, params: dict = None, data: dict = None,
+                            prefetch_pages: int = None) -> AsyncIterator:
+        """
+        Fetch BrAPI objects with pagination (see BrapiClient.fetch_objects)
+        :return async iterable of BrAPI objects parsed from JSON to python dict
+        """
+        if prefetch_pages is None:
+            prefetch_pages = self.prefetch_pages
+        params = params or {}
+        url = url_path_join(self.endpoint, path)
+        paging = Paging(self.page_size_controller, urlparse(url).netloc, route_template(path))
+        attempt = 0
+        while paging.has_next():
+            paging.params(params)
+            self.logger.debug('retrieving page ' + str(paging.page) + ' of ' + str(paging.page_count) + ' from ' +
+                              str(url))
+            start = time.monotonic()
+            failure = None
+            try:
+                async with self._open(method, url, params, data, self.stream_pages) as (r, content):
+                    latency = time.monotonic() - start
+                    status, retry_after = r.status, parse_retry_after(r.headers.get('Retry-After'))
+                    if status == 200 and self.stream_pages:
+                        pagination = {}
+                        page_stream = AsyncResponseStream(r)
+                        index = None
+                        try:
+                            async for obj in aiter_result_data(page_stream, pagination):
+                                if index is None:
+                                    # BrAPI responses give the pagination before the objects
+                                    index = paging.first_index(pagination)
+                                # skip the objects already yielded before a retry of the page
+                                if paging.is_new(index):
+                                    yield obj
+                                index += 1
+                        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError,
+                                JSONError) as error:
+                            failure = error
+                        finally:
+                            if self.metrics is not None:
+                                self.metrics.record_bytes(method, paging.route, page_stream.bytes_read)
+                        page_bytes = page_stream.bytes_read
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                if isinstance(error, asyncio.TimeoutError) and paging.shrink():
+                    self.logger.info("Timeout, testing with pagesize = " + str(paging.page_size))
+                    continue
+                failure = error
+            if failure is not None:
+                if not await self._backoff(url, attempt, method, repr(failure)):
+                    raise failure
+                # resume at the failed page, the objects of the previous pages are already yielded
+                attempt += 1
+                continue
+            if status == 504:
+                if paging.shrink():
+                    self.logger.info("504 Gateway Timeout Error, testing with pagesize = " + str(paging.page_size))
+                    continue
+            elif status >= 500:
+                # not caused by the page size: the same page is retried, but the controller learns of the error
+                paging.record_failure()
+            if status in RETRY_STATUSES and await self._backoff(url, attempt, method, str(status), retry_after):
+                attempt += 1
+                continue
+            if status != 200:
+                self.logger.error("problem with request: " + url + " " + str(status))
+                raise RuntimeError("Non-200 status code")
+            if not self.stream_pages:
+                # the body is decoded once, for both its pagination and its objects
+                with span('decode', 'json', page=paging.page) as decode_span:
+                    body = self.json_loads(content)
+                    decode_span.set(objects=len(body['result']['data']))
+                pagination = body['metadata']['pagination']
+                for index, obj in enumerate(body['result']['data'], paging.first_index(pagination)):
+                    if paging.is_new(index):
+                        yield obj
+                page_bytes = len(content)
+            attempt = 0
+            next_page_size = paging.next_page(pagination, latency, page_bytes)
+            if prefetch_pages > 0 and paging.has_next():
+                # page count is known: fetch the remaining pages concurrently
+                async for obj in self._fetch_pages_concurrently(method, url, paging.params(params), data, paging.page,
+                                                                paging.page_count, prefetch_pages):
+                    yield obj
+                return
+            paging.resize(next_page_size)
+
+    async def _fetch_pages_concurrently(self, method: str, url: str, params: dict, data: dict, first_page: int,
+                                        last_page: int, workers: int) -> AsyncIterator:
+        """Fetch pages [first_page, last_page[ with a look-ahead of `workers` pages, yielding objects in page order"""
+        async def fetch_page(page):
+            status, body = await self._request(method, url, dict(params, page=page), data)
+            if status != 200:
+                self.logger.error("problem with request: " + url + " " + str(status))
+                raise RuntimeError("Non-200 status code")
+            return body['result']['data']
+
+        pending = deque()
+        next_page = first_page
+        try:
+            while next_page < last_page or pending:
+                while next_page < last_page and len(pending) < workers:
+                    pending.append(asyncio.ensure_future(fetch_page(next_page)))
+                    next_page += 1
+                for obj in await pending.popleft():
+                    yield obj
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _request(self, method: str, url: str, params: dict = None, data: dict = None):
+        """Send one request, retrying transient failures (see RetryPolicy), and return its status and JSON body"""
+        attempt = 0
+        while True:
+            try:
+                status, body, retry_after = await self._send(method, url, params, data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                if not await self._backoff(url, attempt, method, repr(error)):
+                    raise
+            else:
+                if status not in RETRY_STATUSES or not await self._backoff(url, attempt, method, str(status),
+                                                                           retry_after):
+                    return status, body
+            attempt += 1
+
+    async def _backoff(self, url: str, attempt: int, method: str, failure: str, retry_after: float = None) -> bool:
+        """Wait before retrying a failed request, return False if it must not be retried"""
+        delay = self.retry_policy.delay(urlparse(url).netloc, attempt, retry_after)
+        if delay is None:
+            return False
+        if self.metrics is not None:
+            self.metrics.record_retry(method, self._route(url))
+        self.logger.warning("Request to " + url + " failed (" + failure + "), retry " + str(attempt + 1) +
+                            " in " + format(delay, '.1f') + "s")
+        await asyncio.sleep(delay)
+        return True
+
+    async def _send(self, method: str, url: str, params: dict = None, data: dict = None):
+        """Send one request within the concurrency limit, return its status, decoded JSON body and Retry-After"""
+        async with self._open(method, url, params, data) as (r, content):
+            if r.status != 200:
+                return r.status, None, parse_retry_after(r.headers.get('Retry-After'))
+        return r.status, self.json_loads(content), None
+
+    @asynccontextmanager
+    async def _open(self, method: str, url: str, params: dict = None, data: dict = None, stream: bool = False):
+        """
+        Send one request within the concurrency limit, recording it in the metrics if any, and tracing it if enabled
+        :return the response and its body, the body is None if stream is True: it is then read from the response,
+                which holds its connection and concurrency slot until the context exits
+        """
+        session = self._get_session()
+        if method == 'POST':
+            # BrAPI v1 search calls take the pagination in the JSON body, along with the search parameters
+            kwargs = {'json': dict(data or {}, **(params or {}))}
+        elif method in ('GET', 'PUT'):
+            kwargs = {'params': {key: str(value) for key, value in (params or {}).items()}, 'data': data}
+        else:
+            raise RuntimeError(f"Unknown method: {method}")
+        route = self._route(url)
+        attributes = {'page': params['page'], 'page_size': params['pageSize']} if params and 'page' in params else {}
+        async with self._semaphore:
+            self.logger.debug(method + " " + url)
+            start = time.monotonic()
+            with span(method + ' ' + route, 'http', url=url, **attributes) as request_span:
+                try:
+                    r = await session.request(method, url, **kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if self.metrics is not None:
+                        self.metrics.record_request(method, route, None, time.monotonic() - start)
+                    raise
+                try:
+                    content = None if stream else await r.read()
+                except BaseException:
+                    r.release()
+                    raise
+                # the body of a streamed response is recorded once read
+                response_bytes = 0 if stream else len(content)
+                request_span.set(status=r.status, bytes=response_bytes)
+            if self.metrics is not None:
+                self.metrics.record_request(method, route, r.status, time.monotonic() - start, response_bytes)
+            try:
+                yield r, content
+            finally:
+                r.release()
+
+    def _route(self, url: str) -> str:
+        """BrAPI route template of a URL of the endpoint"""
+        return route_template(urlparse(url).path[len(self._endpoint_path):])
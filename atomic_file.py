@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+
+def atomic_write(path: str, data):
+    """
+    Write a file then rename it to path, so that a concurrent reader or a killed run never sees a partial file
+    The temporary file is removed if the write or the rename fails.
+    :param path path of the file, its directory is created if missing
+    :param data content of the file, bytes or a str written as UTF-8
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(fd, 'wb') as fh:
+            fh.write(data.encode('utf-8') if isinstance(data, str) else data)
+        os.replace(tmp_path, path)
+        tmp_path = None
+    finally:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
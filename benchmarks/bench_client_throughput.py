@@ -0,0 +1,69 @@
+"""
+Observation units fetched by second from a local stand-in BrAPI server, per client configuration
+
+The server (see brapi_stub_server) adds a fixed latency to every response and a latency by object of each page, so
+page size tuning, prefetching and streaming can be compared end to end without network.
+
+Usage: python benchmarks/bench_client_throughput.py [--units 20000] [--latency 0.05] [--latency-by-object 0.00002]
+                                                    [--error-rate 0]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import brapi_calls  # noqa: E402
+from brapi_client import BrapiClient, iter_result_data  # noqa: E402
+from brapi_stub_server import BrapiStubServer  # noqa: E402
+from page_size_controller import PageSizeController  # noqa: E402
+from retry_policy import RetryPolicy  # noqa: E402
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+# name: options of the BrapiClient
+CONFIGURATIONS = {
+    "pages of 1000": dict(page_size_controller=PageSizeController(logger, initial=1000, maximum=1000)),
+    "adaptive page size": dict(page_size_controller=PageSizeController(logger, initial=1000)),
+    "prefetch 4 pages": dict(page_size_controller=PageSizeController(logger, initial=1000, maximum=1000),
+                             prefetch_pages=4),
+    "streamed pages": dict(page_size_controller=PageSizeController(logger, initial=1000, maximum=1000),
+                           stream_pages=True),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--units', type=int, default=20000, help="observation units of the study")
+    parser.add_argument('--observations', type=int, default=10, help="observations by observation unit")
+    parser.add_argument('--latency', type=float, default=0.05, help="server latency in seconds of every response")
+    parser.add_argument('--latency-by-object', type=float, default=0.00002,
+                        help="server latency in seconds by object of a page")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability that a request fails with 503")
+    args = parser.parse_args()
+
+    with BrapiStubServer(observation_units=args.units, observations_by_unit=args.observations,
+                         latency=args.latency, latency_by_object=args.latency_by_object,
+                         error_rates=args.error_rate) as server:
+        for name, options in CONFIGURATIONS.items():
+            if options.get('stream_pages') and iter_result_data is None:
+                print(format(name, '<20') + "  ijson not installed")
+                continue
+            brapi_calls._calls_by_endpoint.clear()
+            server.requests.clear()
+            client = BrapiClient(server.endpoint, logger, retry_policy=RetryPolicy(logger, backoff=0.1), **options)
+            start = time.perf_counter()
+            units = sum(1 for _ in client.get_study_observation_units('1-1'))
+            seconds = time.perf_counter() - start
+            client.close()
+            print(format(name, '<20') + format(units / seconds, '10.0f') + " units/s" +
+                  format(server.requests['/studies/{id}/observationunits'], '6') + " requests" +
+                  format(seconds, '8.2f') + " s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+Wall time of the conversion stages on synthetic studies of growing size, with their scaling curves
+
+Each stage is timed on the sizes given for its input (observation units, germplasms or variables), the best time of
+--repeat runs is kept, and the scaling exponent between two sizes is reported (1.0 is linear, 2.0 quadratic).
+Results can be written to a JSON file (--output) and compared to the file of another commit (--compare): the
+command exits with status 1 if a stage got slower than --threshold.
+
+Usage: python benchmarks/bench_converter.py [--units 1000,10000,100000] [--germplasms 100,1000,5000]
+                                            [--variables 100,1000,5000] [--repeat 3] [--output results.json]
+                                            [--compare baseline.json] [--threshold 0.25]
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from isatools.model import Assay, OntologyAnnotation, Protocol, Source, Study  # noqa: E402
+
+import brapi_to_isa  # noqa: E402
+import synthetic_data  # noqa: E402
+from brapi_client import BrapiClient  # noqa: E402
+from brapi_to_isa_converter import BrapiToIsaConverter  # noqa: E402
+from compact_records import compact_observation_unit  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# germplasms and variables of the studies whose observation units are scaled
+GERMPLASMS_BY_STUDY = 500
+VARIABLES_BY_STUDY = 50
+OBSERVATIONS_BY_UNIT = 10
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+def study_observation_units(units: int) -> list:
+    """Observation units of a study, held as convert_study holds them"""
+    obs_variables = synthetic_data.variables(VARIABLES_BY_STUDY)
+    return [compact_observation_unit(obs_unit) for obs_unit in
+            synthetic_data.observation_units(units, obs_variables, GERMPLASMS_BY_STUDY, OBSERVATIONS_BY_UNIT)]
+
+
+def bench_obs_levels_and_var(converter, units: int):
+    obs_units = study_observation_units(units)
+    return lambda: converter.obtain_brapi_obs_levels_and_var("1", obs_units)
+
+
+def bench_germplasm_chars(converter, germplasms: int):
+    study_germplasms = synthetic_data.germplasms(germplasms)
+    return lambda: [converter.create_germplasm_chars(germ, germ_details) for germ, germ_details in study_germplasms]
+
+
+def bench_study_sample_and_assay(converter, units: int):
+    obs_units = study_observation_units(units)
+
+    def run():
+        # samples are added to the study: every run converts into a new one
+        isa_study = Study(filename="s_1.txt")
+        isa_study.sources = [Source(name=germ['germplasmName'])
+                             for germ, _ in synthetic_data.germplasms(GERMPLASMS_BY_STUDY)]
+        isa_study.assays.append(Assay(filename="a_1_plot.txt"))
+        sample_collection_protocol = Protocol(name="sample collection",
+                                              protocol_type=OntologyAnnotation(term="sample collection"))
+        phenotyping_protocol = Protocol(name="phenotyping",
+                                        protocol_type=OntologyAnnotation(term="nucleic acid sequencing"))
+        isa_study.protocols += [sample_collection_protocol, phenotyping_protocol]
+        start = time.perf_counter()
+        brapi_to_isa.create_study_sample_and_assay(None, "1", isa_study, sample_collection_protocol,
+                                                   phenotyping_protocol, obs_units)
+        return time.perf_counter() - start
+    run.times_itself = True
+    return run
+
+
+def bench_tdf_from_obsvars(converter, variables: int):
+    obs_variables = synthetic_data.variables(variables)
+    return lambda: converter.create_isa_tdf_from_obsvars(obs_variables)
+
+
+def bench_obs_data_from_obsvars(converter, units: int):
+    obs_units = study_observation_units(units)
+    germplasminfo = {germ['germplasmDbId']: [germ['accessionNumber']]
+                     for germ, _ in synthetic_data.germplasms(GERMPLASMS_BY_STUDY)}
+    obs_level_in_study, obs_levels = converter.obtain_brapi_obs_levels_and_var("1", obs_units)
+    level = synthetic_data.LEVELS[0]
+    obs_variables = sorted(obs_level_in_study[level])
+    return lambda: converter.create_isa_obs_data_from_obsvars(obs_units, obs_variables, level, germplasminfo,
+                                                              obs_levels)
+
+
+# name: (function preparing the run of a stage on a size, size argument, what the size counts)
+BENCHMARKS = {
+    'obtain_brapi_obs_levels_and_var': (bench_obs_levels_and_var, 'units', "observation units"),
+    'create_germplasm_chars': (bench_germplasm_chars, 'germplasms', "germplasms"),
+    'create_study_sample_and_assay': (bench_study_sample_and_assay, 'units', "observation units"),
+    'create_isa_tdf_from_obsvars': (bench_tdf_from_obsvars, 'variables', "variables"),
+    'create_isa_obs_data_from_obsvars': (bench_obs_data_from_obsvars, 'units', "observation units"),
+}
+
+
+def best_time(run, repeat: int) -> float:
+    """Best wall time in seconds of `repeat` runs"""
+    times = []
+    for _ in range(repeat):
+        if getattr(run, 'times_itself', False):
+            times.append(run())
+        else:
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def scaling_exponent(previous: dict, result: dict):
+    """Exponent k of time ~ size^k between two results of a stage"""
+    if previous['seconds'] <= 0 or result['seconds'] <= 0:
+        return None
+    return math.log(result['seconds'] / previous['seconds']) / math.log(result['size'] / previous['size'])
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names: list, sizes: dict, repeat: int) -> list:
+    converter = BrapiToIsaConverter(logger, "http://localhost/brapi/v1/", BrapiClient("http://localhost/brapi/v1/",
+                                                                                       logger))
+    results = []
+    for name in names:
+        prepare, size_argument, counted = BENCHMARKS[name]
+        print(name)
+        previous = None
+        for size in sizes[size_argument]:
+            seconds = best_time(prepare(converter, size), repeat)
+            result = {'benchmark': name, 'size': size, 'counts': counted, 'seconds': seconds,
+                      'per_item_us': seconds / size * 1e6}
+            line = "  " + format(size, '>8') + " " + format(counted, '<18') + format(seconds * 1000, '10.1f') + " ms" + \
+                   format(result['per_item_us'], '10.2f') + " us/item"
+            if previous is not None:
+                exponent = scaling_exponent(previous, result)
+                if exponent is not None:
+                    line += "   scaling x^" + format(exponent, '.2f')
+            print(line)
+            results.append(result)
+            previous = result
+    return results
+
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    """Print the time ratio of every result to the same stage and size of the baseline, return the regressions"""
+    baseline_times = {(result['benchmark'], result['size']): result['seconds'] for result in baseline['results']}
+    print("compared to " + str(baseline.get('commit')) + " (" + str(baseline.get('created')) + ")")
+    regressions = []
+    for result in results:
+        before = baseline_times.get((result['benchmark'], result['size']))
+        if not before:
+            continue
+        ratio = result['seconds'] / before
+        regressed = ratio > 1 + threshold
+        print("  " + format(result['benchmark'], '<34') + format(result['size'], '>8') + "  x" +
+              format(ratio, '.2f') + ("  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+def sizes_list(value: str) -> list:
+    return [int(size) for size in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--units', type=sizes_list, default=[1000, 10000, 100000],
+                        help="comma separated numbers of observation units")
+    parser.add_argument('--germplasms', type=sizes_list, default=[100, 1000, 5000],
+                        help="comma separated numbers of germplasms")
+    parser.add_argument('--variables', type=sizes_list, default=[100, 1000, 5000],
+                        help="comma separated numbers of observation variables")
+    parser.add_argument('--benchmark', choices=list(BENCHMARKS), action='append',
+                        help="stage to time (all by default), can be repeated")
+    parser.add_argument('--repeat', type=int, default=3, help="runs by measure, the best time is kept")
+    parser.add_argument('--output', help="JSON file where the results are written")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare to")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="relative slowdown reported as a regression by --compare")
+    args = parser.parse_args()
+
+    sizes = {'units': args.units, 'germplasms': args.germplasms, 'variables': args.variables}
+    results = run_benchmarks(args.benchmark or list(BENCHMARKS), sizes, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'commit': git_commit(), 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(), 'machine': platform.machine(), 'repeat': args.repeat,
+                       'results': results}, output, indent=2)
+        print("results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
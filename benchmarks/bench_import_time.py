@@ -0,0 +1,74 @@
+"""
+Start-up cost of the modules, each imported in a new interpreter as by a short-lived conversion job
+
+The client-only path imports the BrAPI client, the converter path the brapi_to_isa command line module, and the
+converter with isatools adds the ISA model and ISA-Tab writer imported by the first converted study. The time of an
+interpreter importing nothing is reported first, then the time added by every path. --top lists the slowest modules
+imported by every path, as measured by python -X importtime.
+
+Usage: python benchmarks/bench_import_time.py [--repeat 5] [--top 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: modules imported
+PATHS = {
+    "client only": ['brapi_client'],
+    "converter": ['brapi_to_isa'],
+    "converter with isatools": ['brapi_to_isa', 'isatools.model', 'isatools.isatab'],
+}
+
+
+def process_seconds(modules: list) -> float:
+    """Wall time in seconds of a new interpreter importing modules then exiting"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', '; '.join('import ' + module for module in modules) or 'pass'], cwd=ROOT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def imports_time(modules: list) -> list:
+    """(cumulative microseconds, module) of the modules imported by importing modules, and by their imports"""
+    code = '; '.join('import ' + module for module in modules) or 'pass'
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE).stderr.decode()
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        # the modules and their direct imports, not the imports of the dependencies
+        if cumulative.strip().isdigit() and len(name) - len(name.lstrip()) <= 3:
+            imports.append((int(cumulative), name.strip()))
+    return imports
+
+
+def slowest_imports(modules: list, top: int) -> list:
+    """(cumulative microseconds, module) of the `top` slowest imports of modules, not imported by the interpreter"""
+    start_up_modules = {module for _, module in imports_time([])}
+    return sorted((imported for imported in imports_time(modules) if imported[1] not in start_up_modules),
+                  reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="imports by path, the best time is kept")
+    parser.add_argument('--top', type=int, default=0, help="number of slowest imported modules listed by path")
+    args = parser.parse_args()
+
+    start_up = min(process_seconds([]) for _ in range(args.repeat))
+    print(format("interpreter start-up", '<26') + format(start_up * 1000, '10.1f') + " ms")
+    for name, modules in PATHS.items():
+        seconds = min(process_seconds(modules) for _ in range(args.repeat)) - start_up
+        print(format(name, '<26') + format(seconds * 1000, '+10.1f') + " ms")
+        for cumulative, module in slowest_imports(modules, args.top):
+            print("    " + format(module, '<34') + format(cumulative / 1000, '10.1f') + " ms")
+
+
+if __name__ == '__main__':
+    main()
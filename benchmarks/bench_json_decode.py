@@ -0,0 +1,80 @@
+"""
+CPU time spent decoding one page of BrAPI observation units, per JSON backend
+
+The page decoding of fetch_objects before (r.json() for the pagination, then again for the objects) is compared to
+decoding the body once with each installed backend.
+
+Usage: python benchmarks/bench_json_decode.py [--units 1000] [--observations 10] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_data  # noqa: E402
+from json_backend import BACKENDS, decode_response, get_json_loads  # noqa: E402
+
+
+def observation_units_page(units: int, observations: int) -> bytes:
+    """JSON body of a page of observation units, each with `observations` observations"""
+    template = mock_data.mock_observation_units[0]
+    page = []
+    for i in range(units):
+        obs_unit = dict(template, observationUnitDbId=str(i), observationUnitName="Plot " + str(i))
+        obs_unit['observations'] = [dict(template['observations'][j % 2], value=str(i * j / 7))
+                                    for j in range(observations)]
+        page.append(obs_unit)
+    return json.dumps(mock_data.mock_brapi_results(page, 1, units)).encode('utf-8')
+
+
+def response(body: bytes) -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r._content = body
+    r.encoding = None
+    return r
+
+
+def cpu_time(decode_page, body: bytes, repeat: int) -> float:
+    """Average CPU time in seconds of decode_page(response) on a fresh response"""
+    start = time.process_time()
+    for _ in range(repeat):
+        decode_page(response(body))
+    return (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--units', type=int, default=1000, help="observation units by page")
+    parser.add_argument('--observations', type=int, default=10, help="observations by observation unit")
+    parser.add_argument('--repeat', type=int, default=20, help="pages decoded by measure")
+    args = parser.parse_args()
+
+    body = observation_units_page(args.units, args.observations)
+    print("page of " + str(args.units) + " observation units: " + format(len(body) / 1024 / 1024, '.2f') + " MB")
+
+    def decode_twice(r):
+        r.json()['metadata']['pagination']
+        return r.json()['result']['data']
+    baseline = cpu_time(decode_twice, body, args.repeat)
+    print(format("r.json() twice", '<22') + format(baseline * 1000, '8.1f') + " ms/page")
+
+    for name in BACKENDS:
+        try:
+            _, loads = get_json_loads(name)
+        except ImportError:
+            print(format(name, '<22') + "     not installed")
+            continue
+        decode_once = cpu_time(lambda r: decode_response(r, loads)['result']['data'], body, args.repeat)
+        print(format("decoded once, " + name, '<22') + format(decode_once * 1000, '8.1f') + " ms/page" +
+              "  (" + format((baseline - decode_once) * 1000, '.1f') + " ms saved, x" +
+              format(baseline / decode_once, '.1f') + ")")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Memory held by the observation units of a study, as parsed JSON dicts or as compact records
+
+Observation units are generated as a server would send them (with fields the conversion does not read), parsed
+one by one from JSON and kept in a list, like ObservationUnitStore does for the studies it holds in memory.
+
+Usage: python benchmarks/bench_obs_unit_memory.py [--observations 1000000] [--observations-by-unit 10]
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compact_records import compact_observation_unit  # noqa: E402
+
+
+def observation_unit_json(i: int, observations: int) -> str:
+    """JSON of a BrAPI v1 observation unit of a plant level study"""
+    return json.dumps({
+        "observationUnitDbId": "ou-" + str(i), "observationUnitName": "Plant " + str(i),
+        "observationUnitXref": [{"source": "biosamples", "id": "SAMEA" + str(i)}],
+        "germplasmDbId": "g-" + str(i % 500), "germplasmName": "Germplasm " + str(i % 500),
+        "studyDbId": "1", "studyName": "Study 1", "studyLocationDbId": "1", "studyLocation": "Montpellier",
+        "programName": "Breeding program", "entryType": "test", "entryNumber": str(i % 500),
+        "X": str(i % 100), "Y": str(i // 100), "blockNumber": str(i % 10), "plotNumber": str(i // 10),
+        "plantNumber": str(i % 10), "replicate": "1", "observationLevel": "plant",
+        "observationLevels": "block:" + str(i % 10) + ",plot:" + str(i // 10),
+        "treatments": [{"factor": "watering", "modality": "WW"}],
+        "observations": [{
+            "observationDbId": str(i * observations + j), "observationVariableDbId": "v" + str(j),
+            "observationVariableName": "Variable " + str(j), "collector": "A. Technician",
+            "observationTimeStamp": "2019-06-14T22:0" + str(j % 10) + ":51Z", "season": "2019",
+            "value": str((i * j) % 97 / 7)
+        } for j in range(observations)]
+    })
+
+
+def _held_memory(units: int, observations: int, compact: bool) -> int:
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    held = []
+    for i in range(units):
+        obs_unit = json.loads(observation_unit_json(i, observations))
+        held.append(compact_observation_unit(obs_unit) if compact else obs_unit)
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+
+def held_memory(units: int, observations: int, compact: bool) -> int:
+    """Growth in bytes of the resident memory of a fresh process holding a list of parsed observation units"""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_held_memory, units, observations, compact).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--observations', type=int, default=1000000, help="total number of observations")
+    parser.add_argument('--observations-by-unit', type=int, default=10, help="observations by observation unit")
+    args = parser.parse_args()
+
+    units = args.observations // args.observations_by_unit
+    print(str(units) + " observation units, " + str(units * args.observations_by_unit) + " observations")
+    parsed = held_memory(units, args.observations_by_unit, compact=False)
+    print(format("parsed JSON dicts", '<20') + format(parsed / 1024 / 1024, '9.1f') + " MB RSS")
+    compact = held_memory(units, args.observations_by_unit, compact=True)
+    print(format("compact records", '<20') + format(compact / 1024 / 1024, '9.1f') + " MB RSS  (x" +
+          format(parsed / compact, '.1f') + " smaller)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Peak memory of fetching one page of BrAPI observation units, decoded whole or streamed
+
+The page is served by requests_mock, peak memory is measured with tracemalloc while fetch_objects iterates the page
+and drops every object (as a consumer writing rows to a file would).
+
+Usage: python benchmarks/bench_page_memory.py [--units 1000] [--observations 50]
+"""
+import argparse
+import logging
+import os
+import sys
+import tracemalloc
+
+import requests_mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_json_decode import observation_units_page  # noqa: E402
+from brapi_client import BrapiClient, iter_result_data  # noqa: E402
+from page_size_controller import PageSizeController  # noqa: E402
+
+logger = logging.getLogger()
+
+
+def peak_memory(body: bytes, units: int, stream_pages: bool) -> int:
+    """Peak memory in bytes allocated while iterating the objects of a page"""
+    with requests_mock.Mocker() as mock_requests:
+        mock_requests.get(requests_mock.ANY, content=body)
+        client = BrapiClient('http://brapi/', logger, stream_pages=stream_pages,
+                             page_size_controller=PageSizeController(logger, initial=units))
+        # the page body is built before tracing starts: the copies made to receive it are measured
+        tracemalloc.start()
+        count = sum(1 for _ in client.fetch_objects('GET', '/studies/1/observationunits'))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert count == units
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--units', type=int, default=1000, help="observation units by page")
+    parser.add_argument('--observations', type=int, default=50, help="observations by observation unit")
+    args = parser.parse_args()
+
+    body = observation_units_page(args.units, args.observations)
+    print("page of " + str(args.units) + " observation units: " + format(len(body) / 1024 / 1024, '.2f') + " MB")
+    whole = peak_memory(body, args.units, stream_pages=False)
+    print(format("decoded whole", '<16') + format(whole / 1024 / 1024, '8.2f') + " MB peak")
+    if iter_result_data is None:
+        print(format("streamed", '<16') + "     ijson is not installed")
+        return
+    streamed = peak_memory(body, args.units, stream_pages=True)
+    print(format("streamed", '<16') + format(streamed / 1024 / 1024, '8.2f') + " MB peak")
+
+
+if __name__ == '__main__':
+    main()
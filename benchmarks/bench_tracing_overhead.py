@@ -0,0 +1,53 @@
+"""
+Cost of a tracing span, with tracing disabled and enabled, compared to the same loop without span
+
+Usage: python benchmarks/bench_tracing_overhead.py [--iterations 1000000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tracing  # noqa: E402
+from tracing import span  # noqa: E402
+
+
+def bare(iterations: int):
+    for page in range(iterations):
+        pass
+
+
+def spans(iterations: int):
+    for page in range(iterations):
+        with span('GET /studies/{id}/observationunits', 'http', page=page):
+            pass
+
+
+def seconds(run, iterations: int, repeat: int = 3) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(iterations)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=1000000, help="spans by measure")
+    args = parser.parse_args()
+
+    baseline = seconds(bare, args.iterations)
+    tracing.disable()
+    disabled = seconds(spans, args.iterations)
+    tracing.enable()
+    enabled = seconds(spans, args.iterations)
+    tracing.disable()
+    for name, total in (("tracing disabled", disabled), ("tracing enabled", enabled)):
+        print(format(name, '<18') + format((total - baseline) / args.iterations * 1e9, '10.0f') + " ns/span")
+
+
+if __name__ == '__main__':
+    main()
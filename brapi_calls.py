@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import List
+
+from atomic_file import atomic_write
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'brapi_to_isa')
+
+
+class BrapiCalls:
+    """ Calls supported by a BrAPI endpoint, as listed by its /calls call
+    """
+
+    def __init__(self, calls: List[dict]):
+        self.calls = {el['call']: el for el in calls}
+
+    def __len__(self):
+        return len(self.calls)
+
+    def supports(self, call: str, method: str = None) -> bool:
+        """
+        Tell if the endpoint supports a call
+        :param call call as listed by /calls (ex 'studies/{studyDbId}/observationUnits', 'germplasm-search')
+        :param method if provided, the HTTP method the call must support (ex 'POST')
+        """
+        if call not in self.calls:
+            return False
+        return method is None or method in (self.calls[call].get('methods') or [])
+
+
+# (calls, time they were fetched) by endpoint
+_calls_by_endpoint = {}
+# one lock by endpoint, so that discovering the calls of an endpoint never waits for another endpoint
+_endpoint_locks = {}
+_calls_lock = threading.Lock()
+
+
+def _endpoint_lock(endpoint: str) -> threading.Lock:
+    with _calls_lock:
+        return _endpoint_locks.setdefault(endpoint, threading.Lock())
+
+
+def get_brapi_calls(client, cache_dir: str = None, ttl: float = 86400) -> BrapiCalls:
+    """
+    Return the calls supported by the endpoint of a BrapiClient
+
+    /calls is fetched (with pagination) once by endpoint and process, and shared by every client of that endpoint
+    for ttl seconds. If cache_dir is provided, the result is also persisted there and reused by later runs for ttl
+    seconds after it was fetched.
+    """
+    calls = _shared_calls(client.endpoint, ttl)
+    if calls is not None:
+        return calls
+    with _endpoint_lock(client.endpoint):
+        calls = known_brapi_calls(client.endpoint, cache_dir, ttl, client.logger)
+        if calls is None:
+            client.logger.debug("Discovering calls of " + client.endpoint)
+            calls = register_brapi_calls(client.endpoint, list(client.fetch_objects('GET', '/calls')), cache_dir,
+                                         client.logger)
+        return calls
+
+
+def known_brapi_calls(endpoint: str, cache_dir: str, ttl: float, logger: logging.Logger):
+    """
+    Return the calls of an endpoint discovered by this process or persisted in cache_dir less than ttl seconds ago,
+    None if unknown
+    """
+    calls = _shared_calls(endpoint, ttl)
+    if calls is None:
+        cached = _load_cached_calls(endpoint, cache_dir, ttl, logger)
+        if cached is not None:
+            calls = _share_calls(endpoint, *cached)
+    return calls
+
+
+def register_brapi_calls(endpoint: str, calls: List[dict], cache_dir: str, logger: logging.Logger) -> BrapiCalls:
+    """Share the calls fetched from an endpoint with the other clients, and persist them if cache_dir is provided"""
+    fetched = time.time()
+    _save_cached_calls(endpoint, calls, fetched, cache_dir, logger)
+    return _share_calls(endpoint, calls, fetched)
+
+
+def _shared_calls(endpoint: str, ttl: float):
+    entry = _calls_by_endpoint.get(endpoint)
+    if entry is None or time.time() - entry[1] > ttl:
+        return None
+    return entry[0]
+
+
+def _share_calls(endpoint: str, calls: List[dict], fetched: float) -> BrapiCalls:
+    with _calls_lock:
+        entry = _calls_by_endpoint.get(endpoint)
+        # calls fetched later and registered meanwhile by another client are kept
+        if entry is None or entry[1] < fetched:
+            entry = _calls_by_endpoint[endpoint] = (BrapiCalls(calls), fetched)
+        return entry[0]
+
+
+def _cache_file(endpoint: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, 'calls_' + hashlib.sha1(endpoint.encode('utf-8')).hexdigest() + '.json')
+
+
+def _load_cached_calls(endpoint: str, cache_dir: str, ttl: float, logger: logging.Logger):
+    if not cache_dir:
+        return None
+    try:
+        with open(_cache_file(endpoint, cache_dir), 'r', encoding='utf-8') as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if cached.get('endpoint') != endpoint or time.time() - cached.get('fetched', 0) > ttl:
+        return None
+    logger.debug("Using calls of " + endpoint + " cached in " + cache_dir)
+    return cached['calls'], cached['fetched']
+
+
+def _save_cached_calls(endpoint: str, calls: List[dict], fetched: float, cache_dir: str, logger: logging.Logger):
+    if not cache_dir:
+        return
+    try:
+        # concurrent runs never read a partial file
+        atomic_write(_cache_file(endpoint, cache_dir),
+                     json.dumps({'endpoint': endpoint, 'fetched': fetched, 'calls': calls}))
+    except OSError as oserror:
+        logger.warning("Could not cache calls of " + endpoint + ": " + str(oserror))
@@ -1,9 +1,27 @@
-import json
 import logging
-from collections import Iterable
+import time
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from brapi_calls import BrapiCalls, get_brapi_calls
+from json_backend import decode_response, get_json_loads
+from page_size_controller import PageSizeController, Paging
+from response_cache import ResponseCache
+from retry_policy import RETRY_STATUSES, RetryPolicy, parse_retry_after
+from run_metrics import RunMetrics
+from tracing import span, tracer
+
+try:
+    from streaming_json import JSONError, ResponseStream, iter_result_data
+except ImportError:
+    # ijson is not installed: pages can not be streamed
+    iter_result_data = None
 
 
 def url_path_join(*args):
@@ -11,16 +29,116 @@ def url_path_join(*args):
     return '/'.join(s.strip('/') for s in args)
 
 
+def route_template(path: str) -> str:
+    """BrAPI route of a URL path, identifiers replaced by {id} (ex '/studies/12/germplasm' -> '/studies/{id}/germplasm')"""
+    segments = path.strip('/').split('/')
+    return '/' + '/'.join('{id}' if i % 2 == 1 else segment for i, segment in enumerate(segments))
+
+
+def create_session(pool_size: int = 10, keep_alive: bool = True, headers: dict = None) -> requests.Session:
+    """
+    Create a HTTP session holding a pool of keep-alive connections
+    :param pool_size maximum number of connections kept open by host
+    :param keep_alive if False, connections are closed after each request
+    :param headers default headers sent with every request
+    :return a requests.Session to share between BrapiClient instances
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept'] = 'application/json'
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def map_concurrently(function, items: Iterable, workers: int) -> Iterable:
+    """
+    Apply function to every item on a thread pool, yielding the results in the order of the items
+    No more than `workers` results are computed ahead of the consumer.
+    """
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # consumer stopped early or a call failed: do not run the remaining calls
+            for future in pending:
+                future.cancel()
+
+
 class BrapiClient:
     """ Provide methods to the BRAPI
     """
 
-    def __init__(self, endpoint: str, logger: logging.Logger):
+    def __init__(self, endpoint: str, logger: logging.Logger, session: requests.Session = None,
+                 timeout: float = 300, prefetch_pages: int = 0, lookup_workers: int = 8,
+                 calls_cache_dir: str = None, calls_cache_ttl: float = 86400, response_cache: ResponseCache = None,
+                 page_size_controller: PageSizeController = None, retry_policy: RetryPolicy = None,
+                 json_backend: str = None, stream_pages: bool = False, metrics: RunMetrics = None,
+                 **session_options):
+        """
+        :param endpoint BrAPI server endpoint
+        :param logger logger used to trace the requests
+        :param session HTTP session to use, a pooled session is created (see create_session) if not provided
+        :param timeout timeout in seconds (or (connect, read) tuple) of every request
+        :param prefetch_pages number of pages fetched concurrently by fetch_objects (0 to disable)
+        :param lookup_workers number of single objects (ex: germplasm details) fetched concurrently
+        :param calls_cache_dir directory where the result of /calls is persisted (None to keep it in memory only)
+        :param calls_cache_ttl time in seconds after which the persisted result of /calls is discovered again
+        :param response_cache on-disk cache of GET responses, revalidated with the server on every request
+        :param page_size_controller controller tuning the page size of paginated calls (one is created if not provided,
+                                    not adaptive if response_cache is provided, see ResponseCache.key)
+        :param retry_policy policy retrying failed requests (one is created if not provided)
+        :param json_backend JSON library decoding the responses (see json_backend.BACKENDS), the fastest installed
+                            one if not provided
+        :param stream_pages if True, the objects of the pages fetched one after another are parsed and yielded as the
+                            response body is received, instead of once the whole page is decoded (requires ijson,
+                            GET pages are only streamed without response_cache)
+        :param metrics if provided, every request is recorded there, by route template (see run_metrics)
+        :param session_options options given to create_session when no session is provided
+        """
         self.endpoint = endpoint
         self.logger = logger
+        self.session = session or create_session(**session_options)
+        self.timeout = timeout
+        self.prefetch_pages = prefetch_pages
+        self.lookup_workers = lookup_workers
+        self.calls_cache_dir = calls_cache_dir
+        self.calls_cache_ttl = calls_cache_ttl
+        self.response_cache = response_cache
+        # cached pages are only found again when asked with the same page size
+        self.page_size_controller = page_size_controller or PageSizeController(logger, adaptive=response_cache is None)
+        self.retry_policy = retry_policy or RetryPolicy(logger)
+        self.json_backend, self.json_loads = get_json_loads(json_backend)
+        if stream_pages and iter_result_data is None:
+            logger.warning("ijson is not installed, pages will not be streamed")
+        self.stream_pages = stream_pages and iter_result_data is not None
+        self.metrics = metrics
+        self._endpoint_path = urlparse(endpoint).path.rstrip('/')
+        self._calls = None
         self.obs_unit_call = " "
         self.obs_var_call = " "
 
+    def close(self):
+        """Close the connections held by the HTTP session"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def get_phenotypes(self) -> Iterable:
         """Returns a phenotype information from a BrAPI endpoint."""
         yield from self.fetch_objects('GET', '/phenotype-search')
@@ -37,17 +155,20 @@ class BrapiClient:
         """"Given a BRAPI study identifier returns an array of germplasm objects"""
         yield from self.fetch_objects('GET', f'/studies/{study_id}/germplasm')
 
+    def get_calls(self) -> BrapiCalls:
+        """Return the calls supported by the endpoint (discovered once, see brapi_calls.get_brapi_calls)"""
+        if self._calls is None:
+            self._calls = get_brapi_calls(self, self.calls_cache_dir, self.calls_cache_ttl)
+        return self._calls
+
     def _get_obs_unit_call(self) -> str:
         """Choose which BrAPI call to use in order to fetch observation unit by study"""
         if self.obs_unit_call == " ":
-            r = requests.get(self.endpoint + "calls?pageSize=100")
-            if r.status_code != requests.codes.ok:
-                self.logger.debug("\n\nERROR in get_obs_units_in_study " + str(r.status_code) + str(r.json()))
-                raise RuntimeError("Non-200 status code")
-            elif r.json()['metadata']['pagination']['totalCount'] == 0:
+            calls = self.get_calls()
+            if len(calls) == 0:
                 self.logger.debug(" EMPTY CALLS Call, assume OBSERVATIONUNIT THE 1.1 WAY")
                 self.obs_unit_call = "observationUnits"
-            elif any(el['call'] == 'studies/{studyDbId}/observationUnits' for el in r.json()['result']['data']):
+            elif calls.supports('studies/{studyDbId}/observationUnits'):
                 self.logger.debug(" GOT OBSERVATIONUNIT THE 1.1 WAY")
                 self.obs_unit_call = "observationUnits"
             else:
@@ -58,14 +179,11 @@ class BrapiClient:
     def _get_obs_var_call(self) -> str:
         """Choose which BrAPI call to use in order to fetch observation variables by study"""
         if self.obs_var_call == " ":
-            r = requests.get(self.endpoint + "calls?pageSize=100")
-            if r.status_code != requests.codes.ok:
-                self.logger.debug("\n\nERROR in get_obs_var_in_study " + r.status_code + r.json())
-                raise RuntimeError("Non-200 status code")
-            elif r.json()['metadata']['pagination']['totalCount'] == 0:
+            calls = self.get_calls()
+            if len(calls) == 0:
                 self.logger.debug(" EMPTY CALLS Call, assume OBSERVATIONVARIABLE THE 1.0 WAY")
                 self.obs_var_call = "observationVariables"
-            elif any(el['call'] == 'studies/{studyDbId}/observationVariables' for el in r.json()['result']['data']):
+            elif calls.supports('studies/{studyDbId}/observationVariables'):
                 self.logger.debug(" GOT OBSERVATIONVARIABLE THE 1.0 WAY")
                 self.obs_var_call = "observationVariables"
             else:
@@ -100,6 +218,34 @@ class BrapiClient:
         """ Given a BRAPI germplasm identifiers, return an list of BRAPI germplasm attributes"""
         return self.fetch_object(f'/germplasm/{germplasm_id}')
 
+    def get_germplasms_by_ids(self, germplasm_ids: List[str]) -> Iterable:
+        """
+        Given a list of BRAPI germplasm identifiers, return the BRAPI germplasm attributes in the same order
+        Germplasms are searched by batch when the endpoint supports POST germplasm-search, otherwise up to
+        lookup_workers germplasms are fetched concurrently.
+        """
+        if self.get_calls().supports('germplasm-search', 'POST'):
+            yield from self._search_germplasms_by_ids(germplasm_ids)
+        elif self.lookup_workers > 1:
+            yield from map_concurrently(self.get_germplasm, germplasm_ids, self.lookup_workers)
+        else:
+            for germplasm_id in germplasm_ids:
+                yield self.get_germplasm(germplasm_id)
+
+    def _search_germplasms_by_ids(self, germplasm_ids: List[str], batch_size: int = 1000) -> Iterable:
+        """Search germplasm details by batch of ids with germplasm-search, returned in the order of the ids"""
+        for start in range(0, len(germplasm_ids), batch_size):
+            batch = germplasm_ids[start:start + batch_size]
+            found = {}
+            for germplasm in self.fetch_objects('POST', '/germplasm-search', data={'germplasmDbIds': list(set(batch))}):
+                found[germplasm['germplasmDbId']] = germplasm
+            for germplasm_id in batch:
+                if germplasm_id in found:
+                    yield found[germplasm_id]
+                else:
+                    # not returned by the search, fallback to the single germplasm call
+                    yield self.get_germplasm(germplasm_id)
+
     def get_study_observed_variables(self, study_id: str) -> Iterable:
         """" Given a BRAPI study identifier, returns a list of BRAPI observation Variables objects """
         observation_var_call = self._get_obs_var_call()
@@ -110,11 +256,11 @@ class BrapiClient:
         Return trials found in a given BRAPI endpoint server
         :param trial_ids if provided, this list of trial ids with restrict the list of fetched trials
         :return iterable of BrAPI trials (pared from JSON as python dict)
+        :raise ValueError when no trial ids are given
         """
         if not trial_ids:
-            self.logger.info("Not enough parameters, provide TRIAL or STUDY IDs")
-            exit (1)
-        elif trial_ids == ["all"]:
+            raise ValueError("Not enough parameters, provide TRIAL or STUDY IDs")
+        if trial_ids == ["all"]:
             self.logger.info("Return all trials")
             yield from self.fetch_objects('GET', '/trials')
         else:
@@ -130,65 +276,217 @@ class BrapiClient:
         """
         url = url_path_join(self.endpoint, path)
         self.logger.debug('GET ' + url)
-        r = requests.get(url)
+        r = self._send(url, lambda: self._get(url))
         if r.status_code != requests.codes.ok:
             logging.error("problem with request: " + str(r))
             raise RuntimeError("Non-200 status code")
-        return r.json()["result"]
+        return decode_response(r, self.json_loads)["result"]
 
-    def fetch_objects(self, method: str, path: str, params: dict=None, data: dict=None) -> Iterable:
+    def fetch_objects(self, method: str, path: str, params: dict=None, data: dict=None,
+                      prefetch_pages: int=None) -> Iterable:
         """
         Fetch BrAPI objects with pagination
         :param method HTTP method of the BrAPI call (GET, POST, PUT)
         :param path URL path of the BrAPI call (ex '/studies', '/germplasm-search', ...)
         :param params dict containing the query params for the BrAPI call
         :param data dict containing the request body (used for 'POST' calls)
+        :param prefetch_pages number of pages fetched concurrently once the page count is known
+                              (defaults to the client prefetch_pages, 0 to fetch pages one after another)
         :return iterable of BrAPI objects parsed from JSON to python dict
         """
-        page = 0
-        pagesize = 1000
-        maxcount = None
+        if prefetch_pages is None:
+            prefetch_pages = self.prefetch_pages
         # set a default dict for parameters
         params = params or {}
         url = url_path_join(self.endpoint, path)
-        while maxcount is None or page < maxcount:
-            params['page'] = page
-            params['pageSize'] = pagesize
-            self.logger.debug('retrieving page ' + str(page)+ ' of '+ str(maxcount)+ ' from '+ str(url))
+        paging = Paging(self.page_size_controller, urlparse(url).netloc, route_template(path))
+        stream = self.stream_pages and (method != 'GET' or self.response_cache is None)
+        attempt = 0
+        while paging.has_next():
+            paging.params(params)
+            self.logger.debug('retrieving page ' + str(paging.page) + ' of ' + str(paging.page_count) + ' from ' +
+                              str(url))
             self.logger.info("paging params:" + str(params))
 
-            if method == 'GET':
-                self.logger.debug("GETting " + url)
-                r = requests.get(url, params=params, data=data)
-            elif method == 'PUT':
-                self.logger.debug("PUTting "+  url)
-                r = requests.put(url, params=params, data=data)
-            elif method == 'POST':
-                # params['User-Agent'] = "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)
-                # Chrome/41.0.2272.101 Safari/537.36"
-                params['Accept'] = "application/json"
-                params['Content-Type'] = "application/json"
-                self.logger.debug("POSTing " + url)
-                self.logger.debug("POSTing " + str(params) + str(data))
-                headers = {}
-                r = requests.post(url, params=json.dumps(params).encode('utf-8'), json=data,
-                                  headers=headers)
-                self.logger.debug(r)
-            else:
-                raise RuntimeError(f"Unknown method: {method}")
-            if r.status_code == 504 and pagesize != 100:
-                pagesize = 100
-                self.logger.info("504 Gateway Timeout Error, testing with pagesize = 100") 
+            start = time.monotonic()
+            try:
+                r = self._request_page(method, url, params, data, stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if isinstance(error, requests.exceptions.ReadTimeout) and paging.shrink():
+                    self.logger.info("Timeout, testing with pagesize = " + str(paging.page_size))
+                    continue
+                if not self._backoff(url, attempt, error=error, method=method):
+                    raise
+                # resume at the failed page, the objects of the previous pages are already yielded
+                attempt += 1
                 continue
-            elif r.status_code != requests.codes.ok:
+            latency = time.monotonic() - start
+            if stream and r.status_code != requests.codes.ok:
+                # release the connection without reading the error body
+                r.close()
+            if r.status_code == 504:
+                if paging.shrink():
+                    self.logger.info("504 Gateway Timeout Error, testing with pagesize = " + str(paging.page_size))
+                    continue
+            elif r.status_code >= 500:
+                # not caused by the page size: the same page is retried, but the controller learns of the error
+                paging.record_failure()
+            if r.status_code in RETRY_STATUSES and self._backoff(url, attempt, response=r, method=method):
+                attempt += 1
+                continue
+            if r.status_code != requests.codes.ok:
                 self.logger.error("problem with request: " + str(r))
                 raise RuntimeError("Non-200 status code")
-            maxcount = int(r.json()['metadata']['pagination']['totalPages'])
-            # TODO: remove, hack to adress GnpIS bug, to be fixed in production by January 2019
-            if '/observationUnits' in url:
-                page = 1000
+            if stream:
+                pagination = {}
+                page_stream = ResponseStream(r)
+                index = None
+                try:
+                    for obj in iter_result_data(page_stream, pagination):
+                        if index is None:
+                            # BrAPI responses give the pagination before the objects
+                            index = paging.first_index(pagination)
+                        # skip the objects already yielded before a retry of the page
+                        if paging.is_new(index):
+                            yield obj
+                        index += 1
+                except (requests.exceptions.RequestException, JSONError) as error:
+                    if not self._backoff(url, attempt, error=error, method=method):
+                        raise
+                    attempt += 1
+                    continue
+                finally:
+                    r.close()
+                    if self.metrics is not None:
+                        self.metrics.record_bytes(method, paging.route, page_stream.bytes_read)
+                page_bytes = page_stream.bytes_read
+            else:
+                # the body is decoded once, for both its pagination and its objects
+                with span('decode', 'json', page=paging.page) as decode_span:
+                    body = decode_response(r, self.json_loads)
+                    decode_span.set(objects=len(body['result']['data']))
+                pagination = body['metadata']['pagination']
+                for index, obj in enumerate(body['result']['data'], paging.first_index(pagination)):
+                    if paging.is_new(index):
+                        yield obj
+                page_bytes = len(r.content)
+            attempt = 0
+            next_page_size = paging.next_page(pagination, latency, page_bytes)
+            if prefetch_pages > 0 and paging.has_next():
+                # page count is known: fetch the remaining pages concurrently
+                yield from self._fetch_pages_concurrently(method, url, paging.params(params), data, paging.page,
+                                                          paging.page_count, prefetch_pages)
+                return
+            paging.resize(next_page_size)
+
+    def _send(self, url: str, send, method: str = 'GET') -> requests.Response:
+        """Send a request with send(), retrying connection errors and transient failures (see RetryPolicy)"""
+        attempt = 0
+        while True:
+            try:
+                r = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if not self._backoff(url, attempt, error=error, method=method):
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUSES or not self._backoff(url, attempt, response=r, method=method):
+                    return r
+            attempt += 1
 
-            for data in r.json()['result']['data']:
-                yield data
+    def _backoff(self, url: str, attempt: int, response: requests.Response = None, error: Exception = None,
+                 method: str = 'GET') -> bool:
+        """Wait before retrying a failed request, return False if it must not be retried"""
+        retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+        delay = self.retry_policy.delay(urlparse(url).netloc, attempt, retry_after)
+        if delay is None:
+            return False
+        if self.metrics is not None:
+            self.metrics.record_retry(method, self._route(url))
+        failure = str(error) if error is not None else str(response.status_code) + " " + str(response.reason)
+        self.logger.warning("Request to " + url + " failed (" + failure + "), retry " + str(attempt + 1) +
+                            " in " + format(delay, '.1f') + "s")
+        time.sleep(delay)
+        return True
+
+    def _request_page(self, method: str, url: str, params: dict, data: dict, stream: bool = False) -> requests.Response:
+        """Send the HTTP request of one page of a paginated BrAPI call, without reading its body if stream is True"""
+        if method == 'GET':
+            self.logger.debug("GETting " + url)
+            r = self._get(url, params=params, data=data, stream=stream)
+        elif method == 'PUT':
+            self.logger.debug("PUTting "+  url)
+            r = self._http('PUT', url, lambda: self.session.put(url, params=params, data=data, timeout=self.timeout,
+                                                                stream=stream), stream, params)
+        elif method == 'POST':
+            # BrAPI v1 search calls take the pagination in the JSON body, along with the search parameters
+            body = dict(data or {}, **params)
+            self.logger.debug("POSTing " + url)
+            self.logger.debug("POSTing " + str(body))
+            r = self._http('POST', url, lambda: self.session.post(url, json=body, timeout=self.timeout,
+                                                                  stream=stream), stream, params)
+            self.logger.debug(r)
+        else:
+            raise RuntimeError(f"Unknown method: {method}")
+        return r
+
+    def _get(self, url: str, params: dict = None, data: dict = None, stream: bool = False) -> requests.Response:
+        """Send a GET request, revalidating the cached response when there is one"""
+        if self.response_cache is None or data is not None:
+            return self._http('GET', url, lambda: self.session.get(url, params=params, data=data,
+                                                                   timeout=self.timeout, stream=stream), stream, params)
+        key = self.response_cache.key(url, params)
+        entry = self.response_cache.get(key)
+        headers = self.response_cache.conditional_headers(entry) if entry else None
+        r = self._http('GET', url, lambda: self.session.get(url, params=params, headers=headers, timeout=self.timeout),
+                       params=params)
+        if entry and r.status_code == requests.codes.not_modified:
+            if self.metrics is not None:
+                self.metrics.record_cache_hit('GET', self._route(url))
+            return self.response_cache.hit(key, entry, r.url)
+        if r.status_code == requests.codes.ok:
+            self.response_cache.store(key, r)
+        return r
+
+    def _http(self, method: str, url: str, send, stream: bool = False, params: dict = None) -> requests.Response:
+        """Send a HTTP request with send(), recording it in the metrics if any, and tracing it if enabled"""
+        if self.metrics is None and tracer() is None:
+            return send()
+        route = self._route(url)
+        attributes = {'page': params['page'], 'page_size': params['pageSize']} if params and 'page' in params else {}
+        start = time.monotonic()
+        with span(method + ' ' + route, 'http', url=url, **attributes) as request_span:
+            try:
+                r = send()
+            except requests.exceptions.RequestException:
+                if self.metrics is not None:
+                    self.metrics.record_request(method, route, None, time.monotonic() - start)
+                raise
+            # the body of a streamed response is recorded once read
+            response_bytes = 0 if stream else len(r.content)
+            request_span.set(status=r.status_code, bytes=response_bytes)
+        if self.metrics is not None:
+            self.metrics.record_request(method, route, r.status_code, time.monotonic() - start, response_bytes)
+        return r
+
+    def _route(self, url: str) -> str:
+        """BrAPI route template of a URL of the endpoint"""
+        return route_template(urlparse(url).path[len(self._endpoint_path):])
+
+    def _fetch_pages_concurrently(self, method: str, url: str, params: dict, data: dict, first_page: int,
+                                  last_page: int, workers: int) -> Iterable:
+        """
+        Fetch pages [first_page, last_page[ of a paginated BrAPI call with at most `workers` requests in flight
+        Objects are yielded in page order and no more than `workers` pages are held ahead of the consumer.
+        """
+        def fetch_page(page):
+            page_params = dict(params, page=page)
+            self.logger.debug('prefetching page ' + str(page) + ' of ' + str(last_page) + ' from ' + str(url))
+            r = self._send(url, lambda: self._request_page(method, url, page_params, data), method)
+            if r.status_code != requests.codes.ok:
+                self.logger.error("problem with request: " + str(r))
+                raise RuntimeError("Non-200 status code")
+            return decode_response(r, self.json_loads)['result']['data']
 
-            page += 1
+        for page_objects in map_concurrently(fetch_page, range(first_page, last_page), workers):
+            for obj in page_objects:
+                yield obj
@@ -0,0 +1,274 @@
+import argparse
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+import mock_data
+import synthetic_data
+from brapi_client import route_template
+
+BASE_PATH = '/brapi/v1'
+
+# calls listed by /calls, germplasm-search is only listed when the server supports it
+CALLS = [
+    {"call": "calls", "methods": ["GET"]},
+    {"call": "trials", "methods": ["GET"]},
+    {"call": "trials/{trialDbId}", "methods": ["GET"]},
+    {"call": "studies/{studyDbId}", "methods": ["GET"]},
+    {"call": "studies/{studyDbId}/germplasm", "methods": ["GET"]},
+    {"call": "studies/{studyDbId}/observationunits", "methods": ["GET"]},
+    {"call": "studies/{studyDbId}/observationvariables", "methods": ["GET"]},
+    {"call": "germplasm/{germplasmDbId}", "methods": ["GET"]},
+]
+GERMPLASM_SEARCH_CALL = {"call": "germplasm-search", "methods": ["GET", "POST"]}
+
+
+class BrapiStubServer:
+    """ Local stand-in of a BrAPI v1 server, serving synthetic datasets (see synthetic_data) over HTTP
+
+    Trials, studies, germplasms, observation units and variables are generated on demand, page by page, so a study
+    of any size costs no memory. Latency, failures and page size caps can be set for all the routes or by route
+    template (as given by brapi_client.route_template, ex '/studies/{id}/observationunits'), to see how a client
+    behaves on a slow or unreliable network without leaving the machine.
+
+    Usage:
+        with BrapiStubServer(observation_units=10000, latency=0.05) as server:
+            client = BrapiClient(server.endpoint, logger)
+    """
+
+    def __init__(self, trials: int = 1, studies_by_trial: int = 1, germplasms: int = 100, variables: int = 20,
+                 observation_units: int = 1000, observations_by_unit: int = 10, max_page_size=None, latency=0.0,
+                 latency_by_object: float = 0.0, error_rates=0.0, error_status: int = 503, retry_after: int = None,
+                 timeout_page_size: int = None, germplasm_search: bool = True, seed: int = 0,
+                 host: str = '127.0.0.1', port: int = 0):
+        """
+        :param trials number of trials, with ids '1', '2', ...
+        :param studies_by_trial number of studies of each trial, with ids '<trial id>-1', '<trial id>-2', ...
+        :param germplasms number of germplasms of each study
+        :param variables number of observation variables of each study
+        :param observation_units number of observation units of each study
+        :param observations_by_unit number of observations of each observation unit
+        :param max_page_size largest page served (larger pageSize are capped), int or dict by route template
+        :param latency delay in seconds before every response, float or dict by route template
+        :param latency_by_object additional delay in seconds by object of a page, so bigger pages are slower
+        :param error_rates probability that a request fails with error_status, float or dict by route template
+        :param error_status HTTP status of the injected failures (ex 503, 500, 429)
+        :param retry_after if provided, Retry-After header (in seconds) of the injected failures
+        :param timeout_page_size pages larger than this fail with 504 Gateway Timeout, like a proxy giving up
+        :param germplasm_search if True, germplasm details can be searched by batch with POST /germplasm-search
+        :param seed seed of the random failures, so a run can be replayed
+        :param host address the server listens on
+        :param port port the server listens on (0 for a free port)
+        """
+        self.study_ids = {str(t): [str(t) + '-' + str(s) for s in range(1, studies_by_trial + 1)]
+                          for t in range(1, trials + 1)}
+        self.germplasms = germplasms
+        self.variables = variables
+        self.observation_units = observation_units
+        self.observations_by_unit = observations_by_unit
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.latency_by_object = latency_by_object
+        self.error_rates = error_rates
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.timeout_page_size = timeout_page_size
+        self.calls = CALLS + [GERMPLASM_SEARCH_CALL] if germplasm_search else list(CALLS)
+        self._obs_variables = synthetic_data.variables(variables)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # served requests and injected failures by route template
+        self.requests = Counter()
+        self.failures = Counter()
+        self._httpd = _HTTPServer((host, port), _RequestHandler)
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def endpoint(self) -> str:
+        """BrAPI endpoint of the server (ex 'http://127.0.0.1:40123/brapi/v1/')"""
+        host, port = self._httpd.server_address[:2]
+        return 'http://' + host + ':' + str(port) + BASE_PATH + '/'
+
+    def serve_forever(self):
+        """Serve requests until stop() is called from another thread"""
+        self._httpd.serve_forever()
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name='brapi-stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket"""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _route_setting(self, setting, route: str):
+        if isinstance(setting, dict):
+            return setting.get(route)
+        return setting
+
+    def respond(self, method: str, path: str, params: dict):
+        """
+        Return the (status, headers, body) of a request, after its latency
+        :param method HTTP method
+        :param path URL path of the request, under BASE_PATH
+        :param params query parameters, and the JSON body of POST requests
+        """
+        route = route_template(path)
+        with self._lock:
+            self.requests[route] += 1
+            error_rate = self._route_setting(self.error_rates, route) or 0.0
+            failed = error_rate > 0 and self._random.random() < error_rate
+            if failed:
+                self.failures[route] += 1
+        page = int(params.get('page', 0))
+        page_size = int(params.get('pageSize', 1000))
+        max_page_size = self._route_setting(self.max_page_size, route)
+        if max_page_size:
+            page_size = min(page_size, max_page_size)
+
+        time.sleep(self._route_setting(self.latency, route) or 0.0)
+        if failed:
+            headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else {}
+            return self.error_status, headers, {"metadata": {"status": [{"message": "injected failure"}]}}
+
+        segments = path.strip('/').split('/')
+        if segments == ['calls']:
+            return self._page(self.calls, len(self.calls), page, page_size)
+        if segments == ['trials']:
+            trials = [synthetic_data.trial(trial_id, study_ids) for trial_id, study_ids in self.study_ids.items()]
+            return self._page(trials, len(trials), page, page_size)
+        if segments == ['germplasm-search'] and method == 'POST' and GERMPLASM_SEARCH_CALL in self.calls:
+            germplasm_ids = [int(germplasm_id) for germplasm_id in params.get('germplasmDbIds') or []
+                             if str(germplasm_id).isdigit() and int(germplasm_id) < self.germplasms]
+            return self._generated_page(lambda i: synthetic_data.germplasm_details(germplasm_ids[i]),
+                                        len(germplasm_ids), page, page_size)
+        if len(segments) == 2 and segments[0] == 'trials' and segments[1] in self.study_ids:
+            return 200, {}, mock_data.mock_brapi_result(synthetic_data.trial(segments[1],
+                                                                             self.study_ids[segments[1]]))
+        if len(segments) == 2 and segments[0] == 'germplasm' and segments[1].isdigit() \
+                and int(segments[1]) < self.germplasms:
+            return 200, {}, mock_data.mock_brapi_result(synthetic_data.germplasm_details(int(segments[1])))
+        if len(segments) >= 2 and segments[0] == 'studies' and self._study_exists(segments[1]):
+            if len(segments) == 2:
+                return 200, {}, mock_data.mock_brapi_result(synthetic_data.study(segments[1]))
+            if segments[2:] == ['germplasm']:
+                return self._generated_page(synthetic_data.germplasm, self.germplasms, page, page_size)
+            if segments[2:] == ['observationvariables']:
+                return self._page(self._obs_variables, self.variables, page, page_size)
+            if segments[2:] == ['observationunits']:
+                return self._generated_page(
+                    lambda i: synthetic_data.observation_unit(i, self._obs_variables, self.germplasms,
+                                                              self.observations_by_unit),
+                    self.observation_units, page, page_size)
+        return 404, {}, {"metadata": {"status": [{"message": "not found: " + method + " " + path}]}}
+
+    def _study_exists(self, study_id: str) -> bool:
+        return any(study_id in study_ids for study_ids in self.study_ids.values())
+
+    def _page(self, objects: list, total_count: int, page: int, page_size: int):
+        """(status, headers, body) of a page of a list of objects"""
+        return self._generated_page(objects.__getitem__, total_count, page, page_size)
+
+    def _generated_page(self, generate, total_count: int, page: int, page_size: int):
+        """
+        (status, headers, body) of a page of a paginated call, failing with 504 if the page is too large
+        :param generate function returning the object of an index
+        """
+        if self.timeout_page_size and page_size > self.timeout_page_size:
+            return 504, {}, {"metadata": {"status": [{"message": "gateway timeout"}]}}
+        objects = [generate(i) for i in range(page * page_size, min((page + 1) * page_size, total_count))]
+        time.sleep(self.latency_by_object * len(objects))
+        total_pages = max(1, -(-total_count // page_size))
+        return 200, {}, mock_data.mock_brapi_results(objects, total_pages, total_count, page, page_size)
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive connections, like the pooled sessions of BrapiClient expect
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._handle(json.loads(self.rfile.read(length) or b'{}'))
+
+    def _handle(self, body_params: dict):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        params.update(body_params)
+        if not url.path.startswith(BASE_PATH + '/'):
+            status, headers, body = 404, {}, {"metadata": {"status": [{"message": "not a BrAPI v1 path"}]}}
+        else:
+            status, headers, body = self.server.stub.respond(self.command, url.path[len(BASE_PATH):], params)
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # requests are counted by the server, do not print them
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in BrAPI v1 server serving synthetic data")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--trials', type=int, default=1)
+    parser.add_argument('--studies-by-trial', type=int, default=1)
+    parser.add_argument('--germplasms', type=int, default=100)
+    parser.add_argument('--variables', type=int, default=20)
+    parser.add_argument('--observation-units', type=int, default=1000)
+    parser.add_argument('--observations-by-unit', type=int, default=10)
+    parser.add_argument('--max-page-size', type=int, help="largest page served")
+    parser.add_argument('--latency', type=float, default=0.0, help="delay in seconds before every response")
+    parser.add_argument('--latency-by-object', type=float, default=0.0,
+                        help="additional delay in seconds by object of a page")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability that a request fails")
+    parser.add_argument('--error-status', type=int, default=503, help="HTTP status of the injected failures")
+    parser.add_argument('--timeout-page-size', type=int, help="pages larger than this fail with 504")
+    parser.add_argument('--no-germplasm-search', action='store_true', help="do not support POST /germplasm-search")
+    args = parser.parse_args()
+
+    server = BrapiStubServer(args.trials, args.studies_by_trial, args.germplasms, args.variables,
+                             args.observation_units, args.observations_by_unit, args.max_page_size, args.latency,
+                             args.latency_by_object, args.error_rate, args.error_status,
+                             timeout_page_size=args.timeout_page_size,
+                             germplasm_search=not args.no_germplasm_search, port=args.port)
+    print("Serving " + server.endpoint)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
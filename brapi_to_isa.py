@@ -1,56 +1,184 @@
 import datetime
 import argparse
-import datetime
 import errno
+import importlib.util
 import logging
 import os
 import sys
 import json
+import threading
+from concurrent.futures import CancelledError, Future
 
-from isatools import isatab
-from isatools.model import Investigation, OntologyAnnotation, Characteristic, Source, \
-    Sample, Protocol, Process, StudyFactor, FactorValue, DataFile, ParameterValue, ProtocolParameter, plink, Person, Publication
-
+from brapi_calls import DEFAULT_CACHE_DIR
 from brapi_client import BrapiClient
 from brapi_to_isa_converter import BrapiToIsaConverter
+from compact_records import compact_observation_unit
+from response_cache import ResponseCache
+from observation_unit_store import ObservationUnitStore
+from json_backend import BACKENDS
+from page_size_controller import PageSizeController
+from retry_policy import RetryPolicy
+from run_journal import RunJournal
+from run_metrics import RunMetrics
+import tracing
+from tracing import span
+
+# Importing this module has no side effect: the command line is parsed and the log file is opened by main.
+# isatools, which takes seconds to import, pyarrow and the process pool are imported by the functions using them, so
+# that short-lived processes only pay for what they run (see benchmarks/bench_import_time.py).
+
+# columnar data files can be written when pyarrow is installed, see columnar_export
+COLUMNAR_FORMATS = ('parquet', 'arrow') if importlib.util.find_spec('pyarrow') is not None else ()
 
 __author__ = 'proccaserra (Philippe Rocca-Serra)'
 
 log_file = "brapilog.log"
-# logging.basicConfig(filename=log_file,
-#                     filemode='a',
-#                     level=logging.DEBUG)
+# size in bytes of the write buffer of each data file
+DATA_FILE_BUFFERING = 1024 * 1024
 logger = logging.getLogger('brapi_converter')
-logger.debug('This message should go to the log file')
-logger.info('Starting now...')
-logger.warning('And this, too')
-#logger.setLevel(logging.INFO)
-logger.setLevel(logging.DEBUG)
-
-file4log = logging.FileHandler(log_file)
-file4log.setLevel(logging.INFO)
 
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file4log.setFormatter(formatter)
-logger.addHandler(file4log)
 
-parser = argparse.ArgumentParser()
+def configure_logging():
+    """Log the conversion to log_file, once by process"""
+    # logging.basicConfig(filename=log_file,
+    #                     filemode='a',
+    #                     level=logging.DEBUG)
+    if any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
+        return
+    #logger.setLevel(logging.INFO)
+    logger.setLevel(logging.DEBUG)
+
+    file4log = logging.FileHandler(log_file)
+    file4log.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file4log.setFormatter(formatter)
+    logger.addHandler(file4log)
+
+
+DEFAULT_SERVER = 'https://test-server.brapi.org/brapi/v1/'
+DEFAULT_OUTPUT_DIR = "outputdir"
+
+
+class ConversionSettings:
+    """ Settings of a conversion, see convert
+
+    Settings are given to the functions of the conversion rather than held by the module, so that conversions with
+    different settings can run in the same process, and are sent to the worker processes of the conversion.
+    """
+
+    def __init__(self, endpoint: str, trial_ids: list = None, study_ids: list = None,
+                 output_dir: str = DEFAULT_OUTPUT_DIR, resume: bool = False, obs_units_in_memory: int = 50000,
+                 pool_size: int = 10, timeout: float = 300, retries: int = 5, error_budget: int = 100,
+                 json_backend: str = None, cache_dir: str = DEFAULT_CACHE_DIR, calls_ttl: float = 86400,
+                 response_cache_size: int = 0, workers: int = 1, germplasm_workers: int = 8, page_size: int = 1000,
+                 stream_pages: bool = False, columnar: str = None, row_group_size: int = 65536,
+                 metrics_report: str = None, prometheus_textfile: str = None, trace: str = None,
+                 prefetch_pages: int = 0):
+        """
+        :param endpoint BrAPI server endpoint
+        :param trial_ids ids of the trials to convert, ['all'] for all the trials of the endpoint (not recommended)
+        :param study_ids ids of the studies whose trials are converted, when no trial_ids are given
+        :param output_dir directory where every trial is written, in a directory named after it
+        :param resume skip the studies and trials completed by the previous run, as recorded in the run journal of
+                      output_dir
+        :param obs_units_in_memory number of observation units kept in memory for a study before spooling them to a
+                                   temporary file
+        :param pool_size number of keep-alive HTTP connections kept open to the endpoint
+        :param timeout timeout in seconds of every HTTP request
+        :param retries number of retries of a failed HTTP request, with exponential backoff
+        :param error_budget number of failed HTTP requests retried by endpoint before giving up
+        :param json_backend JSON library decoding the BrAPI responses (see json_backend.BACKENDS), the fastest
+                            installed one if not provided
+        :param cache_dir directory where endpoint capabilities and learned page sizes are cached between runs
+                         ('' to disable)
+        :param calls_ttl time in seconds the cached endpoint capabilities stay valid
+        :param response_cache_size size in MB of the on-disk cache of BrAPI responses (0 to disable)
+        :param workers number of processes converting studies and trials in parallel
+        :param germplasm_workers number of germplasm details fetched concurrently
+        :param page_size initial page size of paginated calls, then adapted to the endpoint response times (only
+                         made smaller after failures when response_cache_size is set, so cached pages are asked again)
+        :param stream_pages parse the objects of result pages as they are received (requires ijson)
+        :param columnar also write the data files in this columnar format, see COLUMNAR_FORMATS (requires pyarrow)
+        :param row_group_size number of rows by row group of the columnar data files
+        :param metrics_report JSON file where the run metrics are written, metrics.json in output_dir by default
+                              ('' to disable)
+        :param prometheus_textfile also write the run metrics to this file, in the Prometheus text format
+        :param trace write a trace of the conversion to this file, in the Chrome trace-event JSON format
+        :param prefetch_pages number of result pages downloaded concurrently for paginated calls
+        """
+        self.endpoint = endpoint
+        self.trial_ids = trial_ids
+        self.study_ids = study_ids
+        self.output_dir = output_dir
+        self.resume = resume
+        self.obs_units_in_memory = obs_units_in_memory
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.error_budget = error_budget
+        self.json_backend = json_backend
+        self.cache_dir = cache_dir
+        self.calls_ttl = calls_ttl
+        self.response_cache_size = response_cache_size
+        self.workers = workers
+        self.germplasm_workers = germplasm_workers
+        self.page_size = page_size
+        self.stream_pages = stream_pages
+        self.columnar = columnar
+        self.row_group_size = row_group_size
+        self.metrics_report = os.path.join(output_dir, "metrics.json") if metrics_report is None else metrics_report
+        self.prometheus_textfile = prometheus_textfile
+        self.trace = trace
+        self.prefetch_pages = prefetch_pages
+
+    @property
+    def journal_dir(self) -> str:
+        """Directory of the run journal"""
+        return os.path.join(self.output_dir, ".journal")
+
+
+# command line of main, whose defaults are those of ConversionSettings
+parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
 parser.add_argument('-e', '--endpoint', help="a BrAPi server endpoint", type=str)
-parser.add_argument('-t', '--trials', help="comma separated list of trial Ids. 'all' to get all trials (not recomended)", type=str, action='append')
-parser.add_argument('-s', '--studies', help="comma separated list of study Ids", type=str, action='append')
-SERVER = 'https://test-server.brapi.org/brapi/v1/'
-
-logger.debug('Argument List:' + str(sys.argv))
-args = parser.parse_args()
-TRIAL_IDS = args.trials
-STUDY_IDS = args.studies
-
-if args.endpoint:
-    SERVER = args.endpoint
-logger.info("\n----------------\ntrials IDs to be exported : "
-            + str(TRIAL_IDS) + "\nstudy IDs to be exported : "
-            + str(STUDY_IDS) + "\nTarget endpoint :  "
-            + str(SERVER) + "\n----------------" )
+parser.add_argument('-t', '--trials', help="comma separated list of trial Ids. 'all' to get all trials (not recomended)", type=str, action='append', dest='trial_ids')
+parser.add_argument('-s', '--studies', help="comma separated list of study Ids", type=str, action='append', dest='study_ids')
+parser.add_argument('-o', '--output-dir', help="directory where the trials are written (default: outputdir)", type=str)
+parser.add_argument('--resume', help="skip the studies and trials completed by the previous run, as recorded in the "
+                    "run journal of the output directory", action='store_true')
+parser.add_argument('--obs-units-in-memory', help="number of observation units kept in memory for a study before "
+                    "spooling them to a temporary file", type=int)
+parser.add_argument('--pool-size', help="number of keep-alive HTTP connections kept open to the endpoint", type=int)
+parser.add_argument('--timeout', help="timeout in seconds of every HTTP request", type=float)
+parser.add_argument('--retries', help="number of retries of a failed HTTP request, with exponential backoff",
+                    type=int)
+parser.add_argument('--error-budget', help="number of failed HTTP requests retried by endpoint before giving up",
+                    type=int)
+parser.add_argument('--json-backend', help="JSON library decoding the BrAPI responses (default: the fastest installed)",
+                    choices=list(BACKENDS))
+parser.add_argument('--cache-dir', help="directory where endpoint capabilities are cached between runs ('' to disable)",
+                    type=str)
+parser.add_argument('--calls-ttl', help="time in seconds the cached endpoint capabilities stay valid", type=float)
+parser.add_argument('--response-cache-size', help="size in MB of the on-disk cache of BrAPI responses, revalidated "
+                    "with ETag/Last-Modified (0 to disable)", type=int)
+parser.add_argument('--workers', help="number of processes converting studies and trials in parallel", type=int)
+parser.add_argument('--germplasm-workers', help="number of germplasm details fetched concurrently", type=int)
+parser.add_argument('--page-size', help="initial page size of paginated calls, then adapted to the endpoint response "
+                    "times (kept when --response-cache-size is set, so that cached pages are asked again)", type=int)
+parser.add_argument('--stream-pages', help="parse the objects of result pages as they are received, so that memory is "
+                    "bounded by one object rather than one page (requires ijson)", action='store_true')
+parser.add_argument('--columnar', help="also write the data files in a columnar format, typed from the scale data type "
+                    "of the variables (requires pyarrow)", choices=COLUMNAR_FORMATS)
+parser.add_argument('--row-group-size', help="number of rows by row group of the columnar data files", type=int)
+parser.add_argument('--metrics-report', help="JSON file where the request metrics and the wall time of the conversion "
+                    "stages are written at the end of the run (default: metrics.json in the output directory)",
+                    type=str)
+parser.add_argument('--prometheus-textfile', help="also write the run metrics to this file, in the Prometheus text "
+                    "format (ex for the textfile collector of the node exporter)", type=str)
+parser.add_argument('--trace', help="write a trace of the trials, studies, conversion stages and HTTP requests to "
+                    "this file, in the Chrome trace-event JSON format (to open with Perfetto)", type=str)
+parser.add_argument('--prefetch-pages', help="number of result pages downloaded concurrently for paginated calls "
+                    "(0 to download them one after another)", type=int)
 
 # SERVER = 'https://urgi.versailles.inra.fr/gnpis-core-srv/brapi/v1/'
 # SERVER = 'https://www.eu-sol.wur.nl/webapi/tomato/brapi/v1/'
@@ -179,7 +307,9 @@ logger.info("\n----------------\ntrials IDs to be exported : "
 #     return these_characteristics
 
 
-def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_collection_protocol, phenotyping_protocol):
+def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_collection_protocol, phenotyping_protocol,
+                                  obs_units=None):
+    from isatools.model import Characteristic, Comment, FactorValue, OntologyAnnotation, Process, Sample, StudyFactor
 
     obsunit_to_isasample_mapping_dictionary = {
         "X": "X",
@@ -199,11 +329,22 @@ def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_col
         "observationLevel": "Observation unit type"
     }
 
-    allready_converted_obs_unit = [] # Allow to handle multiyear observation units
-    for obs_unit in client.get_study_observation_units(brapi_study_id):
+    if obs_units is None:
+        obs_units = client.get_study_observation_units(brapi_study_id)
+
+    # indexes of the isa_study lists, so that looking up an observation unit source or factor does not scan them
+    sources_by_name = {}
+    for source in isa_study.sources:
+        sources_by_name.setdefault(source.name, source)
+    factors_by_name = {factor.name: factor for factor in isa_study.factors}
+
+    # the observation units characteristics stored as comments of the assay, category: values in order of appearance
+    assay_characteristics = {}
+    allready_converted_obs_unit = set() # Allow to handle multiyear observation units
+    for obs_unit in obs_units:
         # Getting the relevant germplasm used for that observation event:
         # ---------------------------------------------------------------
-        this_source = isa_study.get_source(obs_unit['germplasmName'])
+        this_source = sources_by_name.get(obs_unit['germplasmName'])
         #logger.debug("testing for the source reference: ", str(this_source))
 
         # TODO Assumed one assay by study. Will need to move to one assay by level/datalink
@@ -216,7 +357,7 @@ def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_col
                 name= obs_unit['observationUnitName'],
                 #name=obs_unit['observationUnitDbId'] + "_" + obs_unit['observationUnitName'],
                 derives_from=[this_source])
-            allready_converted_obs_unit.append(obs_unit['observationUnitName'])
+            allready_converted_obs_unit.add(obs_unit['observationUnitName'])
 
             for key in obs_unit.keys():
                 if key in obsunit_to_isasample_mapping_dictionary.keys():
@@ -235,12 +376,9 @@ def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_col
                     # this_isa_sample.characteristics.append(c)
                 if key in obsunit_to_isaassay_mapping_dictionary.keys():
                     if isinstance(obsunit_to_isaassay_mapping_dictionary[key], str):
-                        c = Characteristic(category=OntologyAnnotation(term=obsunit_to_isaassay_mapping_dictionary[key]),
-                                           value=OntologyAnnotation(term=str(obs_unit[key]),
-                                                                    term_source="",
-                                                                    term_accession=""))
                         #TODO: quick workaround used to store observation units characteristics
-                        this_assay.comments.append(c)
+                        assay_characteristics.setdefault(obsunit_to_isaassay_mapping_dictionary[key], {})[
+                            str(obs_unit[key])] = None
 
 
             # if 'observationLevel' in obs_unit.keys():
@@ -252,9 +390,11 @@ def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_col
             if 'treatments' in obs_unit.keys():
                 for element in obs_unit['treatments']:
                     for key in element.keys():
-                        f = StudyFactor(name=key, factor_type=OntologyAnnotation(term=key))
-                        if f not in isa_study.factors:
+                        f = factors_by_name.get(key)
+                        if f is None:
+                            f = StudyFactor(name=key, factor_type=OntologyAnnotation(term=key))
                             isa_study.factors.append(f)
+                            factors_by_name[key] = f
 
                         fv = FactorValue(factor_name=f,
                                          value=OntologyAnnotation(term=str(element[key]),
@@ -279,10 +419,15 @@ def create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_col
         # Creating the relevant ISA protocol application / Assay from BRAPI Observation Events:
         # -------------------------------------------------------------------------------------
 
-    create_data_file(obs_unit, this_assay, sample_collection_process, this_isa_sample, phenotyping_protocol)
+    # a single comment by characteristic, ISA-Tab has one Comment[] column by name in the investigation file
+    for category, values in assay_characteristics.items():
+        this_assay.comments.append(Comment(name=category, value=';'.join(values)))
+
+    create_data_file(obs_unit, this_assay, this_isa_sample, phenotyping_protocol)
 
 
-def create_data_file(obs_unit, this_assay, sample_collection_process, this_isa_sample, phenotyping_protocol):
+def create_data_file(obs_unit, this_assay, this_isa_sample, phenotyping_protocol):
+    from isatools.model import OntologyAnnotation, ParameterValue, Process, ProtocolParameter
     #TODO : reactivate data file generation, one by assay
     # Creating the relevant ISA protocol application / Assay from BRAPI Observation Events:
     # -------------------------------------------------------------------------------------
@@ -312,21 +457,6 @@ def create_data_file(obs_unit, this_assay, sample_collection_process, this_isa_s
 
         phenotyping_process.parameter_values.append(pv)
 
-        # Creating relevant protocol parameter values associated with the protocol application:
-        # -------------------------------------------------------------------------------------
-        if 'season' in obs_unit['observations'][j].keys():
-            pv = ParameterValue(
-                category=ProtocolParameter(parameter_name=OntologyAnnotation(term="season")),
-                value=OntologyAnnotation(term=str(obs_unit['observations'][j]['season']),
-                                         term_source="",
-                                         term_accession=""))
-        else:
-            pv = ParameterValue(
-                category=ProtocolParameter(parameter_name=OntologyAnnotation(term="season")),
-                value=OntologyAnnotation(term="none reported", term_source="", term_accession=""))
-
-        phenotyping_process.parameter_values.append(pv)
-
         # Getting and setting values for performer and date of the protocol application:
         # -------------------------------------------------------------------------------------
         # if obs_unit['observations'][j]['observationTimeStamp'] is not None:
@@ -351,7 +481,7 @@ def create_data_file(obs_unit, this_assay, sample_collection_process, this_isa_s
         # this_assay.process_sequence.append(sample_collection_process)
         this_assay.process_sequence.append(phenotyping_process)
         #this_assay.data_files.append(datafile)
-        plink(sample_collection_process, phenotyping_process)
+        # the sample is the link with the study table, the sample collection process is not part of the assay graph
 
         # For debugging purpose only, let's check it is fine:
         # print("process:", this_assay.process_sequence[0].name)
@@ -370,8 +500,72 @@ def write_records_to_file(this_study_id, records, this_directory, filetype, Obse
     fh.close()
 
 
-def get_output_path(path):
-    path = "outputdir/" + path + "/"
+def write_study_tables(isa_study, this_directory):
+    """Write the s_ study table and a_ assay tables of an ISA study, once it is complete"""
+    from isatools import isatab
+    from isatools.model import Investigation
+    # !!!: fix isatab.py to access other protocol_type values to enable Assay Tab serialization
+    # !!!: if Assay Table is missing the 'Assay Name' field, remember to check protocol_type used !!!
+    study_investigation = Investigation(studies=[isa_study])
+    isatab.write_study_table_files(study_investigation, this_directory)
+    isatab.write_assay_table_files(study_investigation, this_directory)
+
+
+def write_obs_data_files(converter, this_study_id, obs_units, obs_levels_in_study_and_var, germplasminfo, obs_levels,
+                         this_directory, variable_types=None, columnar=None, row_group_size=65536):
+    """
+    Write the d_ data files of all the observation levels of a study in a single pass over its observation units
+    Rows are routed to the (buffered) file of their level as soon as they are built, so memory stays constant
+    whatever the number of observations.
+    :param variable_types scale data type of the observation variables, typing the columns of the columnar files
+    :param columnar if given, the same rows are also written to a file of this columnar format (see COLUMNAR_FORMATS)
+    :param row_group_size number of rows by row group of the columnar files
+    """
+    logger.info('Writing data files')
+    if columnar:
+        from columnar_export import COLUMNAR_EXTENSIONS, ObsDataColumnarWriter
+    data_files = {}
+    try:
+        for level, variables in obs_levels_in_study_and_var.items():
+            layout = converter.create_isa_obs_data_layout(list(variables), level, obs_levels)
+            data_file_name = this_directory + 'd_' + this_study_id + '_' + level
+            fh = open(data_file_name + '.txt', 'w', buffering=DATA_FILE_BUFFERING)
+            fh.write('\t'.join(layout.head) + '\n')
+            columnar_writer = None
+            if columnar:
+                columnar_writer = ObsDataColumnarWriter(data_file_name + COLUMNAR_EXTENSIONS[columnar],
+                                                        layout.head, logger, variable_types, columnar, row_group_size)
+            data_files[level] = (fh, layout, columnar_writer)
+
+        for obs_unit in obs_units:
+            level = obs_unit.get('observationLevel')
+            if level not in data_files:
+                continue
+            fh, layout, columnar_writer = data_files[level]
+            try:
+                for row in converter.create_isa_obs_data_row_values(obs_unit, layout, germplasminfo):
+                    fh.write('\t'.join(row) + '\n')
+                    if columnar_writer is not None:
+                        columnar_writer.write_row(row)
+            except Exception:
+                logger.exception("Data file of level " + str(level) + " of study " + this_study_id + " failed")
+                # no partial data file is left, the files of the other levels are closed below
+                del data_files[level]
+                fh.close()
+                os.remove(fh.name)
+                if columnar_writer is not None:
+                    columnar_writer.close()
+                    os.remove(columnar_writer.path)
+                raise
+    finally:
+        for fh, _, columnar_writer in data_files.values():
+            fh.close()
+            if columnar_writer is not None:
+                columnar_writer.close()
+
+
+def get_output_path(path, output_dir=DEFAULT_OUTPUT_DIR):
+    path = os.path.join(output_dir, path, "")
     try:
         if not os.path.exists(path):
             os.makedirs(path)
@@ -381,33 +575,39 @@ def get_output_path(path):
             raise
     return path
 
-def get_trials( brapi_client : BrapiClient):
-    global TRIAL_IDS
-    global STUDY_IDS
-    if TRIAL_IDS:
-       return brapi_client.get_trials(TRIAL_IDS)
-    elif STUDY_IDS:
-        logger.debug("Got Study IDS : " + ','.join(STUDY_IDS))
-        TRIAL_IDS = []
-        for my_study_id in STUDY_IDS:
+def get_trials( brapi_client : BrapiClient, trial_ids=None, study_ids=None):
+    """
+    Return the trials to convert
+    :param trial_ids ids of the trials, ['all'] for all the trials of the endpoint
+    :param study_ids ids of studies, whose trials are returned when no trial_ids are given
+    """
+    if trial_ids:
+       return brapi_client.get_trials(trial_ids)
+    elif study_ids:
+        logger.debug("Got Study IDS : " + ','.join(study_ids))
+        study_trial_ids = []
+        for my_study_id in study_ids:
             my_study = brapi_client.get_study(my_study_id)
             if "trialDbId" in my_study.keys() and my_study["trialDbId"]:
-              TRIAL_IDS += my_study["trialDbId"]
+                my_trial_ids = [my_study["trialDbId"]]
             elif "trialDbIds" in my_study.keys() and my_study["trialDbIds"]:
-               TRIAL_IDS += my_study["trialDbIds"]
-        logger.debug("Got the Following trial ids for the Study IDS : " + str(TRIAL_IDS))
-        if len(TRIAL_IDS) > 0:
-            return brapi_client.get_trials(TRIAL_IDS)
+                my_trial_ids = my_study["trialDbIds"]
+            else:
+                my_trial_ids = []
+            # every trial is converted once, with all its studies
+            study_trial_ids += [trial_id for trial_id in my_trial_ids if trial_id not in study_trial_ids]
+        logger.debug("Got the Following trial ids for the Study IDS : " + str(study_trial_ids))
+        if len(study_trial_ids) > 0:
+            return brapi_client.get_trials(study_trial_ids)
         else:
-            return get_empty_trial()
+            return get_empty_trial(study_ids)
     else:
-        logger.info("Not enough parameters, provide TRIAL or STUDY IDs")
-        exit (1)
+        raise ValueError("Not enough parameters, provide TRIAL or STUDY IDs")
 
 
-def get_empty_trial():
+def get_empty_trial(study_ids):
     empty_trial = {
-        "trialDbId": "trial_less_study_"+STUDY_IDS[0],
+        "trialDbId": "trial_less_study_"+study_ids[0],
         "trialName": "N.A.",
         "trialType": "Project",
         "endDate": "",
@@ -417,43 +617,79 @@ def get_empty_trial():
         "studies":[]
     }
     #empty_trial_json = json.loads(empty_trial)
-    for my_study_id in STUDY_IDS:
+    for my_study_id in study_ids:
         empty_trial["studies"].append({"studyDbId": my_study_id})
     yield from [empty_trial]
 
 
-def main(arg):
-    """ Given a SERVER value (and BRAPI isa_study identifier), generates an ISA-Tab document"""
-
-    client = BrapiClient(SERVER, logger)
-    converter = BrapiToIsaConverter(logger, SERVER)
-
-    # iterating through the trials held in a BRAPI server:
-    # for trial in client.get_trials(TRIAL_IDS):
-    for trial in get_trials(client):
-        logger.info('we start from a set of Trials')
+def create_brapi_client(settings: ConversionSettings, metrics: RunMetrics, session=None) -> BrapiClient:
+    """
+    Create a BrapiClient of the endpoint of a conversion, configured from its settings
+    :param metrics metrics of the conversion, where the requests of the client are recorded
+    :param session HTTP session of the client, a pooled session is created if not provided
+    """
+    response_cache = None
+    if settings.cache_dir and settings.response_cache_size > 0:
+        response_cache = ResponseCache(os.path.join(settings.cache_dir, 'responses'), logger,
+                                       max_size=settings.response_cache_size * 1024 * 1024)
+    # cached pages are only found again when asked with the same page size
+    page_size_controller = PageSizeController(logger, initial=settings.page_size, adaptive=response_cache is None)
+    if settings.cache_dir:
+        page_size_controller.load(os.path.join(settings.cache_dir, 'page_sizes.json'))
+    return BrapiClient(settings.endpoint, logger, session=session, timeout=settings.timeout,
+                       prefetch_pages=settings.prefetch_pages, lookup_workers=settings.germplasm_workers,
+                       calls_cache_dir=settings.cache_dir, calls_cache_ttl=settings.calls_ttl,
+                       response_cache=response_cache, page_size_controller=page_size_controller,
+                       retry_policy=RetryPolicy(logger, retries=settings.retries, error_budget=settings.error_budget),
+                       json_backend=settings.json_backend, stream_pages=settings.stream_pages, metrics=metrics,
+                       pool_size=max(settings.pool_size, settings.prefetch_pages, settings.germplasm_workers))
+
+
+def save_page_sizes(client, cache_dir):
+    """Save the page sizes learned by a client for the next runs, in cache_dir"""
+    if cache_dir:
+        client.page_size_controller.save(os.path.join(cache_dir, 'page_sizes.json'))
+
+
+def create_investigation(trial):
+    """Create the ISA investigation of a BrAPI trial, without its studies"""
+    from isatools.model import Investigation, Person
+    investigation = Investigation()
+    if 'contacts' in trial.keys():
+        for brapicontact in trial['contacts']:
+            #NOTE: brapi has just name atribute -> no seperate first/last name
+            ContactName = brapicontact['name'].split(' ')
+            contact = Person(first_name=ContactName[0], last_name=ContactName[1],
+            affiliation=brapicontact['institutionName'], email=brapicontact['email'])
+            investigation.contacts.append(contact)
+    return investigation
+
+
+def convert_study(client, converter, brapi_study_id, output_directory, settings, metrics):
+    """
+    Convert a BrAPI study to an ISA study, writing its trait definition and data files in output_directory
+    :param settings settings of the conversion
+    :param metrics metrics of the conversion, where the wall time of the stages is recorded
+    :return the ISA study and the list of ontology sources it references
+    """
+    from isatools.model import Investigation, OntologyAnnotation, Protocol, Source
+    with span('study', 'study', study_id=str(brapi_study_id)):
+        germplasminfo = {}
+        #NOTE keeping track of germplasm info for data file generation
+        # the study is built apart from the trial investigation, which only collects its ontology sources here
         investigation = Investigation()
 
-        output_directory = get_output_path( trial['trialName'])
-        logger.info("Generating output in : "+ output_directory)
-
-        if 'contacts' in trial.keys():
-            for brapicontact in trial['contacts']:
-                #NOTE: brapi has just name atribute -> no seperate first/last name
-                ContactName = brapicontact['name'].split(' ')
-                contact = Person(first_name=ContactName[0], last_name=ContactName[1],
-                affiliation=brapicontact['institutionName'], email=brapicontact['email'])
-                investigation.contacts.append(contact)
-        
-        # iterating through the BRAPI studies associated to a given BRAPI trial:
-        for brapi_study in trial['studies']:
-            germplasminfo = {}
-            #NOTE keeping track of germplasm info for data file generation
-            brapi_study_id = brapi_study['studyDbId']
-            obs_levels_in_study_and_var, obs_levels = converter.obtain_brapi_obs_levels_and_var(brapi_study_id)
+        # Observation units are fetched once and replayed to every stage of the study conversion
+        # and held as compact records, keeping only the fields read by the conversion
+        with metrics.stage('observation units'):
+            obs_units = ObservationUnitStore(map(compact_observation_unit, client.get_study_observation_units(brapi_study_id)),
+                                             logger, max_in_memory=settings.obs_units_in_memory)
+        # the units held in memory or spooled to disk are released however the conversion of the study ends
+        with obs_units:
+            obs_levels_in_study_and_var, obs_levels = converter.obtain_brapi_obs_levels_and_var(brapi_study_id,
+                                                                                                obs_units)
             # NB: this method always create an ISA Assay Type
             isa_study, investigation = converter.create_isa_study(brapi_study_id, investigation, obs_levels_in_study_and_var.keys())
-            investigation.studies.append(isa_study)
 
             # creating the main ISA protocols:
             sample_collection_protocol = Protocol(name="sample collection",
@@ -467,68 +703,375 @@ def main(arg):
             isa_study.protocols.append(phenotyping_protocol)
 
             # Getting the list of all germplasms used in the BRAPI isa_study:
-            germplasms = client.get_study_germplasms(brapi_study_id)
-
-            germ_counter = 0
-            
-            # Iterating through the germplasm considered as biosource,
-            # For each of them, we retrieve their attributes and create isa characteristics
-            for germ in germplasms:
-                # print("GERM:", germ['germplasmName']) # germplasmDbId
-                # WARNING: BRAPIv1 endpoints are not consistently using these
-                # depending on endpoints, attributes may have to swapped
-                # get_germplasm_chars(germ)
-                # Creating corresponding ISA biosources with is Creating isa characteristics from germplasm attributes.
-                # ------------------------------------------------------
-                source = Source(name=germ['germplasmName'], characteristics=converter.create_germplasm_chars(germ))
-                
-                if germ['germplasmDbId'] not in germplasminfo:
-                    germplasminfo[germ['germplasmDbId']] = [germ['accessionNumber']]
-
-                # Associating ISA sources to ISA isa_study object
-                isa_study.sources.append(source)
-
-                germ_counter = germ_counter + 1
+            with metrics.stage('germplasm'):
+                germplasms = list(client.get_study_germplasms(brapi_study_id))
+                # and their details, fetched in bulk but returned in the same order
+                germplasms_details = client.get_germplasms_by_ids([germ['germplasmDbId'] for germ in germplasms])
+
+                germ_counter = 0
+
+                # Iterating through the germplasm considered as biosource,
+                # For each of them, we retrieve their attributes and create isa characteristics
+                for germ, germ_details in zip(germplasms, germplasms_details):
+                    # print("GERM:", germ['germplasmName']) # germplasmDbId
+                    # WARNING: BRAPIv1 endpoints are not consistently using these
+                    # depending on endpoints, attributes may have to swapped
+                    # get_germplasm_chars(germ)
+                    # Creating corresponding ISA biosources with is Creating isa characteristics from germplasm attributes.
+                    # ------------------------------------------------------
+                    source = Source(name=germ['germplasmName'],
+                                    characteristics=converter.create_germplasm_chars(germ, germ_details))
+
+                    if germ['germplasmDbId'] not in germplasminfo:
+                        germplasminfo[germ['germplasmDbId']] = [germ['accessionNumber']]
+
+                    # Associating ISA sources to ISA isa_study object
+                    isa_study.sources.append(source)
+
+                    germ_counter = germ_counter + 1
 
             # Now dealing with BRAPI observation units and attempting to create ISA samples
-            create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_collection_protocol, phenotyping_protocol)
+            with metrics.stage('samples'):
+                create_study_sample_and_assay(client, brapi_study_id, isa_study,  sample_collection_protocol, phenotyping_protocol,
+                                              obs_units)
 
-            # Writing isa_study to ISA-Tab format:
+            # Writing isa_study tables to ISA-Tab format:
             # --------------------------------
+            with metrics.stage('dump'):
+                try:
+                    write_study_tables(isa_study, output_directory)
+                except IOError as ioe:
+                    logger.info('CONVERSION FAILED!...')
+                    logger.info(str(ioe))
+
+            with metrics.stage('tdf'):
+                variable_types = None
+                try:
+                    obs_variables = list(client.get_study_observed_variables(brapi_study_id))
+                    if settings.columnar:
+                        from columnar_export import variable_data_types
+                        variable_types = variable_data_types(obs_variables)
+                    variable_records = converter.create_isa_tdf_from_obsvars(obs_variables)
+                    # Writing Trait Definition File:
+                    # ------------------------------
+                    write_records_to_file(this_study_id=str(brapi_study_id),
+                                          this_directory=output_directory,
+                                          records=variable_records,
+                                          filetype="t_")
+                except Exception:
+                    logger.exception("Trait definition file of study " + str(brapi_study_id) + " failed")
+                    raise
+
+            # Getting Variable Data and writing Measurement Data Files of every level in one pass
+            # -------------------------------------------------------
+            with metrics.stage('data files'):
+                write_obs_data_files(converter, str(brapi_study_id), obs_units, obs_levels_in_study_and_var, germplasminfo,
+                                     obs_levels, output_directory, variable_types, settings.columnar,
+                                     settings.row_group_size)
+
+            return isa_study, investigation.ontology_source_references
+
+
+def study_output_files(brapi_study_id, isa_study):
+    """Names of the files written by convert_study for a study"""
+    file_names = [isa_study.filename, "t_" + str(brapi_study_id) + ".txt"]
+    for assay in isa_study.assays:
+        # the d_ data files of an observation level are named after its a_ assay file
+        data_file_name = "d_" + assay.filename[len("a_"):-len(".txt")]
+        file_names += [assay.filename, data_file_name + ".txt"]
+        file_names += [data_file_name + extension for extension in ('.parquet', '.arrow')]
+    return file_names
+
+
+def previously_converted_study(journal, brapi_study_id, output_directory):
+    """Return the result of convert_study for a study completed by the previous run, None if it must be converted"""
+    converted_study = journal.converted_study(output_directory, brapi_study_id)
+    if converted_study is not None:
+        logger.info("Study " + str(brapi_study_id) + " already converted, skipping")
+    return converted_study
+
+
+def record_converted_study(journal, brapi_study_id, output_directory, converted_study):
+    """Record a study converted by convert_study in the run journal"""
+    journal.record_study(output_directory, brapi_study_id, study_output_files(brapi_study_id, converted_study[0]),
+                         converted_study)
+
+
+def journaled_study_converter(journal, study_converter):
+    """
+    Wrap a study converter, see convert_study, to reuse the studies completed by the previous run
+    and to record the studies it converts in the run journal
+    """
+    def convert(brapi_study_id, output_directory):
+        converted_study = previously_converted_study(journal, brapi_study_id, output_directory)
+        if converted_study is None:
+            converted_study = study_converter(brapi_study_id, output_directory)
+            record_converted_study(journal, brapi_study_id, output_directory, converted_study)
+        return converted_study
+    return convert
+
+
+def convert_trial(trial, study_converter, settings, metrics, journal=None):
+    """
+    Convert a BrAPI trial to an ISA investigation written in its output directory
+    :param study_converter function converting a study of the trial, see convert_study
+    :param settings settings of the conversion
+    :param metrics metrics of the conversion, where the wall time of the stages is recorded
+    :param journal run journal recording the trial once converted, and telling if it was by the previous run
+    :return the output directory of the trial
+    """
+    from isatools import isatab
+    with span('trial', 'trial', trial=trial['trialName'], studies=len(trial['studies'])):
+        logger.info('we start from a set of Trials')
+        investigation = create_investigation(trial)
+
+        output_directory = get_output_path( trial['trialName'], settings.output_dir)
+        logger.info("Generating output in : "+ output_directory)
+        study_ids = [brapi_study['studyDbId'] for brapi_study in trial['studies']]
+        if journal is not None and journal.trial_done(output_directory, study_ids):
+            logger.info("Trial " + trial['trialName'] + " already converted, skipping")
+            return output_directory
+
+        # iterating through the BRAPI studies associated to a given BRAPI trial:
+        for brapi_study in trial['studies']:
+            isa_study, ontology_sources = study_converter(brapi_study['studyDbId'], output_directory)
+            for ontology_source in ontology_sources:
+                if ontology_source not in investigation.ontology_source_references:
+                    investigation.ontology_source_references.append(ontology_source)
+            investigation.studies.append(isa_study)
+
+        # Writing the investigation file, the study and assay tables were written with each study:
+        # --------------------------------
+        with metrics.stage('dump'):
             try:
-                # isatools.isatab.dumps(investigation)  # dumps() writes out the ISA
-                # !!!: fix isatab.py to access other protocol_type values to enable Assay Tab serialization
-                # !!!: if Assay Table is missing the 'Assay Name' field, remember to check protocol_type used !!!
-                isatab.dump(isa_obj=investigation, output_path=output_directory)
+                isatab.dump(isa_obj=investigation, output_path=output_directory, skip_dump_tables=True)
+                if journal is not None:
+                    journal.record_trial(output_directory, study_ids, ["i_investigation.txt"])
                 logger.info('DONE!...')
             except IOError as ioe:
                 logger.info('CONVERSION FAILED!...')
                 logger.info(str(ioe))
+        return output_directory
+
+
+# settings, metrics, client and converter of a conversion worker process, which belongs to the pool of one conversion
+_worker_settings = None
+_worker_metrics = None
+_worker_client = None
+_worker_converter = None
+
+
+def _init_worker(settings):
+    global _worker_settings, _worker_metrics, _worker_client, _worker_converter
+    # a forked worker starts with a copy of the tracer of the parent process, if any: it is replaced
+    if settings.trace:
+        tracing.enable('worker')
+    else:
+        tracing.disable()
+    _worker_settings = settings
+    _worker_metrics = RunMetrics(settings.endpoint)
+    _worker_client = create_brapi_client(settings, _worker_metrics)
+    _worker_converter = BrapiToIsaConverter(logger, settings.endpoint, _worker_client)
+
 
+def _convert_study_in_worker(brapi_study_id, output_directory):
+    """Convert a study, return the result of convert_study with the metrics and trace events of the conversion"""
+    try:
+        converted_study = convert_study(_worker_client, _worker_converter, brapi_study_id, output_directory,
+                                        _worker_settings, _worker_metrics)
+        trace_events = tracing.tracer().drain() if tracing.tracer() is not None else []
+        return converted_study, _worker_metrics.to_dict(), trace_events
+    finally:
+        _worker_metrics.reset()
+        save_page_sizes(_worker_client, _worker_settings.cache_dir)
+
+
+def convert(endpoint: str, trial_ids: list = None, study_ids: list = None, output_dir: str = DEFAULT_OUTPUT_DIR,
+            session=None, **options) -> list:
+    """
+    Convert BrAPI trials to ISA-Tab documents, written in a directory by trial in output_dir
+
+    The conversion holds its settings and state, not the module: convert can be called repeatedly in a process, and
+    from several threads converting to different output directories. Tracing is the exception, the spans being
+    collected by process: the trace of concurrent conversions holds the spans of all of them.
+    :param endpoint BrAPI server endpoint
+    :param trial_ids ids of the trials to convert, ['all'] for all the trials of the endpoint (not recommended)
+    :param study_ids ids of the studies whose trials are converted, when no trial_ids are given
+    :param output_dir directory where the trials are written
+    :param session HTTP session of the BrAPI client, to reuse its keep-alive connections across conversions (see
+                   brapi_client.create_session), a session is created and closed by the conversion if not provided
+    :param options other settings of the conversion, see ConversionSettings
+    :return the output directories of the trials
+    """
+    settings = ConversionSettings(endpoint, trial_ids, study_ids, output_dir, **options)
+    if not settings.trial_ids and not settings.study_ids:
+        raise ValueError("Not enough parameters, provide TRIAL or STUDY IDs")
+    # requests and conversion stages of the run, written at its end
+    metrics = RunMetrics(endpoint)
+    # tracing is stopped by the conversion that started it
+    started_tracing = settings.trace and tracing.tracer() is None
+    if started_tracing:
+        tracing.enable('brapi_to_isa')
+    client = create_brapi_client(settings, metrics, session)
+    converter = BrapiToIsaConverter(logger, endpoint, client)
+    journal = RunJournal(settings.journal_dir, logger, resume=settings.resume)
+    try:
+        return convert_trials(client, converter, journal, settings, metrics)
+    finally:
+        save_page_sizes(client, settings.cache_dir)
+        write_metrics(settings, metrics)
+        if started_tracing:
+            tracing.disable()
+        if session is None:
+            client.close()
+
+
+def main(argv=None):
+    """
+    Given a BrAPI endpoint and trial or study identifiers on the command line, generates ISA-Tab documents
+    :param argv command line arguments, without the program name (none by default)
+    """
+    configure_logging()
+    logger.debug('Argument List:' + str(argv))
+    options = vars(parser.parse_args(argv or []))
+    endpoint = options.pop('endpoint', None) or DEFAULT_SERVER
+    # -t and -s can be repeated, and take comma separated ids
+    for ids in ('trial_ids', 'study_ids'):
+        if ids in options:
+            options[ids] = [identifier for value in options[ids] for identifier in value.split(',') if identifier]
+    logger.info("\n----------------\ntrials IDs to be exported : "
+                + str(options.get('trial_ids')) + "\nstudy IDs to be exported : "
+                + str(options.get('study_ids')) + "\nTarget endpoint :  "
+                + str(endpoint) + "\n----------------" )
+    convert(endpoint, **options)
+
+
+def write_metrics(settings, metrics):
+    """Write the metrics of a conversion to its metrics report, Prometheus textfile and trace, as requested"""
+    if settings.metrics_report:
+        metrics.write_json(settings.metrics_report, logger)
+        logger.info("Metrics written to " + settings.metrics_report)
+    if settings.prometheus_textfile:
+        metrics.write_prometheus(settings.prometheus_textfile, logger)
+    if settings.trace and tracing.tracer() is not None:
+        tracing.tracer().write(settings.trace, logger)
+        logger.info("Trace written to " + settings.trace)
+
+
+class SubmittedStudies:
+    """ Studies of a conversion submitted to a pool of worker processes, the first failed study failing the others
+
+    The studies not started yet when a study fails are cancelled, without shutting the pool down: leaving the pool
+    then still waits for the studies already running, so that none of them writes to the output afterwards.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.failures = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def submit(self, brapi_study_id, output_directory):
+        """Submit the conversion of a study, return the future of its worker, None once a study failed"""
+        with self._lock:
+            if self.failures:
+                return None
+            future = self.pool.submit(_convert_study_in_worker, brapi_study_id, output_directory)
+            self._futures.append(future)
+            return future
+
+    def fail(self, error):
+        """Record the failure of a study, and cancel the studies not started yet"""
+        with self._lock:
+            self.failures.append(error)
+            futures = list(self._futures)
+        # the callbacks of the cancelled futures run here
+        for future in futures:
+            future.cancel()
+
+
+def submit_study(submitted, journal, brapi_study_id, output_directory, metrics):
+    """
+    Submit the conversion of a study to a pool of worker processes, unless it was completed by the previous run
+    :param submitted studies submitted to the pool (see SubmittedStudies), the first failed one cancels the studies
+                     not started yet, whose futures then fail with it
+    :param metrics metrics of the conversion, where the metrics of the worker are merged
+    :return future of the result of convert_study, recorded in the run journal as soon as the study is converted
+    """
+    converted_study = previously_converted_study(journal, brapi_study_id, output_directory)
+    if converted_study is not None:
+        future = Future()
+        future.set_result(converted_study)
+        return future
+
+    future = Future()
+
+    def record(done):
+        # the future must be resolved whatever happens here, a trial waits for it
+        try:
+            if done.cancelled():
+                raise submitted.failures[0] if submitted.failures else CancelledError()
+            converted_study, worker_metrics, trace_events = done.result()
+            metrics.merge(worker_metrics)
+            if tracing.tracer() is not None:
+                tracing.tracer().merge(trace_events)
+            record_converted_study(journal, brapi_study_id, output_directory, converted_study)
+        except BaseException as error:
+            if not done.cancelled():
+                submitted.fail(error)
+            future.set_exception(error)
+        else:
+            future.set_result(converted_study)
+
+    worker_future = submitted.submit(brapi_study_id, output_directory)
+    if worker_future is None:
+        # a study submitted before failed
+        future.set_exception(submitted.failures[0])
+    else:
+        worker_future.add_done_callback(record)
+    return future
+
+
+def convert_trials(client, converter, journal, settings, metrics):
+    """
+    Convert the requested trials, serially or with a pool of worker processes
+    :param journal run journal recording the converted studies and trials, and those to skip on resume
+    :param settings settings of the conversion, also given to the worker processes
+    :param metrics metrics of the conversion
+    :return the output directories of the trials
+    """
+    if settings.workers > 1:
+        # Studies are converted by a pool of processes, then merged into their trial investigation in trial and
+        # study order, so that the output is the same as a serial conversion
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=settings.workers, initializer=_init_worker,
+                                 initargs=(settings,)) as pool:
+            submitted = SubmittedStudies(pool)
             try:
-                variable_records = converter.create_isa_tdf_from_obsvars(client.get_study_observed_variables(brapi_study_id))
-                # Writing Trait Definition File:
-                # ------------------------------
-                write_records_to_file(this_study_id=str(brapi_study_id),
-                                      this_directory=output_directory,
-                                      records=variable_records,
-                                      filetype="t_")
-            except Exception as ioe:
-                print(ioe)
-
-            # Getting Variable Data and writing Measurement Data File
-            # -------------------------------------------------------
-            for level, variables in obs_levels_in_study_and_var.items():
-                try:
-                    obsvarlist = []
-                    for i in client.get_study_observation_units(brapi_study_id):
-                        obsvarlist.append(i)
-                    data_readings = converter.create_isa_obs_data_from_obsvars(obsvarlist, list(variables) ,level, germplasminfo, obs_levels)
-                    logger.debug("Generating data files")
-                    write_records_to_file(this_study_id=str(brapi_study_id), this_directory=output_directory, records=data_readings,
-                                        filetype="d_", ObservationLevel=level)
-                except Exception as ioe:
-                    print(ioe)
+                trials = list(get_trials(client, settings.trial_ids, settings.study_ids))
+                # every study of every trial is submitted upfront: independent trials are converted concurrently too
+                converted_studies = {}
+                for trial in trials:
+                    output_directory = get_output_path(trial['trialName'], settings.output_dir)
+                    for brapi_study in trial['studies']:
+                        converted_studies[(output_directory, brapi_study['studyDbId'])] = submit_study(
+                            submitted, journal, brapi_study['studyDbId'], output_directory, metrics)
+                return [convert_trial(trial, lambda brapi_study_id, output_directory:
+                                      converted_studies[(output_directory, brapi_study_id)].result(), settings,
+                                      metrics, journal)
+                        for trial in trials]
+            except BaseException as error:
+                # the studies not started yet are not converted, leaving the pool waits for those running
+                submitted.fail(error)
+                raise
+    else:
+        # iterating through the trials held in a BRAPI server:
+        # for trial in client.get_trials(TRIAL_IDS):
+        study_converter = journaled_study_converter(journal, lambda brapi_study_id, output_directory:
+                                                    convert_study(client, converter, brapi_study_id, output_directory,
+                                                                  settings, metrics))
+        return [convert_trial(trial, study_converter, settings, metrics, journal)
+                for trial in get_trials(client, settings.trial_ids, settings.study_ids)]
 
 
 #############################################
@@ -537,7 +1080,7 @@ def main(arg):
 """ starting up """
 if __name__ == '__main__':
     try:
-        main(arg=SERVER)
+        main(sys.argv[1:])
     except Exception as e:
         logging.exception(e)
         sys.exit(1)
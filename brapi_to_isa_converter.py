@@ -1,10 +1,9 @@
-from isatools.model import Investigation, OntologyAnnotation, OntologySource, Assay, Study, Characteristic, Source, \
-    Sample, Comment
-
-import copy
 from collections import defaultdict
 from brapi_client import BrapiClient
 
+# isatools is imported by the methods building ISA objects: it takes seconds to import, which a process that only
+# needs the observation data conversion or the BrAPI client does not pay
+
 
 class BrapiToIsaConverter:
     """ Converter json coming out of the BRAPI to ISA object
@@ -16,10 +15,18 @@ class BrapiToIsaConverter:
         - create_materials()
     """
 
-    def __init__(self, logger, endpoint):
+    # headers belonging observation unit
+    obs_unit_header = ["observationUnitDbId", "observationUnitXref", "germplasmDbId", "germplasmName", "X", "Y"]
+    # headers belonging germplasm
+    germpl_header = ["accessionNumber"]
+    # headers belonging observation
+    obs_header = ["observationTimeStamp"]
+
+    def __init__(self, logger, endpoint, brapi_client: BrapiClient = None):
         self.logger = logger
         self.endpoint = endpoint
-        self._brapi_client = BrapiClient(self.endpoint, self.logger)
+        # share the client (and its connection pool) of the caller when given
+        self._brapi_client = brapi_client or BrapiClient(self.endpoint, self.logger)
 
     # _brapi_client
     #
@@ -27,12 +34,15 @@ class BrapiToIsaConverter:
     #     if self._brapi_client is None:
     #
     #     return self._brapi_client
-    def obtain_brapi_obs_levels_and_var(self, brapi_study_id):
+    def obtain_brapi_obs_levels_and_var(self, brapi_study_id, obs_units=None):
         # because not every obs level has the same variables, and this is not yet supported by brapi to filter on /
         # every observation will be checked for 
+        # obs_units can be given (ex: an ObservationUnitStore) to avoid fetching them again from the endpoint
+        if obs_units is None:
+            obs_units = self._brapi_client.get_study_observation_units(brapi_study_id)
         obs_level_in_study = defaultdict(set)
         obs_levels = defaultdict(set)
-        for ou in self._brapi_client.get_study_observation_units(brapi_study_id):
+        for ou in obs_units:
             for obs in ou['observations']:
                 if ou['observationLevel']:
                     obs_level_in_study[ou['observationLevel']].add(obs['observationVariableName'])
@@ -47,15 +57,19 @@ class BrapiToIsaConverter:
         self.logger.info("Observation Levels in study: " + ",".join(obs_level_in_study.keys()))
         return obs_level_in_study, obs_levels
 
-    def create_germplasm_chars(self, germplasm):
+    def create_germplasm_chars(self, germplasm, all_germplasm_attributes=None):
         """" Given a BRAPI Germplasm ID, retrieve the list of all attributes from BRAPI and returns a list of ISA
-        characteristics using MIAPPE tags for compliance + X-check against ISAconfiguration"""
+        characteristics using MIAPPE tags for compliance + X-check against ISAconfiguration
+        The attributes can be given when already fetched (ex: with BrapiClient.get_germplasms_by_ids)"""
         # TODO: switch BRAPI tags to MIAPPE Tags
 
         returned_characteristics = []
+        # (category, value) of the returned characteristics, to skip duplicates without comparing every characteristic
+        returned_terms = set()
 
-        germplasm_id = germplasm['germplasmDbId']
-        all_germplasm_attributes = self._brapi_client.get_germplasm(germplasm_id)
+        if all_germplasm_attributes is None:
+            germplasm_id = germplasm['germplasmDbId']
+            all_germplasm_attributes = self._brapi_client.get_germplasm(germplasm_id)
 
         mapping_dictionnary = {
             "accessionNumber": "Material Source ID",
@@ -80,7 +94,8 @@ class BrapiToIsaConverter:
                                            all_germplasm_attributes[key][item][mapping_dictionnary[key][2]])
                         ontovalue = ";".join(taxinfo)
                         c = self.create_isa_characteristic(mapping_dictionnary[key][0], ontovalue)
-                        if c not in returned_characteristics:
+                        if (c.category.term, c.value.term) not in returned_terms:
+                            returned_terms.add((c.category.term, c.value.term))
                             returned_characteristics.append(c)
 
             elif key == "donors":
@@ -100,7 +115,8 @@ class BrapiToIsaConverter:
             else:
                 c = self.create_isa_characteristic(key, str(all_germplasm_attributes[key]))
 
-            if c not in returned_characteristics:
+            if (c.category.term, c.value.term) not in returned_terms:
+                returned_terms.add((c.category.term, c.value.term))
                 returned_characteristics.append(c)
 
         return returned_characteristics
@@ -155,6 +171,7 @@ class BrapiToIsaConverter:
 
     def create_isa_study(self, brapi_study_id, investigation, obs_levels_in_study):
         """Returns an ISA study given a BrAPI endpoints and a BrAPI study identifier."""
+        from isatools.model import Assay, Comment, OntologyAnnotation, OntologySource, Study
 
         brapi_study = self._brapi_client.get_study(brapi_study_id)
 
@@ -253,6 +270,7 @@ class BrapiToIsaConverter:
 
     def create_isa_characteristic(self, my_category, my_value):
         """Given a pair of category and value, return an ISA Characteristics element """
+        from isatools.model import Characteristic, OntologyAnnotation
         this_characteristic = Characteristic(category=OntologyAnnotation(term=str(my_category)),
                                              value=OntologyAnnotation(term=str(my_value), term_source="",
                                                                       term_accession=""))
@@ -291,61 +309,87 @@ class BrapiToIsaConverter:
     def create_isa_obs_data_from_obsvars(self, obs_units, obs_variables, level, germplasminfo, obs_levels):
         # TODO: BH2018 - discussion with Cyril and Guillaume: Observation Values should be grouped by Observation Level {plot,block,plant,individual,replicate}
         # TODO: create as many ISA assays as there as declared ObservationLevel in the BRAPI message
-        data_records = []
+        layout = self.create_isa_obs_data_layout(obs_variables, level, obs_levels)
+        data_records = ['\t'.join(layout.head)]
+
+        for obsUnit in obs_units:
+            if obsUnit['observationLevel'] == level:
+                data_records.extend(self.create_isa_obs_data_rows(obsUnit, layout, germplasminfo))
+
+        return data_records
+
+    def create_isa_obs_data_header(self, obs_variables, level, obs_levels):
+        """Return the column names of the data file of an observation level"""
         obs_levels_header = []
         for obslvl in obs_levels[level]:
             obs_levels_header.append("observationLevels[{}]".format(obslvl))
-        # headers belonging observation unit
-        obs_unit_header = ["observationUnitDbId", "observationUnitXref", "germplasmDbId", "germplasmName", "X", "Y"]
-        # headers belonging germplasm
-        germpl_header = ["accessionNumber"]
-        # headers belonging observation
-        obs_header = ["observationTimeStamp"]
         # adding variables headers
-        head = obs_levels_header + obs_unit_header + germpl_header + obs_header + obs_variables
-        
-        datafile_header = '\t'.join(head)
-        data_records.append(datafile_header)
+        return obs_levels_header + self.obs_unit_header + self.germpl_header + self.obs_header + obs_variables
 
-        emptyRow = [] #Empty row that is later filled in with values -> fixed row size
-        for i in range(len(head)):
-            emptyRow.append("")
+    def create_isa_obs_data_layout(self, obs_variables, level, obs_levels):
+        """Return the compiled column layout of the data file of an observation level"""
+        return ObsDataLayout(self.create_isa_obs_data_header(obs_variables, level, obs_levels))
 
-        for obsUnit in obs_units:
-            if obsUnit['observationLevel'] == level:
-                row = copy.deepcopy(emptyRow)
-                #Get data from observationUnit
-                for obsdet in obsUnit.keys():
-                    if obsdet == "observationLevels":
-                        for obslvls in obsUnit['observationLevels'].split(","):
-                            a,b = obslvls.split(":")
-                            row[head.index("observationLevels[{}]".format(a))] = b
-                    if obsdet in obs_unit_header and obsUnit[obsdet]:
-                        outp = []
-                        if obsdet == "observationUnitXref":
-                            for item in obsUnit[obsdet]:
-                                if item["id"]:
-                                    outp.append("{!s}:{!r}".format(item["source"],item["id"]))
-                            row[head.index("observationUnitXref")] =  ';'.join(outp)
-                        else:
-                            row[head.index(obsdet)] = obsUnit[obsdet]
-                        if obsdet == "germplasmDbId":
-                            row[head.index("accessionNumber")] = germplasminfo[obsUnit[obsdet]][0]
-
-                rowbuffer = copy.deepcopy(row)
-                
-                for measurement in obsUnit["observations"]:
-                    #Get data from observation
-                    for mesdet in obs_header:
-                        if measurement[mesdet]:
-                            row[head.index(mesdet)] = measurement[mesdet]
-                        else:
-                            self.logger.info(mesdet + " does not exist in observation in observationUnit " + obsUnit['observationUnitDbId'])
-                    if measurement["observationVariableName"] in head:
-                        row[head.index(measurement["observationVariableName"])] = str(measurement["value"])
-                        data_records.append('\t'.join(row))
-                        row = copy.deepcopy(rowbuffer)
-                    else:
-                        self.logger.info(measurement["observationVariableName"] + " does not exist in observationVariable list ")
+    def create_isa_obs_data_rows(self, obsUnit, layout, germplasminfo):
+        """Return the data file rows (one by observation) of an observation unit, given the data file layout"""
+        return ['\t'.join(row) for row in self.create_isa_obs_data_row_values(obsUnit, layout, germplasminfo)]
+
+    def create_isa_obs_data_row_values(self, obsUnit, layout, germplasminfo):
+        """Return the cells of the data file rows (one list by observation) of an observation unit"""
+        data_records = []
+        obs_unit_header = self.obs_unit_header
+        obs_header = self.obs_header
+        columns = layout.columns
+
+        row = layout.empty_row[:]
+        #Get data from observationUnit
+        for obsdet in obsUnit.keys():
+            if obsdet == "observationLevels":
+                for obslvls in obsUnit['observationLevels'].split(","):
+                    a,b = obslvls.split(":")
+                    row[columns["observationLevels[{}]".format(a)]] = b
+            if obsdet in obs_unit_header and obsUnit[obsdet]:
+                outp = []
+                if obsdet == "observationUnitXref":
+                    for item in obsUnit[obsdet]:
+                        if item["id"]:
+                            outp.append("{!s}:{!r}".format(item["source"],item["id"]))
+                    row[columns["observationUnitXref"]] =  ';'.join(outp)
+                else:
+                    row[columns[obsdet]] = obsUnit[obsdet]
+                if obsdet == "germplasmDbId":
+                    row[columns["accessionNumber"]] = germplasminfo[obsUnit[obsdet]][0]
+
+        rowbuffer = row[:]
+
+        for measurement in obsUnit["observations"]:
+            #Get data from observation
+            for mesdet in obs_header:
+                if measurement[mesdet]:
+                    row[columns[mesdet]] = measurement[mesdet]
+                else:
+                    self.logger.info(mesdet + " does not exist in observation in observationUnit " + obsUnit['observationUnitDbId'])
+            variable_column = columns.get(measurement["observationVariableName"])
+            if variable_column is not None:
+                row[variable_column] = str(measurement["value"])
+                data_records.append(row)
+                row = rowbuffer[:]
+            else:
+                self.logger.info(measurement["observationVariableName"] + " does not exist in observationVariable list ")
 
         return data_records
+
+
+class ObsDataLayout:
+    """ Column layout of the data file of an observation level, compiled once from its header
+
+    Maps every column name to its index (the first one, if a name is repeated) and holds an empty row template, so
+    that building a row costs a slice copy and one dict lookup by cell instead of scans of the header.
+    """
+
+    def __init__(self, head):
+        self.head = head
+        self.columns = {}
+        for index, name in enumerate(head):
+            self.columns.setdefault(name, index)
+        self.empty_row = [""] * len(head)
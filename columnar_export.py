@@ -0,0 +1,126 @@
+import datetime
+import logging
+from typing import Iterable, List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+# file extension of every columnar format
+COLUMNAR_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# BrAPI v1 scale data types stored as numbers and as dates, other variables are stored as strings
+NUMERICAL_DATA_TYPES = frozenset(('Numerical',))
+DATE_DATA_TYPES = frozenset(('Date',))
+
+
+def variable_data_types(obs_variables: Iterable) -> dict:
+    """Map the names of BrAPI observation variables to their scale data type"""
+    data_types = {}
+    for obs_var in obs_variables:
+        data_type = (obs_var.get('scale') or {}).get('dataType')
+        for name in (obs_var.get('name'), obs_var.get('observationVariableName')):
+            if name:
+                data_types[name] = data_type
+    return data_types
+
+
+def _to_string(value):
+    return str(value) if value != "" else None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value):
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+class ObsDataColumnarWriter:
+    """ Columnar copy (Parquet or Arrow IPC file) of the d_ data file of an observation level
+
+    Variable columns are typed from the scale data type of their variable (numbers, dates, or strings), the other
+    columns are strings, and empty cells are nulls. Rows are buffered and written by row groups of row_group_size
+    rows, so memory stays bounded whatever the number of observations.
+    """
+
+    def __init__(self, path: str, head: List[str], logger: logging.Logger, variable_types: dict = None,
+                 file_format: str = 'parquet', row_group_size: int = 65536):
+        """
+        :param path path of the columnar file
+        :param head column names of the data file (see ObsDataLayout)
+        :param logger logger used to report values not matching the data type of their variable
+        :param variable_types scale data type of the variables, see variable_data_types
+        :param file_format 'parquet' or 'arrow' (Arrow IPC file)
+        :param row_group_size number of rows by row group (Parquet) or record batch (Arrow)
+        """
+        self.path = path
+        self.logger = logger
+        self.row_group_size = row_group_size
+        variable_types = variable_types or {}
+        fields = []
+        self._converters = []
+        for name in head:
+            if variable_types.get(name) in NUMERICAL_DATA_TYPES:
+                fields.append(pa.field(name, pa.float64()))
+                self._converters.append(_to_float)
+            elif variable_types.get(name) in DATE_DATA_TYPES:
+                fields.append(pa.field(name, pa.date32()))
+                self._converters.append(_to_date)
+            else:
+                fields.append(pa.field(name, pa.string()))
+                self._converters.append(_to_string)
+        self.schema = pa.schema(fields)
+        self._columns = [[] for _ in head]
+        self._rows = 0
+        self._invalid_values = 0
+        if file_format == 'parquet':
+            self._sink = None
+            self._writer = pq.ParquetWriter(path, self.schema)
+        elif file_format == 'arrow':
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+        else:
+            raise ValueError("Unknown columnar format: " + str(file_format))
+
+    def write_row(self, row: List[str]):
+        """Add a row of the data file, in the order of its head"""
+        for column, converter, value in zip(self._columns, self._converters, row):
+            converted = converter(value)
+            if converted is None and value != "" and converter is not _to_string:
+                self._invalid_values += 1
+            column.append(converted)
+        self._rows += 1
+        if self._rows >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        batch = pa.record_batch([pa.array(column, type=field.type) for column, field in zip(self._columns, self.schema)],
+                                schema=self.schema)
+        if self._sink is None:
+            self._writer.write_table(pa.Table.from_batches([batch]), row_group_size=self.row_group_size)
+        else:
+            self._writer.write_batch(batch)
+        self._columns = [[] for _ in self._columns]
+        self._rows = 0
+
+    def close(self):
+        """Write the last rows and close the file"""
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+            if self._sink is not None:
+                self._sink.close()
+        if self._invalid_values:
+            self.logger.warning(str(self._invalid_values) + " values of " + self.path +
+                                " do not match the data type of their variable and were written as nulls")
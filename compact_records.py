@@ -0,0 +1,95 @@
+import sys
+from collections.abc import Mapping
+
+# fields of the BrAPI observation units and observations read by the conversion, the others are dropped
+OBS_UNIT_FIELDS = frozenset(("observationUnitDbId", "observationUnitName", "observationUnitXref", "germplasmDbId",
+                             "germplasmName", "X", "Y", "blockNumber", "plotNumber", "plantNumber", "observationLevel",
+                             "observationLevels", "treatments", "observations"))
+OBSERVATION_FIELDS = frozenset(("observationVariableName", "value", "season", "observationTimeStamp"))
+
+# fields whose values repeat across units and observations, stored once with sys.intern
+INTERNED_FIELDS = frozenset(("germplasmDbId", "germplasmName", "observationLevel", "observationLevels",
+                             "observationVariableName", "observationTimeStamp", "season"))
+
+
+class _Layout:
+    """ Keys of a record and their index, shared by all the records having the same keys in the same order
+    """
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys: tuple):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+
+
+_layouts = {}
+
+
+def _layout(keys: tuple) -> _Layout:
+    layout = _layouts.get(keys)
+    if layout is None:
+        layout = _layouts.setdefault(keys, _Layout(tuple(sys.intern(key) for key in keys)))
+    return layout
+
+
+class CompactRecord(Mapping):
+    """ Read-only mapping of the fields of a BrAPI object, holding its values in a tuple
+
+    A record has no __dict__ and shares its keys with every record of the same shape, so it is several times smaller
+    than the dict parsed from JSON. Keys keep the order the server sent them in.
+    """
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, keys: tuple, values: tuple):
+        self._layout = _layout(keys)
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._layout.index[key]]
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self._layout.index
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'CompactRecord(' + repr(dict(self)) + ')'
+
+    def __reduce__(self):
+        return CompactRecord, (self._layout.keys, self._values)
+
+
+def _compact(obj: dict, fields: frozenset) -> CompactRecord:
+    keys = []
+    values = []
+    for key, value in obj.items():
+        if key in fields:
+            if key in INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            elif key == "observations" and isinstance(value, list):
+                value = tuple(_compact(observation, OBSERVATION_FIELDS) for observation in value)
+            keys.append(key)
+            values.append(value)
+    return CompactRecord(tuple(keys), tuple(values))
+
+
+def compact_observation_unit(obs_unit: dict) -> CompactRecord:
+    """
+    Return a compact record of a BrAPI observation unit and of its observations
+    Only the fields read by the conversion are kept, see OBS_UNIT_FIELDS and OBSERVATION_FIELDS.
+    """
+    return _compact(obs_unit, OBS_UNIT_FIELDS)
+
+
+def to_json(obj):
+    """json.dumps default function serializing compact records as objects"""
+    if isinstance(obj, CompactRecord):
+        return dict(obj)
+    raise TypeError("Object of type " + type(obj).__name__ + " is not JSON serializable")
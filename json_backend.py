@@ -0,0 +1,52 @@
+import json
+from typing import Callable, Dict
+
+import requests
+
+
+def _orjson_loads():
+    import orjson
+    return orjson.loads
+
+
+def _ujson_loads():
+    import ujson
+    return ujson.loads
+
+
+# JSON libraries able to decode BrAPI responses, fastest first
+BACKENDS: Dict[str, Callable] = {
+    'orjson': _orjson_loads,
+    'ujson': _ujson_loads,
+    'json': lambda: json.loads,
+}
+
+
+def get_json_loads(backend: str = None):
+    """
+    Return the function decoding JSON (from bytes or str) of a backend
+    :param backend name of the backend (see BACKENDS), the fastest installed one if not provided
+    :return a (name, loads) tuple
+    """
+    if backend is not None:
+        return backend, BACKENDS[backend]()
+    for name, import_loads in BACKENDS.items():
+        try:
+            return name, import_loads()
+        except ImportError:
+            continue
+
+
+JSON_BACKEND, json_loads = get_json_loads()
+
+
+def decode_response(r: requests.Response, loads: Callable = None) -> dict:
+    """
+    Decode the JSON body of a response, once and straight from its bytes
+    :param loads JSON decoding function, json_loads if not provided
+    """
+    try:
+        return (loads or json_loads)(r.content)
+    except ValueError:
+        # not UTF-8: let requests guess the encoding of the body
+        return r.json()
@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import tempfile
+import weakref
+from collections.abc import Iterable
+
+from compact_records import to_json
+
+
+class ObservationUnitStore:
+    """ Hold the observation units of a BrAPI study so they can be replayed to every conversion stage
+
+    The units are pulled from the BrAPI endpoint only once. Small studies are kept in memory, bigger ones are
+    spooled to a local JSON lines file as soon as more than `max_in_memory` units have been read.
+    """
+
+    def __init__(self, obs_units: Iterable, logger: logging.Logger, max_in_memory: int = 50000,
+                 spool_dir: str = None):
+        """
+        :param obs_units iterable of BrAPI observation units (ex: BrapiClient.get_study_observation_units)
+        :param logger logger used to report spooling
+        :param max_in_memory number of units kept in RAM before spooling to disk (None to never spool)
+        :param spool_dir directory of the spool file (system temporary directory by default)
+        """
+        self.logger = logger
+        self.max_in_memory = max_in_memory
+        self.spool_dir = spool_dir
+        self._units = []
+        self._spool_path = None
+        self._count = 0
+        self._closed = False
+        self._load(obs_units)
+
+    def _load(self, obs_units: Iterable):
+        spool = None
+        try:
+            for obs_unit in obs_units:
+                if spool is None and self.max_in_memory is not None and len(self._units) >= self.max_in_memory:
+                    spool = self._open_spool()
+                if spool is not None:
+                    spool.write(json.dumps(obs_unit, default=to_json) + '\n')
+                else:
+                    self._units.append(obs_unit)
+                self._count += 1
+        finally:
+            if spool is not None:
+                spool.close()
+
+    def _open_spool(self):
+        """Move the units read so far to a spool file and return it opened for appending"""
+        fd, self._spool_path = tempfile.mkstemp(prefix='obsunits_', suffix='.jsonl', dir=self.spool_dir)
+        # remove the spool file when the store is closed or garbage collected
+        self._finalizer = weakref.finalize(self, _remove_file, self._spool_path)
+        self.logger.info("More than " + str(self.max_in_memory) + " observation units, spooling to "
+                         + self._spool_path)
+        spool = open(fd, 'w', encoding='utf-8')
+        for obs_unit in self._units:
+            spool.write(json.dumps(obs_unit, default=to_json) + '\n')
+        self._units = []
+        return spool
+
+    @property
+    def spooled(self) -> bool:
+        """True if the observation units are stored on disk"""
+        return self._spool_path is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._closed:
+            raise ValueError("The observation units store is closed, its units can not be replayed")
+        if self._spool_path is None:
+            return iter(self._units)
+        return self._iter_spool()
+
+    def _iter_spool(self):
+        with open(self._spool_path, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                yield json.loads(line)
+
+    def close(self):
+        """Release the stored observation units (and remove the spool file if any), the store can not be replayed"""
+        self._units = []
+        self._closed = True
+        if self._spool_path is not None:
+            self._finalizer()
+            self._spool_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
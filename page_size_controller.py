@@ -0,0 +1,219 @@
+import json
+import logging
+import threading
+
+from atomic_file import atomic_write
+
+
+def aligned_page_size(offset: int, page_size: int, floor: int):
+    """
+    Return the largest page size in [floor, page_size] whose pages start at offset, None if there is none
+    BrAPI pages are addressed by index, so a call can only switch page size where offset is a multiple of the new size.
+    """
+    for size in range(page_size, max(floor, 1) - 1, -1):
+        if offset % size == 0:
+            return size
+    return None
+
+
+class PageSizeController:
+    """ Tune the page size of paginated BrAPI calls with additive increase / multiplicative decrease (AIMD)
+
+    The page size of a route (ex '/studies/{id}/observationunits') of a host grows by `increase` after every fast
+    page and is multiplied by `decrease` after a slow page, a too big page, a timeout or a 5xx error. The learned
+    sizes are the starting sizes of the next calls to the same route of the same host, and can be saved to disk to
+    be reused by later runs. Sizes never grow above the largest page a host serves for a route (see record_cap).
+    A controller that is not adaptive keeps the page sizes, and only makes them smaller after a failed page or for a
+    capped route, so that the pages of a call are the same from one run to the next (ex for a ResponseCache).
+    """
+
+    def __init__(self, logger: logging.Logger, initial: int = 1000, minimum: int = 100, maximum: int = 10000,
+                 increase: int = 500, decrease: float = 0.5, target_latency: float = 10.0,
+                 max_page_bytes: int = 32 * 1024 * 1024, adaptive: bool = True):
+        """
+        :param logger logger used to report page size changes
+        :param initial page size of a route never seen before
+        :param minimum smallest page size
+        :param maximum biggest page size
+        :param increase page size added after a page faster than half the target latency
+        :param decrease factor applied to the page size after a slow or failed page
+        :param target_latency time in seconds above which a page is considered slow
+        :param max_page_bytes size of a page body above which the page size is decreased
+        :param adaptive if False, the page sizes are not changed by the latency and size of successful pages
+        """
+        self.logger = logger
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_page_bytes = max_page_bytes
+        self.adaptive = adaptive
+        self._sizes = {}
+        self._caps = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host: str, route: str) -> str:
+        return host + ' ' + route
+
+    def page_size(self, host: str, route: str) -> int:
+        """Page size to start a call to a route of a host with"""
+        with self._lock:
+            return self._sizes.get(self._key(host, route), self.initial)
+
+    def record_page(self, host: str, route: str, page_size: int, latency: float, page_bytes: int) -> int:
+        """Record a successful page, return the page size to use next"""
+        if not self.adaptive:
+            return page_size
+        if latency > self.target_latency or page_bytes > self.max_page_bytes:
+            new_size = max(self.minimum, int(page_size * self.decrease))
+        elif latency < self.target_latency / 2:
+            with self._lock:
+                cap = self._caps.get(self._key(host, route), self.maximum)
+            new_size = max(page_size, min(self.maximum, cap, page_size + self.increase))
+        else:
+            new_size = page_size
+        return self._learn(host, route, page_size, new_size)
+
+    def record_failure(self, host: str, route: str, page_size: int) -> int:
+        """Record a page that timed out or failed with a 5xx error, return the page size to use next"""
+        return self._learn(host, route, page_size, max(self.minimum, int(page_size * self.decrease)))
+
+    def record_cap(self, host: str, route: str, page_size: int):
+        """Record that a host serves at most page_size objects by page for a route, whatever the pageSize asked"""
+        self.logger.info("pages of " + host + route + " are capped to " + str(page_size) + " objects")
+        with self._lock:
+            self._caps[self._key(host, route)] = page_size
+            self._sizes[self._key(host, route)] = page_size
+
+    def _learn(self, host: str, route: str, page_size: int, new_size: int) -> int:
+        if new_size != page_size:
+            self.logger.debug("page size of " + host + route + ": " + str(page_size) + " -> " + str(new_size))
+        with self._lock:
+            self._sizes[self._key(host, route)] = new_size
+        return new_size
+
+    def load(self, path: str):
+        """Load page sizes learned by a previous run"""
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                sizes = json.load(fh)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for key, size in sizes.items():
+                self._sizes.setdefault(key, min(self.maximum, max(self.minimum, int(size))))
+
+    def save(self, path: str):
+        """Save the learned page sizes for later runs"""
+        with self._lock:
+            sizes = dict(self._sizes)
+        try:
+            # concurrent runs never read a partial file
+            atomic_write(path, json.dumps(sizes, indent=1, sort_keys=True))
+        except OSError as oserror:
+            self.logger.warning("Could not save page sizes to " + path + ": " + str(oserror))
+
+
+class Paging:
+    """ Position and page size of one paginated BrAPI call, shared by BrapiClient and AsyncBrapiClient
+
+    Pages are asked with the page size the controller learned for the route. A page that failed is asked again with
+    smaller pages (see shrink), a page capped by the server makes the following pages use the served size, and the
+    page size learned from a page is switched to where the page boundaries of both sizes meet (see resize). Objects
+    are counted as they are yielded, so that a page asked again never yields the same object twice.
+    """
+
+    def __init__(self, controller: PageSizeController, host: str, route: str):
+        """
+        :param controller controller of the page sizes
+        :param host host of the BrAPI endpoint
+        :param route BrAPI route of the call (ex '/studies/{id}/observationunits')
+        """
+        self.controller = controller
+        self.host = host
+        self.route = route
+        self.page = 0
+        self.page_size = controller.page_size(host, route)
+        # unknown until the first page is read, and after the page size changes
+        self.page_count = None
+        self.yielded = 0
+        self._total_count = None
+
+    def has_next(self) -> bool:
+        """Tell if there is a page left to ask"""
+        return self.page_count is None or self.page < self.page_count
+
+    def params(self, params: dict) -> dict:
+        """Set the page and pageSize query parameters of the current page in params"""
+        params['page'] = self.page
+        params['pageSize'] = self.page_size
+        return params
+
+    def record_failure(self) -> int:
+        """Record a failure of the current page (timeout or 5xx error), return the page size learned from it"""
+        return self.controller.record_failure(self.host, self.route, self.page_size)
+
+    def shrink(self) -> bool:
+        """
+        Record a failure of the current page (timeout or 504 error), return True if it is to be asked again with
+        smaller pages, False if pages can not get smaller
+        """
+        next_page_size = self.record_failure()
+        offset = self.page * self.page_size
+        aligned = aligned_page_size(offset, next_page_size, self.controller.minimum)
+        if not aligned or aligned >= self.page_size:
+            return False
+        # the page count at the smaller size is known from its first page
+        self.page, self.page_size, self.page_count = offset // aligned, aligned, None
+        return True
+
+    def first_index(self, pagination: dict) -> int:
+        """
+        Return the index of the first object of the current page, given its pagination
+        Servers may cap the pageSize asked, then the page holds the objects of that page index at the capped size.
+        The cap is recorded to not ask for bigger pages again.
+        """
+        try:
+            served_page_size = int(pagination['pageSize'])
+            total_pages = int(pagination['totalPages'])
+        except (KeyError, TypeError, ValueError):
+            return self.page * self.page_size
+        # the last page can hold fewer objects than the page size
+        if 0 < served_page_size < self.page_size and self.page + 1 < total_pages:
+            self.controller.record_cap(self.host, self.route, served_page_size)
+            self.page_size = served_page_size
+        return self.page * self.page_size
+
+    def is_new(self, index: int) -> bool:
+        """Tell if the object at index of the call is to be yielded, counting it as yielded if so"""
+        if index < self.yielded:
+            # yielded before the page was asked again
+            return False
+        self.yielded += 1
+        return True
+
+    def next_page(self, pagination: dict, latency: float, page_bytes: int) -> int:
+        """Move to the next page once the current one is read, return the page size learned from it"""
+        # a page capped by the server can end before the objects already yielded: go on after them
+        self.page = max(self.page, self.yielded // self.page_size - 1)
+        self.page_count = int(pagination['totalPages'])
+        self._total_count = pagination.get('totalCount')
+        # TODO: remove, hack to adress GnpIS bug, to be fixed in production by January 2019
+        if '/observationUnits' in self.route:
+            self.page = 1000
+        self.page += 1
+        return self.controller.record_page(self.host, self.route, self.page_size, latency, page_bytes)
+
+    def resize(self, next_page_size: int):
+        """Switch to next_page_size where the page boundaries of both sizes meet, if they do"""
+        if next_page_size == self.page_size or not self.has_next():
+            return
+        offset = self.page * self.page_size
+        floor = self.page_size + 1 if next_page_size > self.page_size else self.controller.minimum
+        aligned = aligned_page_size(offset, next_page_size, floor)
+        if aligned:
+            self.page, self.page_size = offset // aligned, aligned
+            self.page_count = -(-int(self._total_count) // aligned) if self._total_count is not None else None
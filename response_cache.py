@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from atomic_file import atomic_write
+
+
+class ResponseCache:
+    """ On-disk cache of BrAPI GET responses, revalidated with If-None-Match / If-Modified-Since
+
+    Only responses carrying an ETag or a Last-Modified header are stored. Each response is written to its own file
+    and atomically renamed into place, so the cache directory can be shared by concurrent processes. The least
+    recently used responses are evicted once the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir: str, logger: logging.Logger, max_size: int = 1024 * 1024 * 1024):
+        """
+        :param cache_dir directory of the cached responses
+        :param logger logger used to report cache hits and evictions
+        :param max_size maximum size in bytes of the cached responses
+        """
+        self.cache_dir = cache_dir
+        self.logger = logger
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        """
+        Cache key of a GET request, made of its URL and query params
+        The pageSize is part of the key, as the objects of a page depend on it: the page sizes of a client using a
+        cache are not adapted to the response times (see PageSizeController adaptive), so a call asks for the same
+        pages on every run.
+        """
+        request = json.dumps([url, sorted((str(k), str(v)) for k, v in (params or {}).items())])
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.resp')
+
+    def get(self, key: str):
+        """Return the cached entry (validators, headers and body) of a key, None if not cached"""
+        try:
+            with open(self._path(key), 'rb') as fh:
+                entry = json.loads(fh.readline().decode('utf-8'))
+                entry['body'] = fh.read()
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        """Headers revalidating a cached entry"""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def hit(self, key: str, entry: dict, url: str) -> requests.Response:
+        """Build the response of a request answered by '304 Not Modified' from its cached entry"""
+        try:
+            # mark the entry as recently used
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        self.logger.debug("304 Not Modified, using cached response of " + url)
+        response = requests.Response()
+        response.status_code = requests.codes.ok
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.url = url
+        response.encoding = entry.get('encoding') or 'utf-8'
+        response._content = entry['body']
+        return response
+
+    def store(self, key: str, response: requests.Response):
+        """Store a 200 response, if it carries an ETag or a Last-Modified validator"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        header = {'etag': etag, 'last_modified': last_modified, 'encoding': response.encoding,
+                  'headers': {'Content-Type': response.headers.get('Content-Type', 'application/json')}}
+        entry = json.dumps(header).encode('utf-8') + b'\n' + response.content
+        path = self._path(key)
+        try:
+            # a response stored again replaces the previous entry of its key
+            replaced_size = os.stat(path).st_size
+        except OSError:
+            replaced_size = 0
+        try:
+            atomic_write(path, entry)
+        except OSError as oserror:
+            self.logger.warning("Could not cache response of " + response.url + ": " + str(oserror))
+            return
+        with self._lock:
+            self._size += len(entry) - replaced_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.resp'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    # removed by a concurrent process
+                    continue
+                yield name, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        """Remove the least recently used responses until the cache is back under 90% of its maximum size"""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        for name, _, size in entries:
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            self._size -= size
+        self.logger.debug("Response cache evicted down to " + str(self._size) + " bytes")
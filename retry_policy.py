@@ -0,0 +1,76 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# statuses of transient server failures, worth sending the same request again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value: str):
+    """Return the delay in seconds requested by a Retry-After header (seconds or HTTP date), None if not parsable"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class RetryPolicy:
+    """ Decide if and when a failed BrAPI request is sent again
+
+    A request is retried at most `retries` times, after a delay drawn uniformly between 0 and
+    backoff * 2 ** attempt seconds (capped to max_backoff), or after the delay requested by the server with a
+    Retry-After header, also capped to max_backoff so that a server asking to come back tomorrow does not stall the
+    conversion. Every host has an error budget: once `error_budget` retries have been spent on a host,
+    its failures are not retried anymore, so that a server that is down fails the conversion quickly.
+    """
+
+    def __init__(self, logger: logging.Logger, retries: int = 5, backoff: float = 1.0, max_backoff: float = 60.0,
+                 error_budget: int = 100):
+        """
+        :param logger logger used to report retries
+        :param retries maximum number of retries of one request (0 to disable retries)
+        :param backoff base delay in seconds of the exponential backoff
+        :param max_backoff maximum delay in seconds between two attempts, Retry-After included
+        :param error_budget maximum number of retries by host
+        """
+        self.logger = logger
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.error_budget = error_budget
+        self._spent = {}
+        self._lock = threading.Lock()
+
+    def delay(self, host: str, attempt: int, retry_after: float = None):
+        """
+        Spend one retry of the error budget of a host
+        :param host host of the failed request
+        :param attempt number of retries of the request already done
+        :param retry_after delay in seconds requested by the server, if any
+        :return the delay in seconds to wait before retrying, None if the request must not be retried
+        """
+        if attempt >= self.retries:
+            return None
+        with self._lock:
+            spent = self._spent.get(host, 0)
+            if spent >= self.error_budget:
+                if spent == self.error_budget:
+                    self.logger.error("Error budget of " + host + " exhausted, failures are not retried anymore")
+                    self._spent[host] = spent + 1
+                return None
+            self._spent[host] = spent + 1
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                self.logger.warning("Retry-After of " + host + " (" + format(retry_after, '.0f') + "s) capped to " +
+                                    format(self.max_backoff, '.0f') + "s")
+                return self.max_backoff
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from typing import List
+
+from atomic_file import atomic_write
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunJournal:
+    """ Journal of the studies and trials completed by a conversion run, to resume an interrupted run
+
+    Every completed study and trial appends one JSON line to journal.jsonl, with the SHA-256 of its output files.
+    The ISA study built for a study is pickled next to the journal, so that the investigation file of a trial can be
+    written again without converting its completed studies. On resume, a study or trial is only considered complete
+    if all its output files are still there and unchanged, otherwise it is converted again.
+    """
+
+    def __init__(self, journal_dir: str, logger: logging.Logger, resume: bool = False):
+        """
+        :param journal_dir directory of the journal and of the pickled studies
+        :param logger logger used to report skipped and invalid work
+        :param resume if True, load the journal of the previous run, otherwise start a new journal
+        """
+        self.journal_dir = journal_dir
+        self.logger = logger
+        self._studies = {}
+        self._trials = {}
+        self._verified = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(journal_dir, 'studies'), exist_ok=True)
+        self.path = os.path.join(journal_dir, 'journal.jsonl')
+        if resume:
+            self._load()
+        else:
+            open(self.path, 'w').close()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a run killed while writing it
+                        continue
+                    if entry.get('stage') == 'study':
+                        self._studies[(entry['output'], entry['study'])] = entry
+                    elif entry.get('stage') == 'trial':
+                        self._trials[entry['output']] = entry
+        except OSError:
+            return
+        self.logger.info("Resuming run journal with " + str(len(self._studies)) + " studies and " +
+                         str(len(self._trials)) + " trials completed")
+
+    def _append(self, entry: dict):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as fh:
+                fh.write(json.dumps(entry) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def _hash_files(self, output_directory: str, file_names: List[str]) -> dict:
+        files = {}
+        for name in file_names:
+            path = os.path.join(output_directory, name)
+            if os.path.exists(path):
+                files[name] = file_sha256(path)
+                self._verified[path] = True
+        return files
+
+    def _files_unchanged(self, output_directory: str, files: dict) -> bool:
+        for name, sha256 in files.items():
+            path = os.path.join(output_directory, name)
+            if path not in self._verified:
+                try:
+                    self._verified[path] = file_sha256(path) == sha256
+                except OSError:
+                    self._verified[path] = False
+                if not self._verified[path]:
+                    self.logger.info(path + " is missing or changed since it was journaled")
+            if not self._verified[path]:
+                return False
+        return True
+
+    def _study_pickle(self, output_directory: str, study_id: str) -> str:
+        key = hashlib.sha1(json.dumps([output_directory, str(study_id)]).encode('utf-8')).hexdigest()
+        return os.path.join(self.journal_dir, 'studies', key + '.pickle')
+
+    def converted_study(self, output_directory: str, study_id: str):
+        """Return the result of convert_study for a study completed by the previous run, None if not completed"""
+        entry = self._studies.get((output_directory, str(study_id)))
+        if entry is None or not self._files_unchanged(output_directory, entry['files']):
+            return None
+        try:
+            with open(self._study_pickle(output_directory, study_id), 'rb') as fh:
+                return pickle.load(fh)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def record_study(self, output_directory: str, study_id: str, file_names: List[str], converted_study):
+        """Record a converted study, its output files and the result of convert_study"""
+        pickle_path = self._study_pickle(output_directory, study_id)
+        # a killed run never leaves a partial pickle
+        atomic_write(pickle_path, pickle.dumps(converted_study, protocol=pickle.HIGHEST_PROTOCOL))
+        entry = {'stage': 'study', 'output': output_directory, 'study': str(study_id),
+                 'files': self._hash_files(output_directory, file_names)}
+        self._append(entry)
+        self._studies[(output_directory, str(study_id))] = entry
+
+    def trial_done(self, output_directory: str, study_ids: List[str]) -> bool:
+        """Tell if a trial and all its studies were completed by the previous run"""
+        entry = self._trials.get(output_directory)
+        if entry is None or entry['studies'] != [str(study_id) for study_id in study_ids]:
+            return False
+        return self._files_unchanged(output_directory, entry['files']) and all(
+            (output_directory, str(study_id)) in self._studies and
+            self._files_unchanged(output_directory, self._studies[(output_directory, str(study_id))]['files'])
+            for study_id in study_ids)
+
+    def record_trial(self, output_directory: str, study_ids: List[str], file_names: List[str]):
+        """Record a converted trial, once its investigation file is written"""
+        entry = {'stage': 'trial', 'output': output_directory, 'studies': [str(study_id) for study_id in study_ids],
+                 'files': self._hash_files(output_directory, file_names)}
+        self._append(entry)
+        self._trials[output_directory] = entry
@@ -0,0 +1,231 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from atomic_file import atomic_write
+from tracing import span
+
+# upper bounds in seconds of the request latency histogram buckets (the last bucket is +Inf)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _RouteMetrics:
+    """ Requests sent to a BrAPI route with a HTTP method
+    """
+    __slots__ = ('count', 'errors', 'statuses', 'latency_sum', 'latency_max', 'buckets', 'bytes', 'retries',
+                 'cache_hits')
+
+    def __init__(self):
+        self.count = 0
+        # requests that got no response (connection error, timeout)
+        self.errors = 0
+        self.statuses = {}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        # number of requests by latency bucket, not cumulative
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes = 0
+        self.retries = 0
+        self.cache_hits = 0
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.buckets):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'errors': self.errors, 'statuses': dict(self.statuses),
+                'latency': {'sum': self.latency_sum, 'max': self.latency_max, 'buckets': buckets},
+                'bytes': self.bytes, 'retries': self.retries, 'cache_hits': self.cache_hits}
+
+    def merge(self, route: dict):
+        """Add the metrics of a route exported by to_dict"""
+        self.count += route['count']
+        self.errors += route['errors']
+        for status, count in route['statuses'].items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.latency_sum += route['latency']['sum']
+        self.latency_max = max(self.latency_max, route['latency']['max'])
+        previous = 0
+        for i, cumulative in enumerate(route['latency']['buckets'].values()):
+            self.buckets[i] += cumulative - previous
+            previous = cumulative
+        self.bytes += route['bytes']
+        self.retries += route['retries']
+        self.cache_hits += route['cache_hits']
+
+
+class RunMetrics:
+    """ Metrics of a conversion run: the requests sent by BrapiClient, by BrAPI route template
+    (ex '/studies/{id}/observationunits'), and the wall time of the conversion stages
+
+    Metrics are recorded from any thread, can be merged from worker processes (see to_dict and merge) and are
+    written at the end of the run as a JSON report, and optionally as a Prometheus textfile.
+    """
+
+    def __init__(self, endpoint: str = None):
+        """
+        :param endpoint BrAPI endpoint of the run, written in the report
+        """
+        self.endpoint = endpoint
+        self.started = datetime.datetime.now()
+        self._start = time.monotonic()
+        self._routes = {}
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def _route(self, method: str, route: str) -> _RouteMetrics:
+        key = (method, route)
+        if key not in self._routes:
+            self._routes[key] = _RouteMetrics()
+        return self._routes[key]
+
+    def record_request(self, method: str, route: str, status: int, latency: float, response_bytes: int = 0):
+        """
+        Record a request
+        :param status HTTP status of the response, None if the request got no response
+        :param latency time in seconds until the response was received
+        :param response_bytes size of the response body
+        """
+        with self._lock:
+            metrics = self._route(method, route)
+            metrics.count += 1
+            if status is None:
+                metrics.errors += 1
+            else:
+                metrics.statuses[str(status)] = metrics.statuses.get(str(status), 0) + 1
+            metrics.latency_sum += latency
+            metrics.latency_max = max(metrics.latency_max, latency)
+            metrics.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+            metrics.bytes += response_bytes
+
+    def record_bytes(self, method: str, route: str, response_bytes: int):
+        """Record the size of a response body read after the request was recorded (streamed pages)"""
+        with self._lock:
+            self._route(method, route).bytes += response_bytes
+
+    def record_cache_hit(self, method: str, route: str):
+        """Record a response served by the response cache once revalidated"""
+        with self._lock:
+            self._route(method, route).cache_hits += 1
+
+    def record_retry(self, method: str, route: str):
+        """Record that a failed request is retried"""
+        with self._lock:
+            self._route(method, route).retries += 1
+
+    def record_stage(self, stage: str, seconds: float):
+        """Add wall time to a conversion stage"""
+        with self._lock:
+            total, count = self._stages.get(stage, (0.0, 0))
+            self._stages[stage] = (total + seconds, count + 1)
+
+    @contextmanager
+    def stage(self, stage: str):
+        """
+        Record the wall time of the enclosed block as a conversion stage (ex 'germplasm', 'data files'),
+        also traced as a span when tracing is enabled
+        """
+        start = time.monotonic()
+        try:
+            with span(stage, 'stage'):
+                yield
+        finally:
+            self.record_stage(stage, time.monotonic() - start)
+
+    def to_dict(self) -> dict:
+        """Metrics as a JSON serializable dict"""
+        with self._lock:
+            return {
+                'endpoint': self.endpoint,
+                'started': self.started.isoformat(timespec='seconds'),
+                'wall_time': time.monotonic() - self._start,
+                'stages': {stage: {'seconds': seconds, 'count': count}
+                           for stage, (seconds, count) in self._stages.items()},
+                'requests': [dict(method=method, route=route, **metrics.to_dict())
+                             for (method, route), metrics in sorted(self._routes.items())],
+            }
+
+    def merge(self, metrics: dict):
+        """Add the requests and stages of metrics exported by to_dict (ex by a worker process)"""
+        with self._lock:
+            for stage, stage_metrics in metrics['stages'].items():
+                total, count = self._stages.get(stage, (0.0, 0))
+                self._stages[stage] = (total + stage_metrics['seconds'], count + stage_metrics['count'])
+            for route in metrics['requests']:
+                self._route(route['method'], route['route']).merge(route)
+
+    def reset(self):
+        """Forget the recorded requests and stages (ex once sent to the parent process)"""
+        with self._lock:
+            self._routes = {}
+            self._stages = {}
+
+    def write_json(self, path: str, logger: logging.Logger = None):
+        """Write the metrics as a JSON report"""
+        _write_atomically(path, json.dumps(self.to_dict(), indent=2), logger)
+
+    def write_prometheus(self, path: str, logger: logging.Logger = None):
+        """Write the metrics in the Prometheus text format, for the textfile collector of the node exporter"""
+        _write_atomically(path, prometheus_text(self.to_dict()), logger)
+
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(name + '="' + _label_value(value) + '"' for name, value in labels.items()) + '}'
+
+
+def prometheus_text(metrics: dict) -> str:
+    """Prometheus text exposition of metrics exported by RunMetrics.to_dict"""
+    lines = []
+
+    def family(name, metric_type, help_text, samples):
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+        lines.extend(samples)
+
+    requests = metrics['requests']
+    family('brapi_requests_total', 'counter', 'BrAPI requests by route, method and response status',
+           ['brapi_requests_total' + _labels(method=r['method'], route=r['route'], status=status) + ' ' + str(count)
+            for r in requests for status, count in sorted(r['statuses'].items())] +
+           ['brapi_requests_total' + _labels(method=r['method'], route=r['route'], status='error') + ' ' +
+            str(r['errors']) for r in requests if r['errors']])
+    histogram = []
+    for r in requests:
+        for bound, count in r['latency']['buckets'].items():
+            histogram.append('brapi_request_duration_seconds_bucket' +
+                             _labels(method=r['method'], route=r['route'], le=bound) + ' ' + str(count))
+        histogram.append('brapi_request_duration_seconds_sum' + _labels(method=r['method'], route=r['route']) + ' ' +
+                         repr(r['latency']['sum']))
+        histogram.append('brapi_request_duration_seconds_count' + _labels(method=r['method'], route=r['route']) +
+                         ' ' + str(r['count']))
+    family('brapi_request_duration_seconds', 'histogram', 'Latency of the BrAPI requests', histogram)
+    for name, key, help_text in (('brapi_response_bytes_total', 'bytes', 'Bytes of the BrAPI response bodies'),
+                                 ('brapi_request_retries_total', 'retries', 'Retries of failed BrAPI requests'),
+                                 ('brapi_cache_hits_total', 'cache_hits', 'BrAPI responses served by the cache')):
+        family(name, 'counter', help_text, [name + _labels(method=r['method'], route=r['route']) + ' ' + str(r[key])
+                                            for r in requests])
+    family('brapi_stage_duration_seconds', 'gauge', 'Wall time of the conversion stages',
+           ['brapi_stage_duration_seconds' + _labels(stage=stage) + ' ' + repr(stage_metrics['seconds'])
+            for stage, stage_metrics in sorted(metrics['stages'].items())])
+    family('brapi_run_duration_seconds', 'gauge', 'Wall time of the conversion run',
+           ['brapi_run_duration_seconds' + _labels(endpoint=metrics['endpoint'] or '') + ' ' +
+            repr(metrics['wall_time'])])
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomically(path: str, text: str, logger: logging.Logger = None):
+    # a collector never reads a partial file
+    try:
+        atomic_write(path, text)
+    except OSError as oserror:
+        if logger is None:
+            raise
+        logger.warning("Could not write metrics to " + path + ": " + str(oserror))
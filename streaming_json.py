@@ -0,0 +1,93 @@
+from typing import AsyncIterator, Iterator
+
+import ijson
+import requests
+from ijson import JSONError
+
+# JSONError is raised by the parsers, exported for the clients to catch it along with their connection errors
+__all__ = ['AsyncResponseStream', 'JSONError', 'ResponseStream', 'aiter_result_data', 'iter_result_data']
+
+# ijson parsing events of scalar values
+_SCALAR_EVENTS = ('null', 'boolean', 'integer', 'double', 'number', 'string')
+
+
+class ResponseStream:
+    """ File-like view of the body of a streamed response, for ijson, counting the bytes read
+    """
+
+    def __init__(self, r: requests.Response, chunk_size: int = 64 * 1024):
+        # iter_content decodes gzip and raises requests exceptions on broken connections
+        self._chunks = r.iter_content(chunk_size)
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            # ijson reads nothing first, to tell bytes from str streams
+            return b''
+        chunk = next(self._chunks, b'')
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+class AsyncResponseStream:
+    """ File-like view of the body of an aiohttp response, for ijson, counting the bytes read
+    """
+
+    def __init__(self, r, chunk_size: int = 64 * 1024):
+        self._content = r.content
+        self._chunk_size = chunk_size
+        self.bytes_read = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return b''
+        chunk = await self._content.read(self._chunk_size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+class _ResultData:
+    """Objects of result.data built from the ijson parsing events of a BrAPI response body"""
+
+    def __init__(self, pagination: dict):
+        self.pagination = pagination
+        self._builder = None
+
+    def event(self, prefix: str, event: str, value) -> tuple:
+        """Consume a parsing event, return (True, object) once an object of result.data is parsed, else (False, None)"""
+        if self._builder is not None:
+            self._builder.event(event, value)
+            if prefix == 'result.data.item' and event in ('end_map', 'end_array'):
+                obj, self._builder = self._builder.value, None
+                return True, obj
+        elif prefix == 'result.data.item':
+            if event not in ('start_map', 'start_array'):
+                return True, value
+            self._builder = ijson.ObjectBuilder()
+            self._builder.event(event, value)
+        elif prefix.startswith('metadata.pagination.') and event in _SCALAR_EVENTS:
+            self.pagination[prefix[len('metadata.pagination.'):]] = value
+        return False, None
+
+
+def iter_result_data(stream, pagination: dict) -> Iterator:
+    """
+    Parse a BrAPI response body incrementally, yielding the objects of result.data as soon as each one is parsed
+    Only one object of the page is held in memory at a time.
+    :param stream file-like object of the response body (see ResponseStream)
+    :param pagination dict filled with metadata.pagination, whether it comes before or after result.data
+    """
+    result_data = _ResultData(pagination)
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        parsed, obj = result_data.event(prefix, event, value)
+        if parsed:
+            yield obj
+
+
+async def aiter_result_data(stream, pagination: dict) -> AsyncIterator:
+    """Parse a BrAPI response body incrementally (see iter_result_data) from an async stream (see AsyncResponseStream)"""
+    result_data = _ResultData(pagination)
+    async for prefix, event, value in ijson.parse_async(stream, use_float=True):
+        parsed, obj = result_data.event(prefix, event, value)
+        if parsed:
+            yield obj
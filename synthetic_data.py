@@ -0,0 +1,90 @@
+"""
+Synthetic BrAPI v1 data of any size, shaped like the objects of mock_data
+
+Every generator is deterministic (same arguments, same objects), so benchmarks of different commits and the stand-in
+server (see brapi_stub_server) work on the same data.
+"""
+import copy
+
+import mock_data
+
+LEVELS = ('plot', 'plant')
+
+
+def trial(trial_id: str, study_ids: list) -> dict:
+    """Trial listing its studies"""
+    return {"trialDbId": trial_id, "trialName": "Trial " + trial_id, "trialType": "Project",
+            "studies": [{"studyDbId": study_id, "studyName": "Study " + study_id} for study_id in study_ids]}
+
+
+def study(study_id: str) -> dict:
+    """Study as returned by /studies/{id}, whose id is prefixed by the id of its trial (ex '1-2')"""
+    return dict(mock_data.mock_study, studyDbId=study_id, studyName="Study " + study_id,
+                trialDbId=study_id.split('-')[0])
+
+
+def germplasm(i: int) -> dict:
+    """Germplasm as listed by /studies/{id}/germplasm"""
+    return dict(mock_data.mock_germplasms[0], germplasmDbId=str(i), germplasmName="Name" + format(i, '06d'),
+                accessionNumber="accession" + str(i))
+
+
+def germplasm_details(i: int) -> dict:
+    """Germplasm as returned by /germplasm/{id}, with the attributes mapped to ISA characteristics"""
+    return dict(germplasm(i), genus="Zea", species="mays", subtaxa="subtaxa " + str(i % 10),
+                commonCropName="maize", countryOfOriginCode="PER", biologicalStatusOfAccessionCode=str(300 + i % 5),
+                synonyms=["synonym " + str(i), "alias " + str(i)],
+                taxonIds=[{"sourceName": "NCBI", "taxonId": "4577"}, {"sourceName": "GRIN", "taxonId": str(i % 50)}],
+                donors=[{"donorInstituteCode": "INST" + str(i % 20), "donorAccessionNumber": "D" + str(i)}])
+
+
+def germplasms(count: int) -> list:
+    """(germplasm, germplasm details) of `count` germplasms"""
+    return [(germplasm(i), germplasm_details(i)) for i in range(count)]
+
+
+def variable(i: int) -> dict:
+    """Observation variable, numerical or categorical in turn"""
+    obs_var = copy.deepcopy(mock_data.mock_variables[i % 2])
+    obs_var['observationVariableDbId'] = "MO_123:" + str(100000 + i)
+    obs_var['name'] = obs_var['observationVariableName'] = "Variable " + format(i, '05d')
+    return obs_var
+
+
+def variables(count: int) -> list:
+    """`count` observation variables"""
+    return [variable(i) for i in range(count)]
+
+
+def observation_unit(i: int, obs_variables: list, germplasm_count: int, observations: int) -> dict:
+    """Observation unit of a plot or plant, with `observations` observations of the variables in turn"""
+    germ = germplasm(i % germplasm_count)
+    level = LEVELS[i % len(LEVELS)]
+    observation_template = mock_data.mock_observation_units[0]['observations'][0]
+    return {
+        "observationUnitDbId": str(i),
+        "observationUnitName": level + " " + str(i),
+        "observationUnitXref": [{"source": "biosamples", "id": "SAMEA" + str(i)}],
+        "germplasmDbId": germ['germplasmDbId'],
+        "germplasmName": germ['germplasmName'],
+        "observationLevel": level,
+        "observationLevels": "block:" + str(i % 10) + ",plot:" + str(i // len(LEVELS)),
+        "X": str(i % 100),
+        "Y": str(i // 100),
+        "blockNumber": str(i % 10),
+        "plotNumber": str(i // len(LEVELS)),
+        "treatments": [{"watering": "WW" if i % 3 else "WD"}],
+        "observations": [dict(observation_template,
+                              observationVariableDbId=obs_variables[(i + j) % len(obs_variables)][
+                                  'observationVariableDbId'],
+                              observationVariableName=obs_variables[(i + j) % len(obs_variables)]['name'],
+                              observationTimeStamp="2019-06-" + format(1 + j % 28, '02d') + "T10:00:00Z",
+                              season="2019",
+                              value=str((i * 7 + j) % 997 / 10))
+                         for j in range(observations)]
+    }
+
+
+def observation_units(count: int, obs_variables: list, germplasm_count: int, observations: int = 10) -> list:
+    """`count` observation units spread over the LEVELS, each with `observations` observations"""
+    return [observation_unit(i, obs_variables, germplasm_count, observations) for i in range(count)]
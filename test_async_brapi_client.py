@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import brapi_calls
+import mock_data
+from async_brapi_client import AsyncBrapiClient
+from brapi_client import BrapiClient
+from brapi_stub_server import BrapiStubServer
+from page_size_controller import PageSizeController
+from retry_policy import RetryPolicy
+from run_metrics import RunMetrics
+
+logger = logging.getLogger()
+
+
+class AsyncBrapiClientTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        brapi_calls._calls_by_endpoint.clear()
+        self.requested_pages = []
+        self.failed_requests = 0
+        self.objects = [{'studyDbId': str(i)} for i in range(10)]
+
+        async def studies(request):
+            page = int(request.query['page'])
+            self.requested_pages.append(page)
+            return web.json_response(mock_data.mock_brapi_results(self.objects[page*2:page*2+2], 5,
+                                                                  len(self.objects), page))
+
+        async def study(request):
+            return web.json_response(mock_data.mock_brapi_result(mock_data.mock_study))
+
+        async def failing_study(request):
+            self.failed_requests += 1
+            return web.Response(status=500)
+
+        app = web.Application()
+        app.router.add_get('/brapi/v1/studies', studies)
+        app.router.add_get('/brapi/v1/studies/1001', study)
+        app.router.add_get('/brapi/v1/studies/fail', failing_study)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.client = AsyncBrapiClient(str(self.server.make_url('/brapi/v1/')), logger, concurrency=3,
+                                       retry_policy=RetryPolicy(logger, retries=2, backoff=0))
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def test_get_study(self):
+        # Call
+        actual_study = await self.client.get_study('1001')
+
+        # Assert
+        assert actual_study == mock_data.mock_study
+        with self.assertRaises(RuntimeError):
+            await self.client.get_study('fail')
+        assert self.failed_requests == 1 + 2
+
+    async def test_fetch_objects_prefetch(self):
+        # Call
+        actual_results = [obj async for obj in self.client.fetch_objects('GET', '/studies', prefetch_pages=3)]
+
+        # Assert objects are yielded in server order and each page is fetched once
+        assert actual_results == self.objects
+        assert sorted(self.requested_pages) == list(range(5))
+
+    async def test_fetch_objects_page_size(self):
+        """Test pages timing out are asked again with smaller pages, streamed or not, as BrapiClient does"""
+        with BrapiStubServer(observation_units=500, timeout_page_size=200) as server:
+            sync_metrics = RunMetrics(server.endpoint)
+            sync_client = BrapiClient(server.endpoint, logger, metrics=sync_metrics,
+                                      retry_policy=RetryPolicy(logger, retries=0),
+                                      page_size_controller=PageSizeController(logger, initial=400, minimum=100))
+            with sync_client:
+                assert len(list(sync_client.fetch_objects('GET', '/studies/1-1/observationunits'))) == 500
+            sync_requests = {r['route']: r for r in sync_metrics.to_dict()['requests']}
+            assert sync_requests['/studies/{id}/observationunits']['statuses']['504'] > 0
+
+            for stream_pages in (False, True):
+                controller = PageSizeController(logger, initial=400, minimum=100)
+                metrics = RunMetrics(server.endpoint)
+                async with AsyncBrapiClient(server.endpoint, logger, page_size_controller=controller,
+                                            stream_pages=stream_pages, metrics=metrics,
+                                            retry_policy=RetryPolicy(logger, retries=0)) as client:
+                    units = [unit async for unit in client.fetch_objects('GET', '/studies/1-1/observationunits')]
+
+                assert len(units) == len({unit['observationUnitDbId'] for unit in units}) == 500
+                # the same pages asked as by BrapiClient
+                requests = {r['route']: r for r in metrics.to_dict()['requests']}
+                assert requests['/studies/{id}/observationunits']['statuses'] == \
+                    sync_requests['/studies/{id}/observationunits']['statuses']
+                assert requests['/studies/{id}/observationunits']['bytes'] > 0
+
+    async def test_calls_discovered_concurrently(self):
+        """Test /calls is fetched once when the calls are asked by concurrent tasks"""
+        with BrapiStubServer(latency={'/calls': 0.2}) as server:
+            async with AsyncBrapiClient(server.endpoint, logger) as client:
+                calls = await asyncio.gather(*(client.get_calls() for _ in range(5)))
+            assert all(call is calls[0] for call in calls)
+            assert server.requests['/calls'] == 1
+
+    async def test_get_germplasms_by_ids_search(self):
+        """Test germplasms are searched by batch when the endpoint supports germplasm-search"""
+        germplasm_ids = ['3', '1', '3', '2']
+        for germplasm_search in (True, False):
+            brapi_calls._calls_by_endpoint.clear()
+            with BrapiStubServer(germplasms=5, germplasm_search=germplasm_search) as server:
+                async with AsyncBrapiClient(server.endpoint, logger) as client:
+                    germplasms = await client.get_germplasms_by_ids(germplasm_ids)
+                assert [germplasm['germplasmDbId'] for germplasm in germplasms] == germplasm_ids
+                if germplasm_search:
+                    assert server.requests['/germplasm-search'] == 1
+                    assert server.requests['/germplasm/{id}'] == 0
+                else:
+                    assert server.requests['/germplasm/{id}'] == len(germplasm_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
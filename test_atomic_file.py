@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+import mock
+
+from atomic_file import atomic_write
+
+
+class AtomicWriteTest(unittest.TestCase):
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache', 'file.json')
+            atomic_write(path, '{"é": 1}')
+            with open(path, encoding='utf-8') as fh:
+                assert fh.read() == '{"é": 1}'
+            atomic_write(path, b'\x00\x01')
+            with open(path, 'rb') as fh:
+                assert fh.read() == b'\x00\x01'
+            assert os.listdir(os.path.dirname(path)) == ['file.json']
+
+    def test_failed_write_removes_temporary_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'file.json')
+            atomic_write(path, 'previous')
+            with mock.patch('os.replace', side_effect=OSError("disk full")):
+                with self.assertRaises(OSError):
+                    atomic_write(path, 'next')
+            with self.assertRaises(TypeError):
+                atomic_write(path, None)
+            assert os.listdir(directory) == ['file.json']
+            with open(path, encoding='utf-8') as fh:
+                assert fh.read() == 'previous'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,25 @@
+import io
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+import mock
+import requests
 import requests_mock
+import urllib3
 
+import brapi_calls
 import mock_data
-from brapi_client import BrapiClient
+from brapi_client import BrapiClient, create_session, iter_result_data
+from brapi_stub_server import BrapiStubServer
+from json_backend import JSON_BACKEND
+from page_size_controller import PageSizeController
+from retry_policy import RetryPolicy
+from response_cache import ResponseCache
 
 logger = logging.getLogger()
 
@@ -13,6 +28,8 @@ class BrapiClientTest(unittest.TestCase):
 
     def setUp(self):
         self.endpoint = 'http://foo/'
+        # forget the calls discovered by previous tests
+        brapi_calls._calls_by_endpoint.clear()
 
     @requests_mock.Mocker()
     def test_get_trial_fail_on_second_page(self, mock_requests):
@@ -30,10 +47,10 @@ class BrapiClientTest(unittest.TestCase):
         )
 
         # Init
-        client = BrapiClient(self.endpoint, logger)
+        client = BrapiClient(self.endpoint, logger, retry_policy=RetryPolicy(logger, retries=0))
 
         # Call
-        trial_it = iter(client.get_trials())
+        trial_it = iter(client.get_trials(['all']))
 
         # Assert first page can be fetched
         for i in range(total_count-1):
@@ -45,13 +62,19 @@ class BrapiClientTest(unittest.TestCase):
         # Assert same request executed twice (for each page)
         assert req.call_count == 2
 
+    def test_get_trials_without_ids(self):
+        client = BrapiClient(self.endpoint, logger)
+
+        # Call / Assert
+        self.assertRaises(ValueError, list, client.get_trials())
+
     @requests_mock.Mocker()
     def test_get_study_fail(self, mock_requests):
         # Mock
         mock_requests.get(requests_mock.ANY, status_code=500)
 
         # Init
-        client = BrapiClient(self.endpoint, logger)
+        client = BrapiClient(self.endpoint, logger, retry_policy=RetryPolicy(logger, retries=0))
 
         # Call / Assert
         self.assertRaises(RuntimeError, client.get_study, 'bar')
@@ -87,6 +110,354 @@ class BrapiClientTest(unittest.TestCase):
         assert len(actual_results) == 1
         assert actual_results[0] == mock_data.mock_study
 
+    @requests_mock.Mocker()
+    def test_shared_session(self, mock_requests):
+        # Mock
+        result = mock_data.mock_brapi_result(mock_data.mock_study)
+        mock_requests.get(requests_mock.ANY, json=result)
+
+        # Init
+        session = create_session(pool_size=2, headers={'Authorization': 'Bearer token'})
+        client1 = BrapiClient(self.endpoint, logger, session=session)
+        client2 = BrapiClient(self.endpoint, logger, session=session)
+
+        # Call
+        client1.get_study('bar')
+        client2.get_study('bar')
+
+        # Assert both clients use the same pooled session and its default headers
+        assert client1.session is client2.session
+        assert mock_requests.call_count == 2
+        assert mock_requests.last_request.headers['Authorization'] == 'Bearer token'
+        assert mock_requests.last_request.headers['Accept'] == 'application/json'
+
+    @requests_mock.Mocker()
+    def test_fetch_objects_prefetch(self, mock_requests):
+        # Mock 5 pages of 2 objects
+        total_pages = 5
+        objects = [{'studyDbId': str(i)} for i in range(total_pages * 2)]
+
+        def page_callback(request, context):
+            page = int(request.qs['page'][0])
+            return mock_data.mock_brapi_results(objects[page*2:page*2+2], total_pages, len(objects), page)
+        mock_requests.get(requests_mock.ANY, json=page_callback)
+
+        # Init
+        client = BrapiClient(self.endpoint, logger, prefetch_pages=3)
+
+        # Call
+        actual_results = list(client.fetch_objects('GET', '/studies'))
+
+        # Assert objects are yielded in server order and each page is fetched once
+        assert actual_results == objects
+        assert mock_requests.call_count == total_pages
+        pages = sorted(int(request.qs['page'][0]) for request in mock_requests.request_history)
+        assert pages == list(range(total_pages))
+
+    @requests_mock.Mocker()
+    def test_fetch_objects_adaptive_page_size(self, mock_requests):
+        # Mock 10 objects, the server times out on pages of more than 2 objects
+        objects = [{'studyDbId': str(i)} for i in range(10)]
+
+        def page_callback(request, context):
+            page, page_size = int(request.qs['page'][0]), int(request.qs['pagesize'][0])
+            if page_size > 2:
+                context.status_code = 504
+                return None
+            return mock_data.mock_brapi_results(objects[page*page_size:(page+1)*page_size], 5, len(objects), page)
+        mock_requests.get(requests_mock.ANY, json=page_callback)
+
+        # Init
+        client = BrapiClient(self.endpoint, logger,
+                             page_size_controller=PageSizeController(logger, initial=8, minimum=1, increase=0))
+
+        # Call
+        actual_results = list(client.fetch_objects('GET', '/studies'))
+        request_count = mock_requests.call_count
+        list(client.fetch_objects('GET', '/studies'))
+
+        # Assert the page size is halved on 504 without losing objects, and reused by the next call
+        assert actual_results == objects
+        assert request_count == 2 + 5
+        assert mock_requests.call_count == request_count + 5
+
+    @requests_mock.Mocker()
+    def test_fetch_objects_server_error_page_size(self, mock_requests):
+        # Mock 3 pages of 4 objects, the second page fails once with a 503
+        objects = [{'studyDbId': str(i)} for i in range(12)]
+        failures = [503]
+
+        def page_callback(request, context):
+            page, page_size = int(request.qs['page'][0]), int(request.qs['pagesize'][0])
+            if page == 1 and failures:
+                context.status_code = failures.pop()
+                context.headers['Retry-After'] = '0'
+                return None
+            return mock_data.mock_brapi_results(objects[page*page_size:(page+1)*page_size], 3, len(objects), page)
+        mock_requests.get(requests_mock.ANY, json=page_callback)
+
+        # Init
+        client = BrapiClient(self.endpoint, logger, retry_policy=RetryPolicy(logger, backoff=0),
+                             page_size_controller=PageSizeController(logger, initial=4, minimum=1, increase=0))
+
+        # Call
+        actual_results = list(client.fetch_objects('GET', '/studies'))
+
+        # Assert only a 504 makes the failed page asked again with smaller pages
+        assert actual_results == objects
+        assert [request.qs['pagesize'] for request in mock_requests.request_history] == [['4']] * 4
+
+    @requests_mock.Mocker()
+    def test_fetch_objects_retry(self, mock_requests):
+        # Mock 3 pages of 2 objects, the second page fails twice before succeeding
+        objects = [{'studyDbId': str(i)} for i in range(6)]
+        failures = [{'status_code': 503, 'headers': {'Retry-After': '0'}}, {'exc': requests.exceptions.ConnectionError}]
+
+        def page_callback(request, context):
+            page = int(request.qs['page'][0])
+            return mock_data.mock_brapi_results(objects[page*2:page*2+2], 3, len(objects), page)
+
+        def failing_page_callback(request, context):
+            failure = failures.pop(0) if failures else {}
+            if 'exc' in failure:
+                raise failure['exc']
+            context.status_code = failure.get('status_code', 200)
+            context.headers.update(failure.get('headers', {}))
+            return page_callback(request, context)
+        mock_requests.get(requests_mock.ANY, json=page_callback)
+        mock_requests.get(self.endpoint + 'studies?page=1', json=failing_page_callback)
+
+        # Init
+        client = BrapiClient(self.endpoint, logger, retry_policy=RetryPolicy(logger, backoff=0, error_budget=2),
+                             page_size_controller=PageSizeController(logger, initial=2, increase=0))
+
+        # Call
+        actual_results = list(client.fetch_objects('GET', '/studies'))
+
+        # Assert the failed page is retried without yielding the previous objects again
+        assert actual_results == objects
+        assert mock_requests.call_count == 3 + 2
+
+        # Assert failures are not retried anymore once the error budget of the host is spent
+        failures.append({'status_code': 503})
+        self.assertRaises(RuntimeError, list, client.fetch_objects('GET', '/studies'))
+
+    def test_retry_after_capped(self):
+        # a server asking to retry in a day is retried after max_backoff
+        policy = RetryPolicy(logger, max_backoff=0.05)
+        assert policy.delay('foo', 0, 86400) == 0.05
+        assert policy.delay('foo', 0, 0.01) == 0.01
+
+        with BrapiStubServer(observation_units=100, error_rates={'/germplasm/{id}': 0.5}, retry_after=86400,
+                             seed=1) as server:
+            client = BrapiClient(server.endpoint, logger, retry_policy=RetryPolicy(logger, retries=20, max_backoff=0.05))
+            with mock.patch('time.sleep') as sleep:
+                for germplasm_id in ('1', '2', '3', '4'):
+                    assert client.get_germplasm(germplasm_id)['germplasmDbId'] == germplasm_id
+            assert server.failures['/germplasm/{id}'] > 0
+            assert [call[0][0] for call in sleep.call_args_list if call[0][0] > 0] == \
+                   [0.05] * server.failures['/germplasm/{id}']
+
+    @requests_mock.Mocker()
+    def test_fetch_objects_json_backends(self, mock_requests):
+        # Mock
+        objects = [{'studyDbId': str(i), 'studyName': 'Étude ' + str(i)} for i in range(3)]
+        mock_requests.get(requests_mock.ANY, json=mock_data.mock_brapi_results(objects))
+
+        for backend in ('json', JSON_BACKEND):
+            # Init
+            client = BrapiClient(self.endpoint, logger, json_backend=backend)
+
+            # Call
+            with mock.patch.object(requests.Response, 'json', side_effect=AssertionError("decoded twice")):
+                actual_results = list(client.fetch_objects('GET', '/studies'))
+
+            # Assert each page is decoded once, with the chosen backend
+            assert client.json_backend == backend
+            assert actual_results == objects
+
+    @unittest.skipIf(iter_result_data is None, "ijson is not installed")
+    @requests_mock.Mocker()
+    def test_fetch_objects_streamed(self, mock_requests):
+        # Mock 2 pages of 3 objects, the connection of the first page breaks in the middle of its body once
+        objects = [{'studyDbId': str(i), 'observations': [{'value': i / 2}], 'name': None} for i in range(6)]
+        pages = [json.dumps(mock_data.mock_brapi_results(objects[page*3:page*3+3], 2, len(objects), page)).encode()
+                 for page in range(2)]
+
+        class BrokenBody(io.BytesIO):
+            def read(self, *args, **kwargs):
+                if self.tell() > len(self.getvalue()) / 2:
+                    raise urllib3.exceptions.ProtocolError("Connection broken")
+                return super().read(*args, **kwargs)
+        mock_requests.get(self.endpoint + 'studies?page=0', [{'body': BrokenBody(pages[0])}, {'content': pages[0]}])
+        mock_requests.get(self.endpoint + 'studies?page=1', content=pages[1])
+
+        # Init
+        client = BrapiClient(self.endpoint, logger, stream_pages=True,
+                             retry_policy=RetryPolicy(logger, backoff=0),
+                             page_size_controller=PageSizeController(logger, initial=3, increase=0))
+
+        # Call
+        actual_results = list(client.fetch_objects('GET', '/studies'))
+
+        # Assert objects parsed before the connection broke are not yielded again
+        assert actual_results == objects
+        assert mock_requests.call_count == 3
+
+    @requests_mock.Mocker()
+    def test_get_germplasms_by_ids(self, mock_requests):
+        # Mock
+        germplasms = {germplasm['germplasmDbId']: germplasm for germplasm in mock_data.mock_germplasms}
+
+        def germplasm_callback(request, context):
+            return mock_data.mock_brapi_result(germplasms[request.path.split('/')[-1]])
+        mock_requests.get(requests_mock.ANY, json=germplasm_callback)
+        mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results([]))
+
+        # Init
+        client = BrapiClient(self.endpoint, logger, lookup_workers=2)
+
+        # Call
+        germplasm_ids = ['2', '1', '2']
+        actual_results = list(client.get_germplasms_by_ids(germplasm_ids))
+
+        # Assert details are returned in the order of the ids
+        assert [germplasm['germplasmDbId'] for germplasm in actual_results] == germplasm_ids
+        assert mock_requests.call_count == len(germplasm_ids) + 1
+
+    @requests_mock.Mocker()
+    def test_get_germplasms_by_ids_search(self, mock_requests):
+        # Mock
+        calls = [{'call': 'germplasm-search', 'methods': ['GET', 'POST']}]
+        mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results(calls))
+        search = mock_requests.post(self.endpoint + 'germplasm-search',
+                                    json=mock_data.mock_brapi_results(mock_data.mock_germplasms))
+
+        # Init
+        client = BrapiClient(self.endpoint, logger)
+
+        # Call
+        actual_results = list(client.get_germplasms_by_ids(['2', '1']))
+
+        # Assert all germplasms were searched at once and returned in the order of the ids
+        assert [germplasm['germplasmDbId'] for germplasm in actual_results] == ['2', '1']
+        assert search.call_count == 1
+        assert sorted(search.last_request.json()['germplasmDbIds']) == ['1', '2']
+
+    @requests_mock.Mocker()
+    def test_calls_discovered_once(self, mock_requests):
+        # Mock
+        calls = [{'call': 'studies/{studyDbId}/observationUnits', 'methods': ['GET']}]
+        calls_request = mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results(calls))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Call
+            client1 = BrapiClient(self.endpoint, logger, calls_cache_dir=cache_dir)
+            client2 = BrapiClient(self.endpoint, logger, calls_cache_dir=cache_dir)
+
+            # Assert /calls is fetched once for every call variant and client
+            assert client1._get_obs_unit_call() == 'observationUnits'
+            assert client1._get_obs_var_call() == 'observationvariables'
+            assert client2._get_obs_unit_call() == 'observationUnits'
+            assert calls_request.call_count == 1
+
+            # Assert a later run reuses the persisted result
+            brapi_calls._calls_by_endpoint.clear()
+            client3 = BrapiClient(self.endpoint, logger, calls_cache_dir=cache_dir)
+            assert client3._get_obs_unit_call() == 'observationUnits'
+            assert calls_request.call_count == 1
+            assert len(os.listdir(cache_dir)) == 1
+
+    @requests_mock.Mocker()
+    def test_calls_discovered_again_after_ttl(self, mock_requests):
+        # Mock
+        calls_request = mock_requests.get(self.endpoint + 'calls', json=mock_data.mock_brapi_results([]))
+
+        with mock.patch('brapi_calls.time') as clock:
+            # Call
+            clock.time.return_value = 1000.0
+            BrapiClient(self.endpoint, logger, calls_cache_ttl=60).get_calls()
+            clock.time.return_value = 1060.0
+            BrapiClient(self.endpoint, logger, calls_cache_ttl=60).get_calls()
+
+            # Assert the calls shared by the clients of the process expire like the persisted ones
+            assert calls_request.call_count == 1
+            clock.time.return_value = 1061.0
+            BrapiClient(self.endpoint, logger, calls_cache_ttl=60).get_calls()
+            assert calls_request.call_count == 2
+
+    def test_calls_discovered_concurrently(self):
+        """Test /calls is fetched once by endpoint, and a slow endpoint does not hold the clients of another one"""
+        with BrapiStubServer(latency={'/calls': 1.0}) as slow_server, BrapiStubServer() as server:
+            calls = []
+            threads = [threading.Thread(
+                target=lambda: calls.append(BrapiClient(slow_server.endpoint, logger).get_calls())) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+
+            start = time.monotonic()
+            assert len(BrapiClient(server.endpoint, logger).get_calls()) > 0
+            assert time.monotonic() - start < 0.5
+            for thread in threads:
+                thread.join()
+            assert len(calls) == 3 and calls[0] is calls[1] is calls[2]
+            assert slow_server.requests['/calls'] == 1
+
+    @requests_mock.Mocker()
+    def test_response_cache_revalidation(self, mock_requests):
+        # Mock first response with an ETag, then '304 Not Modified'
+        result = mock_data.mock_brapi_result(mock_data.mock_study)
+        req = mock_requests.get(requests_mock.ANY, [{'json': result, 'headers': {'ETag': '"v1"'}},
+                                                    {'status_code': 304}])
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Init
+            client = BrapiClient(self.endpoint, logger, response_cache=ResponseCache(cache_dir, logger))
+
+            # Call
+            first_study = client.get_study('1001')
+            second_study = client.get_study('1001')
+
+            # Assert the second request is revalidated and served from the cache
+            assert first_study == second_study == mock_data.mock_study
+            assert req.call_count == 2
+            assert 'If-None-Match' not in req.request_history[0].headers
+            assert req.request_history[1].headers['If-None-Match'] == '"v1"'
+
+    @requests_mock.Mocker()
+    def test_response_cache_page_size(self, mock_requests):
+        # Mock 10 objects, every page with an ETag and revalidated with '304 Not Modified'
+        objects = [{'studyDbId': str(i)} for i in range(10)]
+        statuses = []
+
+        def page_callback(request, context):
+            page, page_size = int(request.qs['page'][0]), int(request.qs['pagesize'][0])
+            etag = '"' + str(page) + '-' + str(page_size) + '"'
+            not_modified = request.headers.get('If-None-Match') == etag
+            statuses.append(304 if not_modified else 200)
+            if not_modified:
+                context.status_code = 304
+                return None
+            context.headers['ETag'] = etag
+            return mock_data.mock_brapi_results(objects[page*page_size:(page+1)*page_size], -(-10 // page_size),
+                                                len(objects), page, page_size)
+        req = mock_requests.get(requests_mock.ANY, json=page_callback)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            assert not BrapiClient(self.endpoint, logger,
+                                   response_cache=ResponseCache(cache_dir, logger)).page_size_controller.adaptive
+            # Call: two runs, the fast pages would make an adaptive controller grow the page size
+            for _ in range(2):
+                client = BrapiClient(self.endpoint, logger, response_cache=ResponseCache(cache_dir, logger),
+                                     page_size_controller=PageSizeController(logger, initial=2, increase=2,
+                                                                             adaptive=False))
+                assert list(client.fetch_objects('GET', '/studies')) == objects
+
+        # Assert the same pages are asked by both runs, and the second run is served from the cache
+        assert [request.qs['pagesize'] for request in req.request_history] == [['2']] * 10
+        assert statuses == [200] * 5 + [304] * 5
+
 
 if __name__ == '__main__':
     unittest.main()
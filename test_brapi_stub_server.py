@@ -0,0 +1,92 @@
+import logging
+import unittest
+
+import requests
+
+import brapi_calls
+from brapi_client import BrapiClient, iter_result_data
+from brapi_stub_server import BrapiStubServer
+from page_size_controller import PageSizeController
+from retry_policy import RetryPolicy
+
+logger = logging.getLogger('brapi_stub_server_test')
+
+
+class BrapiStubServerTest(unittest.TestCase):
+
+    def setUp(self):
+        # forget the calls discovered by previous tests (a port can be reused)
+        brapi_calls._calls_by_endpoint.clear()
+
+    def client(self, server, **options):
+        return BrapiClient(server.endpoint, logger, retry_policy=RetryPolicy(logger, retries=10, backoff=0),
+                           **options)
+
+    def test_trials_and_studies(self):
+        with BrapiStubServer(trials=2, studies_by_trial=3) as server:
+            client = self.client(server)
+            trials = list(client.get_trials(["all"]))
+            assert [trial['trialDbId'] for trial in trials] == ['1', '2']
+            assert [study['studyDbId'] for study in trials[1]['studies']] == ['2-1', '2-2', '2-3']
+            assert list(client.get_trials(['2'])) == [trials[1]]
+            assert client.get_study('2-3')['studyDbId'] == '2-3'
+            with self.assertRaises(RuntimeError):
+                client.get_study('3-1')
+
+    def test_capped_pages(self):
+        for stream_pages in (False, iter_result_data is not None):
+            with BrapiStubServer(observation_units=2500, max_page_size=300) as server:
+                client = self.client(server, page_size_controller=PageSizeController(logger, initial=1000),
+                                     stream_pages=stream_pages)
+                obs_units = list(client.get_study_observation_units('1-1'))
+                assert [obs_unit['observationUnitDbId'] for obs_unit in obs_units] == [str(i) for i in range(2500)]
+                assert server.requests['/studies/{id}/observationunits'] == 9
+                assert len(list(client.get_study_observed_variables('1-1'))) == 20
+            brapi_calls._calls_by_endpoint.clear()
+
+    def test_page_size_grown_above_cap(self):
+        # pages grow from 100 to 600, the server serves 300 at most
+        with BrapiStubServer(observation_units=3000, max_page_size=300) as server:
+            client = self.client(server, page_size_controller=PageSizeController(logger, initial=100,
+                                                                                  increase=500))
+            obs_units = list(client.get_study_observation_units('1-1'))
+            assert [obs_unit['observationUnitDbId'] for obs_unit in obs_units] == [str(i) for i in range(3000)]
+
+    def test_injected_failures(self):
+        with BrapiStubServer(observation_units=1000, error_rates={'/studies/{id}/observationunits': 0.3},
+                             seed=1) as server:
+            client = self.client(server, page_size_controller=PageSizeController(logger, initial=100,
+                                                                                  maximum=100))
+            obs_units = list(client.get_study_observation_units('1-1'))
+            assert len(obs_units) == 1000
+            assert server.failures['/studies/{id}/observationunits'] > 0
+            assert server.requests['/studies/{id}/observationunits'] == \
+                10 + server.failures['/studies/{id}/observationunits']
+
+    def test_gateway_timeout_on_large_pages(self):
+        with BrapiStubServer(observation_units=1000, timeout_page_size=250) as server:
+            client = self.client(server, page_size_controller=PageSizeController(logger, initial=1000))
+            obs_units = list(client.get_study_observation_units('1-1'))
+            assert [obs_unit['observationUnitDbId'] for obs_unit in obs_units] == [str(i) for i in range(1000)]
+
+    def test_germplasms_by_ids(self):
+        ids = ['5', '1', '42']
+        with BrapiStubServer() as server:
+            germplasms = list(self.client(server).get_germplasms_by_ids(ids))
+            assert [germplasm['germplasmDbId'] for germplasm in germplasms] == ids
+            assert server.requests['/germplasm-search'] == 1
+            assert server.requests['/germplasm/{id}'] == 0
+        brapi_calls._calls_by_endpoint.clear()
+        with BrapiStubServer(germplasm_search=False) as server:
+            germplasms = list(self.client(server, lookup_workers=1).get_germplasms_by_ids(ids))
+            assert [germplasm['germplasmDbId'] for germplasm in germplasms] == ids
+            assert server.requests['/germplasm/{id}'] == 3
+
+    def test_unknown_path(self):
+        with BrapiStubServer() as server:
+            r = requests.get(server.endpoint + 'studies/9-9')
+            assert r.status_code == 404
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
+import filecmp
+import json
 import logging
 import os
+import tempfile
+import threading
 import unittest
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 import mock
@@ -9,7 +15,10 @@ from isatools.model import Investigation
 
 import brapi_to_isa
 import mock_data
+from brapi_client import create_session
+from brapi_stub_server import BrapiStubServer
 from brapi_to_isa_converter import BrapiToIsaConverter
+from observation_unit_store import ObservationUnitStore
 
 logger = logging.getLogger()
 endpoint = 'http://foo.com/'
@@ -91,10 +100,14 @@ class ConvertTest(unittest.TestCase):
         assert len(tdf) == len(variables) + 1
 
     def test_create_data_records(self):
-        observation_units = mock_data.mock_observation_units
+        observation_units = [dict(obs_unit, observationLevel='plot') for obs_unit in mock_data.mock_observation_units]
+        variables = [variable['name'] for variable in mock_data.mock_variables]
+        germplasminfo = {germplasm['germplasmDbId']: [germplasm.get('accessionNumber', '')]
+                         for germplasm in mock_data.mock_germplasms}
 
         # Call
-        data = self.converter.create_isa_obs_data_from_obsvars(observation_units)
+        data = self.converter.create_isa_obs_data_from_obsvars(observation_units, variables, 'plot', germplasminfo,
+                                                               defaultdict(set))
 
         # Assert
         assert data
@@ -103,6 +116,19 @@ class ConvertTest(unittest.TestCase):
         )
         assert len(data) == observation_count + 1
 
+    def test_write_obs_data_files_failure(self):
+        """Test a data file that can not be written fails the conversion of the study, without a partial file left"""
+        converter = mock.Mock()
+        converter.create_isa_obs_data_layout.return_value.head = ['Assay Name']
+        converter.create_isa_obs_data_row_values.side_effect = IOError("disk full")
+        obs_units = [dict(obs_unit, observationLevel='plot') for obs_unit in mock_data.mock_observation_units]
+
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaisesRegex(IOError, "disk full"):
+                brapi_to_isa.write_obs_data_files(converter, '1', obs_units, {'plot': {'height'}}, {}, ['plot'],
+                                                  directory + os.sep)
+            assert os.listdir(directory) == []
+
     @mock.patch('brapi_to_isa.BrapiClient', autospec=True)
     @mock.patch('brapi_to_isa_converter.BrapiClient', autospec=True)
     def test_all_convert(self, client_mock1, client_mock2):
@@ -111,20 +137,138 @@ class ConvertTest(unittest.TestCase):
         instance_mock = client_mock1.return_value = client_mock2.return_value
         instance_mock.get_trials.return_value = mock_data.mock_trials
         instance_mock.get_study.return_value = mock_data.mock_study
-        instance_mock.get_study_germplasms.return_value = mock_data.mock_germplasms
-        instance_mock.get_study_observation_units.return_value = mock_data.mock_observation_units
+        # the germplasms of a study are listed with their accession number
+        germplasms = [dict(germplasm, accessionNumber=germplasm.get('accessionNumber', ''))
+                      for germplasm in mock_data.mock_germplasms]
+        instance_mock.get_study_germplasms.return_value = germplasms
+        instance_mock.get_germplasms_by_ids.return_value = germplasms
+        instance_mock.get_study_observation_units.return_value = [dict(obs_unit, observationLevel='plot')
+                                                                  for obs_unit in mock_data.mock_observation_units]
         instance_mock.get_study_observed_variables.return_value = mock_data.mock_variables
 
-        # Run full conversion
-        brapi_to_isa.main(None)
+        with tempfile.TemporaryDirectory() as directory:
+            # Run full conversion
+            brapi_to_isa.main(['-t', 'all', '-o', directory, '--cache-dir', ''])
+
+            out_folder = brapi_to_isa.get_output_path(mock_data.mock_trials[0]['trialName'], directory)
+            assert os.path.exists(out_folder)
+
+            # TODO: use MIAPPE ISA configuration for validation here
+            investigation_file_path = os.path.join(out_folder, 'i_investigation.txt')
+            with open(investigation_file_path, 'r', encoding='utf-8') as i_fp:
+                assert isatab.validate(i_fp)
+
+    @mock.patch('isatools.isatab.dump')
+    @mock.patch('brapi_to_isa.write_study_tables')
+    def test_convert_repeatedly_and_from_threads(self, *_):
+        """Test conversions of a process, one after another and concurrently, do not share their settings or state."""
+        with BrapiStubServer(trials=2, studies_by_trial=2, observation_units=200) as server, \
+                tempfile.TemporaryDirectory() as directory:
+            def convert(output_dir, **options):
+                return brapi_to_isa.convert(server.endpoint, output_dir=os.path.join(directory, output_dir),
+                                            cache_dir='', **options)
+
+            assert convert('trial', trial_ids=['1']) == [os.path.join(directory, 'trial', 'Trial 1', '')]
+            # the trial of the study, and a session reused by the next conversions
+            session = create_session()
+            assert convert('study', study_ids=['2-1'], session=session) == \
+                [os.path.join(directory, 'study', 'Trial 2', '')]
+            assert len(convert('all', trial_ids=['all'], session=session)) == 2
+
+            converted = {}
+            threads = [threading.Thread(target=lambda output_dir=output_dir, trial_ids=trial_ids:
+                                        converted.setdefault(output_dir, convert(output_dir, trial_ids=trial_ids)))
+                       for output_dir, trial_ids in (('thread1', ['1', '2']), ('thread2', ['1']))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert [len(converted['thread1']), len(converted['thread2'])] == [2, 1]
+
+            trial_files = sorted(os.listdir(os.path.join(directory, 'trial', 'Trial 1')))
+            assert trial_files == ['d_1-1_plant.txt', 'd_1-1_plot.txt', 'd_1-2_plant.txt', 'd_1-2_plot.txt',
+                                   't_1-1.txt', 't_1-2.txt']
+            for output_dir in ('all', 'thread1', 'thread2'):
+                _, mismatch, errors = filecmp.cmpfiles(os.path.join(directory, 'trial', 'Trial 1'),
+                                                       os.path.join(directory, output_dir, 'Trial 1'), trial_files,
+                                                       shallow=False)
+                assert mismatch == errors == []
+            # metrics of every conversion
+            with open(os.path.join(directory, 'thread2', 'metrics.json')) as report:
+                requests = {r['route']: r['count'] for r in json.load(report)['requests']}
+            assert requests['/trials/{id}'] == 1
+
+    @mock.patch('isatools.isatab.dump')
+    @mock.patch('brapi_to_isa.write_study_tables')
+    def test_convert_with_workers_fails_fast(self, *_):
+        """Test a failed study of a conversion with workers fails the conversion without converting the studies not
+        started yet, and a failure in the parent process still waits for the studies running."""
+        # worker threads instead of processes, so that the studies started are known: each worker records the failure
+        # of its study before taking the next one, then every study not started yet is cancelled
+        with BrapiStubServer(trials=1, studies_by_trial=8, observation_units=50,
+                             error_rates={'/studies/{id}/germplasm': 1.0}) as server, \
+                tempfile.TemporaryDirectory() as directory, \
+                mock.patch('concurrent.futures.ProcessPoolExecutor', ThreadPoolExecutor):
+            with self.assertRaises(RuntimeError):
+                brapi_to_isa.convert(server.endpoint, trial_ids=['1'], output_dir=directory, cache_dir='',
+                                     workers=2, retries=0)
+            assert 1 <= server.requests['/studies/{id}/germplasm'] <= 2
+
+        with BrapiStubServer(trials=1, studies_by_trial=2, observation_units=50) as server, \
+                tempfile.TemporaryDirectory() as directory, \
+                mock.patch('run_metrics.RunMetrics.merge', side_effect=ValueError("merge failed")):
+            with self.assertRaisesRegex(ValueError, "merge failed"):
+                brapi_to_isa.convert(server.endpoint, trial_ids=['1'], output_dir=directory, cache_dir='',
+                                     workers=2)
+            # the studies started are written before the conversion fails
+            trait_files = [file_name for file_name in os.listdir(os.path.join(directory, 'Trial 1'))
+                           if file_name.startswith('t_')]
+            assert len(trait_files) == server.requests['/studies/{id}/germplasm']
+
+    @mock.patch('brapi_to_isa.write_obs_data_files', side_effect=IOError("disk full"))
+    def test_convert_study_failure_releases_obs_units(self, _):
+        """Test the observation units of a study are released when its conversion fails"""
+        with BrapiStubServer(trials=1, studies_by_trial=1, observation_units=5) as server, \
+                tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(ObservationUnitStore, 'close', autospec=True) as close:
+            with self.assertRaisesRegex(IOError, "disk full"):
+                brapi_to_isa.convert(server.endpoint, trial_ids=['1'], output_dir=directory, cache_dir='')
+            assert close.call_count == 1
+
+    def test_convert_writes_isa_tables(self):
+        """Test the investigation, study and assay tables written for a small study, with the observation units
+        characteristics of the samples and their values as comments of the assay."""
+        with BrapiStubServer(trials=1, studies_by_trial=1, observation_units=5, germplasms=3, variables=2) as server, \
+                tempfile.TemporaryDirectory() as directory:
+            brapi_to_isa.convert(server.endpoint, trial_ids=['1'], output_dir=directory, cache_dir='')
+            trial_directory = os.path.join(directory, 'Trial 1')
+
+            def read_table(file_name):
+                with open(os.path.join(trial_directory, file_name), encoding='utf-8') as table_file:
+                    return [line.rstrip('\n').split('\t') for line in table_file]
+
+            study_table = read_table('s_1-1.txt')
+            header = study_table[0]
+            assert header[header.index('Sample Name'):] == [
+                'Sample Name', 'Characteristics[Observation unit type]', 'Characteristics[X]', 'Characteristics[Y]',
+                'Characteristics[Block Number]', 'Characteristics[Plot Number]', 'Factor Value[watering]']
+            samples = {row[header.index('Sample Name')]: row[header.index('Sample Name') + 1:] for row in study_table[1:]}
+            assert len(samples) == 5
+            # the observation unit type of the samples, and the characteristics of their observation unit
+            assert all(name.split(' ')[0] == values[0] for name, values in samples.items())
+            assert all(values[1] == name.split(' ')[1] for name, values in samples.items())
 
-        out_folder = brapi_to_isa.get_output_path(mock_data.mock_trials[0]['trialName'])
-        assert os.path.exists(out_folder)
+            assay_table = read_table('a_1-1_plot.txt')
+            assert assay_table[0] == ['Sample Name', 'Protocol REF', 'Parameter Value[season]', 'Assay Name']
+            assert len(assay_table) > 1
+            assert all(row[0] in samples and row[1] == 'phenotyping' for row in assay_table[1:])
 
-        # TODO: use MIAPPE ISA configuration for validation here
-        investigation_file_path = os.path.join(out_folder, 'i_investigation.txt')
-        with open(investigation_file_path, 'r', encoding='utf-8') as i_fp:
-            assert isatab.validate(i_fp)
+            investigation = {row[0]: row[1:] for row in read_table('i_investigation.txt')}
+            assert investigation['Study Assay File Name'] == ['a_1-1_plot.txt', 'a_1-1_plant.txt']
+            assert sorted(investigation['Comment[Observation unit type]'][0].split(';')) == \
+                sorted({values[0] for values in samples.values()})
+            assert sorted(investigation['Comment[Plot Number]'][0].split(';')) == \
+                sorted({row[4] for row in samples.values()})
 
 
 if __name__ == '__main__':
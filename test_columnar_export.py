@@ -0,0 +1,75 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+import mock_data
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from columnar_export import ObsDataColumnarWriter, variable_data_types
+except ImportError:
+    pa = None
+
+logger = logging.getLogger()
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class ObsDataColumnarWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.head = ['observationUnitDbId', 'observationTimeStamp', 'Plant height', 'Sowing date', 'Root color']
+        self.variable_types = {'Plant height': 'Numerical', 'Sowing date': 'Date', 'Root color': 'Categorical'}
+        self.rows = [['1', '2013-06-14T22:03:51Z', '1.2', '', ''],
+                     ['1', '2013-06-14T22:04:51Z', '', '2013-05-02', ''],
+                     ['2', '2013-06-14T22:05:51Z', 'NA', '', 'dark blue']]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, file_format):
+        path = os.path.join(self.tmp_dir.name, 'd_1_plot.' + file_format)
+        writer = ObsDataColumnarWriter(path, self.head, logger, self.variable_types, file_format, row_group_size=2)
+        for row in self.rows:
+            writer.write_row(row)
+        writer.close()
+        return path
+
+    def assert_table(self, table):
+        assert table.schema.field('Plant height').type == pa.float64()
+        assert table.schema.field('Sowing date').type == pa.date32()
+        assert table.schema.field('Root color').type == pa.string()
+        assert table.column('Plant height').to_pylist() == [1.2, None, None]
+        assert table.column('Sowing date').to_pylist() == [None, datetime.date(2013, 5, 2), None]
+        assert table.column('Root color').to_pylist() == [None, None, 'dark blue']
+        assert table.column('observationUnitDbId').to_pylist() == ['1', '1', '2']
+
+    def test_parquet(self):
+        # Call
+        path = self.write('parquet')
+
+        # Assert columns are typed and rows are written by row groups
+        assert pq.ParquetFile(path).num_row_groups == 2
+        self.assert_table(pq.read_table(path))
+
+    def test_arrow(self):
+        # Call
+        path = self.write('arrow')
+
+        # Assert
+        with pa.OSFile(path, 'rb') as source:
+            reader = pa.ipc.open_file(source)
+            assert reader.num_record_batches == 2
+            self.assert_table(reader.read_all())
+
+    def test_variable_data_types(self):
+        # Call / Assert
+        data_types = variable_data_types(mock_data.mock_variables)
+        assert data_types[mock_data.mock_variables[0]['name']] == 'Numerical'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import json
+import pickle
+import unittest
+
+import mock_data
+from compact_records import compact_observation_unit, to_json
+
+
+class CompactRecordsTest(unittest.TestCase):
+
+    def test_compact_observation_unit(self):
+        # Init
+        obs_unit = dict(mock_data.mock_observation_units[0], observationLevel='plot', unusedField='dropped')
+
+        # Call
+        record = compact_observation_unit(obs_unit)
+
+        # Assert fields read by the conversion are kept in server order, the others dropped
+        assert list(record.keys()) == [key for key in obs_unit if key != 'unusedField']
+        assert record['observationUnitName'] == 'Plot 1'
+        assert record.get('unusedField') is None
+        assert 'unusedField' not in record.keys()
+        with self.assertRaises(KeyError):
+            record['unusedField']
+        observation = record['observations'][0]
+        assert dict(observation) == {'observationTimeStamp': '2013-06-14T22:03:51Z',
+                                     'observationVariableName': mock_data.mock_variables[0]['name'],
+                                     'value': '1.2'}
+
+    def test_shared_keys_and_interned_values(self):
+        # Call
+        records = [compact_observation_unit(json.loads(json.dumps(obs_unit)))
+                   for obs_unit in mock_data.mock_observation_units[:2]]
+
+        # Assert records of the same shape share their keys, and repeated values are stored once
+        assert records[0]._layout is records[1]._layout
+        assert records[0]['observations'][0]['observationVariableName'] is \
+            compact_observation_unit(json.loads(json.dumps(mock_data.mock_observation_units[0])))[
+                'observations'][0]['observationVariableName']
+
+    def test_serialization(self):
+        # Init
+        record = compact_observation_unit(mock_data.mock_observation_units[0])
+
+        # Assert records can be spooled to JSON and sent to worker processes
+        assert json.loads(json.dumps(record, default=to_json))['observations'][1]['value'] == '4.5'
+        assert pickle.loads(pickle.dumps(record)) == record
+
+
+if __name__ == '__main__':
+    unittest.main()
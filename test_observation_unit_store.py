@@ -0,0 +1,52 @@
+import logging
+import os
+import unittest
+
+import mock_data
+from observation_unit_store import ObservationUnitStore
+
+logger = logging.getLogger()
+
+
+class ObservationUnitStoreTest(unittest.TestCase):
+
+    def test_replay_in_memory(self):
+        fetched = []
+
+        def obs_units():
+            for obs_unit in mock_data.mock_observation_units:
+                fetched.append(obs_unit)
+                yield obs_unit
+
+        # Init
+        store = ObservationUnitStore(obs_units(), logger)
+
+        # Assert units can be replayed without fetching them again
+        assert not store.spooled
+        assert len(store) == len(mock_data.mock_observation_units)
+        assert list(store) == mock_data.mock_observation_units
+        assert list(store) == mock_data.mock_observation_units
+        assert len(fetched) == len(mock_data.mock_observation_units)
+
+    def test_replay_spooled(self):
+        # Init
+        store = ObservationUnitStore(iter(mock_data.mock_observation_units), logger, max_in_memory=1)
+
+        # Assert
+        assert store.spooled
+        spool_path = store._spool_path
+        assert os.path.exists(spool_path)
+        assert len(store) == len(mock_data.mock_observation_units)
+        assert list(store) == mock_data.mock_observation_units
+        assert list(store) == mock_data.mock_observation_units
+
+        # Assert spool file is removed on close, and a closed store can not be replayed
+        store.close()
+        assert not os.path.exists(spool_path)
+        assert not store.spooled
+        with self.assertRaises(ValueError):
+            iter(store)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import logging
+import os
+import tempfile
+import time
+import unittest
+
+import requests
+
+from response_cache import ResponseCache
+
+logger = logging.getLogger()
+
+
+def make_response(url, body, etag):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['ETag'] = etag
+    response._content = body
+    return response
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_store_and_hit(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir, logger)
+            key = cache.key('http://foo/studies', {'page': 0, 'pageSize': 1000})
+
+            # Call
+            cache.store(key, make_response('http://foo/studies', b'{"result": {}}', '"v1"'))
+            entry = cache.get(key)
+
+            # Assert
+            assert cache.conditional_headers(entry) == {'If-None-Match': '"v1"'}
+            assert cache.hit(key, entry, 'http://foo/studies').json() == {'result': {}}
+            assert cache.get(cache.key('http://foo/studies', {'page': 1, 'pageSize': 1000})) is None
+
+    def test_store_again(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir, logger)
+            key = cache.key('http://foo/studies')
+
+            # Call: store the same response 3 times, then a bigger one
+            for etag in ('"v1"', '"v2"', '"v3"'):
+                cache.store(key, make_response('http://foo/studies', b'x' * 1000, etag))
+            cache.store(key, make_response('http://foo/studies', b'x' * 2000, '"v4"'))
+
+            # Assert the size of the cache is the size of the last entry only
+            assert cache._size == os.path.getsize(cache._path(key))
+            assert ResponseCache(cache_dir, logger)._size == cache._size
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir, logger, max_size=2500)
+            body = b'x' * 1000
+
+            # Call: store 3 responses of ~1KB in a 2.5KB cache
+            for i in range(3):
+                cache.store(cache.key(f'http://foo/{i}'), make_response(f'http://foo/{i}', body, str(i)))
+                # make sure previous responses look older
+                past = time.time() - 100 + i
+                os.utime(cache._path(cache.key(f'http://foo/{i}')), (past, past))
+
+            # Assert least recently stored response was evicted
+            assert cache.get(cache.key('http://foo/0')) is None
+            assert cache.get(cache.key('http://foo/2')) is not None
+
+
+if __name__ == '__main__':
+    unittest.main()
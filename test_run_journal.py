@@ -0,0 +1,54 @@
+import logging
+import os
+import tempfile
+import unittest
+
+from run_journal import RunJournal
+
+logger = logging.getLogger()
+
+
+class RunJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal_dir = os.path.join(self.tmp_dir.name, '.journal')
+        self.output_directory = os.path.join(self.tmp_dir.name, 'trial') + '/'
+        os.makedirs(self.output_directory)
+        for name in ('s_1.txt', 'd_1_plot.txt', 'i_investigation.txt'):
+            with open(self.output_directory + name, 'w') as fh:
+                fh.write(name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resume(self):
+        # Init
+        journal = RunJournal(self.journal_dir, logger)
+        journal.record_study(self.output_directory, '1', ['s_1.txt', 'd_1_plot.txt', 't_1.txt'], ('study', []))
+        journal.record_trial(self.output_directory, ['1'], ['i_investigation.txt'])
+
+        # Assert completed work is found by a resumed run, and forgotten by a new run
+        resumed = RunJournal(self.journal_dir, logger, resume=True)
+        assert resumed.converted_study(self.output_directory, '1') == ('study', [])
+        assert resumed.trial_done(self.output_directory, ['1'])
+        assert not resumed.trial_done(self.output_directory, ['1', '2'])
+        assert resumed.converted_study(self.output_directory, '2') is None
+        assert not RunJournal(self.journal_dir, logger).trial_done(self.output_directory, ['1'])
+
+    def test_resume_changed_file(self):
+        # Init
+        journal = RunJournal(self.journal_dir, logger)
+        journal.record_study(self.output_directory, '1', ['s_1.txt', 'd_1_plot.txt'], ('study', []))
+        journal.record_trial(self.output_directory, ['1'], ['i_investigation.txt'])
+        with open(self.output_directory + 'd_1_plot.txt', 'a') as fh:
+            fh.write('partial row')
+
+        # Assert a study whose files changed, and its trial, are converted again
+        resumed = RunJournal(self.journal_dir, logger, resume=True)
+        assert resumed.converted_study(self.output_directory, '1') is None
+        assert not resumed.trial_done(self.output_directory, ['1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
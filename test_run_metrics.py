@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+import brapi_calls
+from brapi_client import BrapiClient
+from brapi_stub_server import BrapiStubServer
+from page_size_controller import PageSizeController
+from retry_policy import RetryPolicy
+from run_metrics import RunMetrics, prometheus_text
+
+logger = logging.getLogger('run_metrics_test')
+
+
+class RunMetricsTest(unittest.TestCase):
+
+    def test_record_requests_and_stages(self):
+        metrics = RunMetrics('http://foo/')
+        metrics.record_request('GET', '/studies/{id}', 200, 0.02, 100)
+        metrics.record_request('GET', '/studies/{id}', 503, 3.0, 10)
+        metrics.record_request('GET', '/studies/{id}', None, 300.0)
+        metrics.record_retry('GET', '/studies/{id}')
+        metrics.record_cache_hit('GET', '/studies/{id}')
+        with metrics.stage('germplasm'):
+            pass
+        metrics.record_stage('germplasm', 1.5)
+
+        report = metrics.to_dict()
+        route, = report['requests']
+        assert (route['method'], route['route'], route['count'], route['errors']) == ('GET', '/studies/{id}', 3, 1)
+        assert route['statuses'] == {'200': 1, '503': 1}
+        assert route['latency']['buckets']['0.05'] == 1
+        assert route['latency']['buckets']['5.0'] == 2
+        assert route['latency']['buckets']['+Inf'] == 3
+        assert (route['bytes'], route['retries'], route['cache_hits']) == (110, 1, 1)
+        assert report['stages']['germplasm']['count'] == 2
+        assert report['stages']['germplasm']['seconds'] >= 1.5
+
+        # merged from a worker process
+        merged = RunMetrics('http://foo/')
+        merged.merge(report)
+        merged.merge(json.loads(json.dumps(report)))
+        route, = merged.to_dict()['requests']
+        assert route['count'] == 6
+        assert route['latency']['buckets'] == {bound: count * 2 for bound, count in
+                                               report['requests'][0]['latency']['buckets'].items()}
+        assert merged.to_dict()['stages']['germplasm']['count'] == 4
+
+        text = prometheus_text(report)
+        assert 'brapi_requests_total{method="GET",route="/studies/{id}",status="503"} 1\n' in text
+        assert 'brapi_requests_total{method="GET",route="/studies/{id}",status="error"} 1\n' in text
+        assert 'brapi_request_duration_seconds_bucket{method="GET",route="/studies/{id}",le="+Inf"} 3\n' in text
+        assert 'brapi_stage_duration_seconds{stage="germplasm"} ' in text
+
+    def test_write_reports(self):
+        metrics = RunMetrics('http://foo/')
+        metrics.record_request('GET', '/trials', 200, 0.1, 10)
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.write_json(os.path.join(directory, 'out', 'metrics.json'))
+            metrics.write_prometheus(os.path.join(directory, 'metrics.prom'))
+            with open(os.path.join(directory, 'out', 'metrics.json')) as report:
+                assert json.load(report)['requests'][0]['route'] == '/trials'
+            with open(os.path.join(directory, 'metrics.prom')) as textfile:
+                assert '# TYPE brapi_request_duration_seconds histogram' in textfile.read()
+            assert sorted(os.listdir(directory)) == ['metrics.prom', 'out']
+
+    def test_client_metrics(self):
+        brapi_calls._calls_by_endpoint.clear()
+        metrics = RunMetrics()
+        with BrapiStubServer(observation_units=500, error_rates={'/germplasm/{id}': 0.5}, seed=3) as server:
+            client = BrapiClient(server.endpoint, logger, metrics=metrics,
+                                 retry_policy=RetryPolicy(logger, retries=20, backoff=0),
+                                 page_size_controller=PageSizeController(logger, initial=200, maximum=200))
+            assert len(list(client.get_study_observation_units('1-1'))) == 500
+            for germplasm_id in ('1', '2', '3'):
+                client.get_germplasm(germplasm_id)
+            requests = {(route['method'], route['route']): route for route in metrics.to_dict()['requests']}
+
+            obs_units = requests[('GET', '/studies/{id}/observationunits')]
+            assert obs_units['count'] == 3
+            assert obs_units['statuses'] == {'200': 3}
+            assert obs_units['bytes'] > 0
+            germplasm = requests[('GET', '/germplasm/{id}')]
+            assert germplasm['count'] == server.requests['/germplasm/{id}']
+            assert germplasm['retries'] == server.failures['/germplasm/{id}'] > 0
+            assert germplasm['statuses'] == {'200': 3, '503': server.failures['/germplasm/{id}']}
+            assert ('GET', '/calls') in requests
+
+
+if __name__ == '__main__':
+    unittest.main()
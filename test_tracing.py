@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+import brapi_calls
+import tracing
+from brapi_client import BrapiClient
+from brapi_stub_server import BrapiStubServer
+from page_size_controller import PageSizeController
+from run_metrics import RunMetrics
+from tracing import span
+
+logger = logging.getLogger('tracing_test')
+
+
+class TracingTest(unittest.TestCase):
+
+    def tearDown(self):
+        tracing.disable()
+
+    def test_disabled(self):
+        assert tracing.tracer() is None
+        with span('study', 'study', study_id='1') as study_span:
+            study_span.set(objects=3)
+        assert study_span is span('other')
+
+    def test_nested_spans(self):
+        trace = tracing.enable('test')
+        with span('trial', 'trial', trial='Trial 1'):
+            with span('study', 'study', study_id='1') as study_span:
+                study_span.set(units=10)
+                with self.assertRaises(ValueError):
+                    with span('decode', 'json'):
+                        raise ValueError()
+        with RunMetrics().stage('germplasm'):
+            pass
+
+        events = trace.to_chrome_trace()['traceEvents']
+        assert [event['name'] for event in events if event['ph'] == 'M'] == ['process_name', 'thread_name']
+        spans = {event['name']: event for event in events if event['ph'] == 'X'}
+        assert sorted(spans) == ['decode', 'germplasm', 'study', 'trial']
+        assert spans['study']['args'] == {'study_id': '1', 'units': 10}
+        assert spans['decode']['args'] == {'error': 'ValueError'}
+        assert spans['germplasm']['cat'] == 'stage'
+        # children within their parent
+        for parent, child in (('trial', 'study'), ('study', 'decode')):
+            assert spans[parent]['ts'] <= spans[child]['ts']
+            assert spans[child]['ts'] + spans[child]['dur'] <= spans[parent]['ts'] + spans[parent]['dur']
+
+        # events of a worker process merged into the trace of the parent
+        drained = trace.drain()
+        assert drained == events
+        assert trace.to_chrome_trace()['traceEvents'] == []
+        parent = tracing.Tracer('parent')
+        parent.merge(json.loads(json.dumps(drained)))
+        assert len(parent.to_chrome_trace()['traceEvents']) == len(events) + 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            parent.write(os.path.join(directory, 'trace', 'trace.json'))
+            with open(os.path.join(directory, 'trace', 'trace.json')) as trace_file:
+                assert len(json.load(trace_file)['traceEvents']) == len(events) + 1
+
+    def test_client_spans(self):
+        brapi_calls._calls_by_endpoint.clear()
+        trace = tracing.enable()
+        with BrapiStubServer(observation_units=500) as server:
+            client = BrapiClient(server.endpoint, logger,
+                                 page_size_controller=PageSizeController(logger, initial=200, maximum=200))
+            assert len(list(client.get_study_observation_units('1-1'))) == 500
+
+        spans = [event for event in trace.to_chrome_trace()['traceEvents'] if event['ph'] == 'X']
+        pages = [event['args'] for event in spans if event['name'] == 'GET /studies/{id}/observationunits']
+        assert [(page['page'], page['page_size'], page['status']) for page in pages] == \
+               [(0, 200, 200), (1, 200, 200), (2, 200, 200)]
+        assert all(page['bytes'] > 0 for page in pages)
+        decoded = [event['args'] for event in spans if event['cat'] == 'json']
+        assert sum(decode['objects'] for decode in decoded) >= 500
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from atomic_file import atomic_write
+
+
+class Span:
+    """ Timed operation of a trace, recorded as a Chrome trace-event complete event when it ends
+
+    Spans opened in a span of the same thread are nested in it by the trace viewers (Perfetto, chrome://tracing).
+    """
+    __slots__ = ('tracer', 'name', 'category', 'attributes', 'start')
+
+    def __init__(self, tracer, name: str, category: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.start = None
+
+    def set(self, **attributes):
+        """Add attributes to the span (ex a count known once the operation is done)"""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.category, self.start, end, self.attributes)
+
+
+class _NullSpan:
+    """ Span returned when tracing is disabled, doing nothing
+    """
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """ Collect the spans of a process as Chrome trace events, to be viewed in Perfetto or chrome://tracing
+
+    Timestamps come from the monotonic performance counter, shared by the processes of a machine, so the events
+    of worker processes can be merged into the trace of the parent process (see drain and merge).
+    """
+
+    def __init__(self, process_name: str = None):
+        """
+        :param process_name name of the process in the trace (ex 'brapi_to_isa', 'worker')
+        """
+        self.pid = os.getpid()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        if process_name:
+            self._events.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                                 'args': {'name': process_name + ' ' + str(self.pid)}})
+
+    def record(self, name: str, category: str, start: int, end: int, attributes: dict):
+        """Record a span from start to end, in nanoseconds of time.perf_counter_ns"""
+        tid = threading.get_ident()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000,
+                 'pid': self.pid, 'tid': tid, 'args': attributes}
+        with self._lock:
+            if tid not in self._threads:
+                self._threads[tid] = threading.current_thread().name
+                self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                     'args': {'name': self._threads[tid]}})
+            self._events.append(event)
+
+    def drain(self) -> list:
+        """Return the events recorded so far and forget them (ex to send them to the parent process)"""
+        with self._lock:
+            events, self._events = self._events, []
+            self._threads = {}
+            return events
+
+    def merge(self, events: list):
+        """Add events recorded by another tracer (ex in a worker process)"""
+        with self._lock:
+            self._events.extend(events)
+
+    def to_chrome_trace(self) -> dict:
+        """Trace in the Chrome trace-event JSON format"""
+        with self._lock:
+            return {'traceEvents': list(self._events), 'displayTimeUnit': 'ms'}
+
+    def write(self, path: str, logger: logging.Logger = None):
+        """Write the trace as a Chrome trace-event JSON file"""
+        trace = json.dumps(self.to_chrome_trace(), default=str)
+        try:
+            atomic_write(path, trace)
+        except OSError as oserror:
+            if logger is None:
+                raise
+            logger.warning("Could not write trace to " + path + ": " + str(oserror))
+
+
+# tracer of the process, None while tracing is disabled
+_tracer = None
+
+
+def enable(process_name: str = None) -> Tracer:
+    """Start tracing the spans of the process, return the tracer collecting them"""
+    global _tracer
+    _tracer = Tracer(process_name)
+    return _tracer
+
+
+def disable():
+    """Stop tracing"""
+    global _tracer
+    _tracer = None
+
+
+def tracer() -> Tracer:
+    """Tracer of the process, None if tracing is disabled"""
+    return _tracer
+
+
+def span(name: str, category: str = 'brapi', **attributes):
+    """
+    Return a span to time an operation with a with statement, a no-op shared object when tracing is disabled
+    :param name name of the span (ex 'study', 'GET /studies/{id}/observationunits')
+    :param category category of the span (ex 'stage', 'http')
+    :param attributes attributes of the span, shown as its arguments (ex study_id='1', page=3)
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, category, attributes)